@@ -0,0 +1,92 @@
+"""
+Measure the time and memory used to return a page of rows, by default
+using first: 5000 against a table with eight columns.
+
+    python benchmarks/rows.py
+    python benchmarks/rows.py 1000 10000
+"""
+
+from datasette.app import Datasette
+from datasette_graphql.execution import execute_graphql
+from datasette_graphql.utils import schema_for_database
+import asyncio
+import pathlib
+import sqlite_utils
+import sys
+import tempfile
+import time
+import tracemalloc
+
+QUERY = """{
+  rows(first: %d) {
+    nodes { id name score created category flag notes parent_id }
+  }
+}"""
+REPEAT = 5
+
+
+def build_database(path, num_rows):
+    db = sqlite_utils.Database(path)
+    db["rows"].insert_all(
+        (
+            {
+                "id": i,
+                "name": "row {}".format(i),
+                "score": i / 7,
+                "created": "2024-01-01 00:00:{:02d}".format(i % 60),
+                "category": "category {}".format(i % 10),
+                "flag": i % 2,
+                "notes": "Some notes about row {}".format(i),
+                "parent_id": i // 2,
+            }
+            for i in range(num_rows)
+        ),
+        pk="id",
+    )
+    db.close()
+
+
+async def benchmark(path, num_rows):
+    ds = Datasette([str(path)], settings={"max_returned_rows": num_rows})
+    await ds.invoke_startup()
+    schema = (await schema_for_database(ds, path.stem)).schema
+    query = QUERY % num_rows
+
+    async def run():
+        result = await execute_graphql(schema, query, context_value={}, cost_limit=None)
+        assert not result.errors, result.errors
+        assert len(result.data["rows"]["nodes"]) == num_rows
+
+    # Warm up caches
+    await run()
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        await run()
+    elapsed = (time.perf_counter() - start) / REPEAT
+    tracemalloc.start()
+    await run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(sizes):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print(
+            "{:>8}  {:>10}  {:>12}  {:>14}".format(
+                "rows", "time (s)", "us per row", "peak memory (MB)"
+            )
+        )
+        for size in sizes:
+            path = pathlib.Path(tmpdir) / "rows_{}.db".format(size)
+            build_database(path, size)
+            elapsed, peak = asyncio.run(benchmark(path, size))
+            print(
+                "{:>8}  {:>10.3f}  {:>12.1f}  {:>14.1f}".format(
+                    size, elapsed, elapsed / size * 1000000, peak / 1024 / 1024
+                )
+            )
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [5000])
@@ -0,0 +1,62 @@
+"""
+Measure how long it takes to build the GraphQL schema for databases with
+10, 100 and 1,000 tables, linked to each other by foreign keys in a tree.
+
+    python benchmarks/schema_build.py
+    python benchmarks/schema_build.py 50 500
+"""
+
+from datasette.app import Datasette
+from datasette_graphql.utils import introspect_tables, schema_for_database
+import asyncio
+import pathlib
+import sqlite_utils
+import sys
+import tempfile
+import time
+
+
+def build_database(path, num_tables):
+    db = sqlite_utils.Database(path)
+    for i in range(num_tables):
+        db["table_{}".format(i)].create(
+            {
+                "id": int,
+                "name": str,
+                "score": float,
+                "created": str,
+                "parent_id": int,
+            },
+            pk="id",
+            foreign_keys=(
+                [("parent_id", "table_{}".format(i // 2), "id")] if i else []
+            ),
+        )
+    db.close()
+
+
+async def benchmark(path):
+    ds = Datasette([str(path)])
+    await ds.invoke_startup()
+    db = ds.get_database(path.stem)
+    start = time.perf_counter()
+    await db.execute_fn(lambda conn: introspect_tables(conn, ds, db.name, {}))
+    introspect = time.perf_counter() - start
+    start = time.perf_counter()
+    await schema_for_database(ds, db.name)
+    build = time.perf_counter() - start
+    return introspect, build
+
+
+def main(sizes):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print("{:>8}  {:>14}  {:>14}".format("tables", "introspect (s)", "schema (s)"))
+        for size in sizes:
+            path = pathlib.Path(tmpdir) / "tables_{}.db".format(size)
+            build_database(path, size)
+            introspect, build = asyncio.run(benchmark(path))
+            print("{:>8}  {:>14.3f}  {:>14.3f}".format(size, introspect, build))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000])
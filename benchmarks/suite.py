@@ -0,0 +1,299 @@
+"""
+Benchmark suite that runs against synthetic databases of a controlled
+shape, writing the results as JSON so that runs can be compared.
+
+Each of the shape options accepts a comma separated list of values, and
+every combination of them is benchmarked:
+
+    python benchmarks/suite.py
+    python benchmarks/suite.py --tables 10,100 --rows 1000 --fts 0,1
+    python benchmarks/suite.py --output before.json
+    python benchmarks/suite.py --output after.json --compare before.json
+
+The databases have these shapes:
+
+--tables   number of tables, linked by foreign keys in a binary tree
+--rows     rows in each table
+--columns  extra integer, float and text columns in each table
+--fanout   rows in a child table that point at each row in its parent
+--fts      1 to configure full-text search for every table
+
+For each database schema_build_seconds is how long schema_for_database()
+takes with nothing cached. Then each of these queries is measured:
+
+- simple: a page of rows from one table, with totalCount
+- nested: rows, their related rows and the foreign keys of those, an
+  N+1 pattern without batching - if there are two or more tables
+- search: a search: query - if --fts is 1
+
+For each query:
+
+- cold_request_seconds: a request through view_graphql after clearing
+  the schema and query document caches
+- warm_request_seconds: the same request with everything cached
+- sql_statements: SQL statements executed by a warm request
+- peak_memory_bytes: peak memory allocated during a warm request
+
+Everything runs in-process against temporary files, with no network.
+"""
+
+from datasette.app import Datasette
+from datasette_graphql import utils
+from datasette_graphql.execution import _document_cache
+from datasette_graphql.utils import _schema_cache, schema_for_database
+import argparse
+import asyncio
+import datasette
+import graphql
+import itertools
+import json
+import pathlib
+import platform
+import sqlite3
+import sqlite_utils
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+PAGE_SIZE = 100
+NESTED_PAGE_SIZE = 10
+PLUGIN_CONFIG = {
+    # Large enough that no limit interrupts a benchmark
+    "time_limit_ms": 600000,
+    "num_queries_limit": 100000,
+    "query_cost_limit": 0,
+}
+
+
+def build_database(path, tables, rows, columns, fanout, fts):
+    db = sqlite_utils.Database(path)
+    types = (int, float, str)
+    for i in range(tables):
+        schema = {"id": int, "name": str, "parent_id": int}
+        for c in range(columns):
+            schema["column_{}".format(c)] = types[c % 3]
+        table = db["table_{}".format(i)]
+        table.create(
+            schema,
+            pk="id",
+            foreign_keys=(
+                [("parent_id", "table_{}".format((i - 1) // 2), "id")] if i else []
+            ),
+        )
+        table.insert_all(
+            (
+                dict(
+                    {
+                        "id": r,
+                        "name": "Row {} of table {}".format(r, i),
+                        "parent_id": r // fanout if i else None,
+                    },
+                    **{
+                        "column_{}".format(c): (r * c, r / (c + 1), "text " * c)[c % 3]
+                        for c in range(columns)
+                    },
+                )
+                for r in range(rows)
+            ),
+            batch_size=1000,
+        )
+        if fts:
+            table.enable_fts(["name"], create_triggers=False)
+    db.close()
+
+
+def queries(tables, fts):
+    page = "first: {}".format(PAGE_SIZE)
+    result = {
+        "simple": "{ table_0(%s) { totalCount nodes { id name } } }" % page,
+    }
+    if tables > 1:
+        result["nested"] = (
+            "{ table_0(%s) { nodes { id name table_1_list(first: %d) "
+            "{ totalCount nodes { id name parent_id { id name } } } } } }"
+        ) % (page, NESTED_PAGE_SIZE)
+    if fts:
+        result["search"] = '{ table_0(search: "Row", %s) { nodes { id name } } }' % (
+            page
+        )
+    return result
+
+
+def clear_caches():
+    _schema_cache.clear()
+    _document_cache.clear()
+    utils._schema_versions.clear()
+
+
+def count_statements(db):
+    "Count the SQL statements executed against db in db.statements"
+    execute = db.execute
+    db.statements = 0
+
+    async def counting_execute(*args, **kwargs):
+        db.statements += 1
+        return await execute(*args, **kwargs)
+
+    db.execute = counting_execute
+
+
+async def timed_request(ds, db, query):
+    statements = db.statements
+    start = time.perf_counter()
+    response = await ds.client.post(
+        "/graphql/{}".format(db.name), json={"query": query}
+    )
+    elapsed = time.perf_counter() - start
+    data = response.json()
+    assert response.status_code == 200 and not data.get("errors"), data
+    return elapsed, db.statements - statements
+
+
+def summary(timings):
+    timings = sorted(timings)
+    return {
+        "min": timings[0],
+        "median": statistics.median(timings),
+        "p95": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+    }
+
+
+async def benchmark(path, parameters, repeat):
+    clear_caches()
+    ds = Datasette(
+        [str(path)],
+        settings={"max_returned_rows": PAGE_SIZE},
+        metadata={"plugins": {"datasette-graphql": PLUGIN_CONFIG}},
+    )
+    await ds.invoke_startup()
+    database = path.stem
+    db = ds.get_database(database)
+    count_statements(db)
+    results = {}
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await schema_for_database(ds, database)
+        timings.append(time.perf_counter() - start)
+    results["schema_build_seconds"] = summary(timings)
+
+    for name, query in queries(parameters["tables"], parameters["fts"]).items():
+        cold = []
+        for _ in range(repeat):
+            clear_caches()
+            elapsed, statements = await timed_request(ds, db, query)
+            cold.append(elapsed)
+        warm = []
+        for _ in range(repeat):
+            elapsed, statements = await timed_request(ds, db, query)
+            warm.append(elapsed)
+        tracemalloc.start()
+        await timed_request(ds, db, query)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {
+            "cold_request_seconds": summary(cold),
+            "warm_request_seconds": summary(warm),
+            "sql_statements": statements,
+            "peak_memory_bytes": peak,
+        }
+    clear_caches()
+    return results
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sqlite": sqlite3.sqlite_version,
+        "datasette": datasette.__version__,
+        "graphql-core": graphql.__version__,
+    }
+
+
+def flatten(results, prefix=""):
+    "{'simple': {'warm_request_seconds': {'median': 1}}} => {'simple.warm...median': 1}"
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(previous, runs):
+    "Print the change in every measurement since a previous set of results"
+    previous_runs = {json.dumps(run["parameters"]): run for run in previous["runs"]}
+    for run in runs:
+        before = previous_runs.get(json.dumps(run["parameters"]))
+        if before is None:
+            continue
+        print("\nCompared with previous results for {}".format(run["parameters"]))
+        before = flatten(before["results"])
+        for key, value in flatten(run["results"]).items():
+            if before.get(key):
+                print(
+                    "  {:<50} {:>+8.1f}%".format(
+                        key, (value - before[key]) / before[key] * 100
+                    )
+                )
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tables", type=int_list, default=[10])
+    parser.add_argument("--rows", type=int_list, default=[1000])
+    parser.add_argument("--columns", type=int_list, default=[6])
+    parser.add_argument("--fanout", type=int_list, default=[5])
+    parser.add_argument("--fts", type=int_list, default=[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results from a previous run")
+    args = parser.parse_args(argv)
+
+    runs = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i, (tables, rows, columns, fanout, fts) in enumerate(
+            itertools.product(
+                args.tables, args.rows, args.columns, args.fanout, args.fts
+            )
+        ):
+            parameters = {
+                "tables": tables,
+                "rows": rows,
+                "columns": columns,
+                "fanout": fanout,
+                "fts": bool(fts),
+            }
+            path = pathlib.Path(tmpdir) / "bench_{}.db".format(i)
+            build_database(path, **parameters)
+            results = asyncio.run(benchmark(path, parameters, args.repeat))
+            runs.append({"parameters": parameters, "results": results})
+            print(
+                "{}: schema {:.3f}s, warm simple {:.2f}ms".format(
+                    parameters,
+                    results["schema_build_seconds"]["median"],
+                    results["simple"]["warm_request_seconds"]["median"] * 1000,
+                ),
+                file=sys.stderr,
+            )
+
+    output = {"environment": environment(), "runs": runs}
+    if args.output:
+        pathlib.Path(args.output).write_text(json.dumps(output, indent=2))
+    else:
+        print(json.dumps(output, indent=2))
+    if args.compare:
+        compare(json.loads(pathlib.Path(args.compare).read_text()), runs)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
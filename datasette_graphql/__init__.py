@@ -1,11 +1,42 @@
 from click import ClickException
 from datasette import hookimpl
-from datasette.utils.asgi import Response, NotFound, Forbidden
+from datasette.utils.asgi import AsgiStream, Response, NotFound, Forbidden
+from datasette.permissions import Action
 from datasette.plugins import pm
 from datasette.resources import DatabaseResource
 from graphql import graphql, print_schema
-import json
-from .utils import schema_for_database_via_cache
+import asyncio
+from .advisor import DEFAULT_QUERY_PLAN_ADVISOR_SIZE, _query_plan_advisor
+from .concurrency import (
+    DEFAULT_MAX_CONCURRENT_QUERIES_PER_REQUEST,
+    _query_limiter,
+    default_max_concurrent_queries,
+    request_semaphore,
+)
+from .execution import (
+    DEFAULT_DOCUMENT_CACHE_SIZE,
+    _document_cache,
+    _response_cache,
+    cache_response,
+    execute_graphql,
+    get_cached_response,
+    response_cache_key,
+)
+from .incremental import MULTIPART_CONTENT_TYPE, IncrementalResult, multipart_parts
+from .metrics import _metrics
+from .persisted import (
+    DEFAULT_PERSISTED_QUERIES_SIZE,
+    _persisted_queries,
+    query_hash,
+    sha256_re,
+)
+from .utils import (
+    DEFAULT_SCHEMA_CACHE_SIZE,
+    _schema_cache,
+    schema_for_database_via_cache,
+)
+from .serializers import json_response, loads
+from .tracing import TRACING_HEADER, Tracer
 from . import hookspecs
 import pathlib
 import time
@@ -13,20 +44,38 @@ import urllib
 
 pm.add_hookspecs(hookspecs)
 
+_metrics.register_cache("schema", _schema_cache)
+_metrics.register_cache("document", _document_cache)
+_metrics.register_cache("response", _response_cache)
+_metrics.register_cache("persisted_queries", _persisted_queries)
+
 DEFAULT_TIME_LIMIT_MS = 1000
 DEFAULT_NUM_QUERIES_LIMIT = 100
+DEFAULT_MAX_BODY_SIZE = 10 * 1024 * 1024
+DEFAULT_BATCH_SIZE_LIMIT = 10
+
+
+class RequestBodyTooLarge(Exception):
+    pass
 
 
-async def post_body(request):
-    body = b""
+async def post_body(request, max_body_size=None):
+    "Read the request body, raising RequestBodyTooLarge if it exceeds max_body_size"
+    content_length = request.headers.get("content-length")
+    if max_body_size and content_length and content_length.isdigit():
+        if int(content_length) > max_body_size:
+            raise RequestBodyTooLarge()
+    body = bytearray()
     more_body = True
     while more_body:
         message = await request.receive()
         assert message["type"] == "http.request", message
         body += message.get("body", b"")
+        if max_body_size and len(body) > max_body_size:
+            raise RequestBodyTooLarge()
         more_body = message.get("more_body", False)
 
-    return body
+    return bytes(body)
 
 
 async def view_graphql_schema(request, datasette):
@@ -52,7 +101,17 @@ async def view_graphql(request, datasette):
     if request.method == "OPTIONS":
         return Response.text("ok", headers=CORS_HEADERS if datasette.cors else {})
 
-    body = await post_body(request)
+    config = datasette.plugin_config("datasette-graphql") or {}
+    try:
+        body = await post_body(
+            request, config.get("max_body_size", DEFAULT_MAX_BODY_SIZE)
+        )
+    except RequestBodyTooLarge:
+        return json_response(
+            {"error": "Request body too large"},
+            status=413,
+            headers=CORS_HEADERS if datasette.cors else {},
+        )
     database = request.url_vars.get("database")
 
     try:
@@ -87,49 +146,270 @@ async def view_graphql(request, datasette):
     if request.args.get("schema"):
         return Response.text(print_schema(schema.graphql_schema))
 
-    incoming = {}
+    headers = CORS_HEADERS if datasette.cors else {}
     if body:
-        incoming = json.loads(body)
-        query = incoming.get("query")
-        variables = incoming.get("variables")
-        operation_name = incoming.get("operationName")
+        incoming = loads(body)
     else:
-        query = request.args.get("query")
-        variables = request.args.get("variables", "")
-        if variables:
-            variables = json.loads(variables)
-        operation_name = request.args.get("operationName")
-
-    if not query:
-        return Response.json(
-            {"error": "Missing query"},
-            status=400,
-            headers=CORS_HEADERS if datasette.cors else {},
+        incoming = {
+            "query": request.args.get("query"),
+            "operationName": request.args.get("operationName"),
+        }
+        for key in ("variables", "extensions"):
+            if request.args.get(key):
+                incoming[key] = loads(request.args[key])
+
+    tracing = await tracing_requested(request, datasette, db.name)
+
+    if isinstance(incoming, list):
+        batch_size_limit = config.get("batch_size_limit", DEFAULT_BATCH_SIZE_LIMIT)
+        if not incoming:
+            return json_response({"error": "Missing query"}, 400, headers)
+        if batch_size_limit and len(incoming) > batch_size_limit:
+            return json_response(
+                {
+                    "error": "Batch of {} operations exceeds the limit of {}".format(
+                        len(incoming), batch_size_limit
+                    )
+                },
+                400,
+                headers,
+            )
+        # One context for the batch so the operations share DataLoaders
+        context = request_context(request, config)
+        results = await asyncio.gather(
+            *(
+                execute_operation(
+                    datasette,
+                    config,
+                    db,
+                    schema,
+                    operation,
+                    context,
+                    tracing=tracing,
+                )
+                for operation in incoming
+            )
+        )
+        _metrics.sql_statements.observe(context["num_sql_statements"], db.name)
+        return json_response(
+            [payload for payload, _ in results],
+            status=max(status for _, status in results),
+            headers=headers,
         )
 
-    config = datasette.plugin_config("datasette-graphql") or {}
-    context = {
+    context = request_context(request, config)
+    result = await execute_operation(
+        datasette,
+        config,
+        db,
+        schema,
+        incoming,
+        context,
+        # Tracing covers the whole operation, so nothing is deferred
+        incremental=not tracing
+        and "multipart/mixed" in request.headers.get("accept", ""),
+        tracing=tracing,
+    )
+    if isinstance(result, IncrementalResult):
+        return incremental_response(datasette, *result, db=db, context=context)
+    _metrics.sql_statements.observe(context["num_sql_statements"], db.name)
+    payload, status = result
+    return json_response(payload, status=status, headers=headers)
+
+
+def request_context(request, config):
+    return {
+        "actor": request.actor,
         "time_started": time.monotonic(),
         "time_limit_ms": config.get("time_limit_ms") or DEFAULT_TIME_LIMIT_MS,
         "num_queries_executed": 0,
+        # Every statement actually run, for the sql_statements metric
+        "num_sql_statements": 0,
         "num_queries_limit": config.get("num_queries_limit")
         or DEFAULT_NUM_QUERIES_LIMIT,
+        "query_plan_advisor": bool(config.get("query_plan_advisor")),
+        "query_semaphore": request_semaphore(
+            config.get(
+                "max_concurrent_queries_per_request",
+                DEFAULT_MAX_CONCURRENT_QUERIES_PER_REQUEST,
+            )
+        ),
     }
 
-    result = await schema.execute_async(
+
+async def tracing_requested(request, datasette, database):
+    "Was tracing requested, by a user with the graphql-tracing permission?"
+    requested = request.headers.get(TRACING_HEADER) or request.args.get("_tracing")
+    if not requested or requested.lower() in ("0", "false", "off"):
+        return False
+    return await datasette.allowed(
+        actor=request.actor,
+        action="graphql-tracing",
+        resource=DatabaseResource(database),
+    )
+
+
+async def execute_operation(
+    datasette,
+    config,
+    db,
+    schema,
+    operation,
+    context,
+    incremental=False,
+    tracing=False,
+):
+    """
+    Execute one operation - a dictionary with query, variables, operationName
+    and extensions keys. Returns a (payload, status) tuple, or an
+    IncrementalResult if incremental is True and results were deferred.
+
+    If tracing is True resolver timings are included in extensions.tracing
+    and the response cache is not used.
+    """
+    if not isinstance(operation, dict):
+        return {"error": "Operation must be a JSON object"}, 400
+    query = operation.get("query")
+    variables = operation.get("variables")
+    operation_name = operation.get("operationName")
+    extensions = operation.get("extensions")
+
+    if extensions is not None and not isinstance(extensions, dict):
+        return {"error": "extensions must be a JSON object"}, 400
+
+    persisted_query = (extensions or {}).get("persistedQuery")
+    if persisted_query:
+        query, error = await persisted_query_text(config, persisted_query, query)
+        if error:
+            return error
+
+    if not query:
+        return {"error": "Missing query"}, 400
+
+    _metrics.requests.inc(db.name, operation_name or "")
+    actor = context["actor"]
+    cache_key = None
+    if _response_cache.maxsize and not tracing:
+        cache_key = await response_cache_key(
+            db, schema, query, operation_name, variables, actor
+        )
+        cached = get_cached_response(cache_key) if cache_key else None
+        if cached is not None:
+            return dict(cached, extensions={"responseCache": {"hit": True}}), 200
+
+    tracer = Tracer() if tracing else None
+    start = time.perf_counter()
+    result = await execute_graphql(
+        schema,
         query,
         operation_name=operation_name,
         variable_values=variables or {},
         context_value=context,
+        cost_limit=config.get("query_cost_limit"),
+        depth_limit=config.get("query_depth_limit"),
+        alias_limit=config.get("query_alias_limit"),
+        incremental=incremental,
+        tracer=tracer,
     )
+    _metrics.request_duration.observe(time.perf_counter() - start, db.name)
+    if isinstance(result, IncrementalResult):
+        return result
     response = {"data": result.data}
     if result.errors:
         response["errors"] = [error.formatted for error in result.errors]
-
-    return Response.json(
-        response,
-        status=200 if not result.errors else 500,
+    elif cache_key:
+        # Errors could be caused by time limits, so only cache successes
+        db_config = datasette.plugin_config("datasette-graphql", database=db.name)
+        cache_response(
+            cache_key, dict(response), (db_config or {}).get("response_cache_ttl")
+        )
+    if cache_key:
+        response["extensions"] = {"responseCache": {"hit": False}}
+    if tracer is not None:
+        response["extensions"] = {"tracing": tracer.to_dict()}
+    return response, 200 if not result.errors else 500
+
+
+def incremental_response(
+    datasette, initial_result, subsequent_results, db=None, context=None
+):
+    "Stream @defer and @stream payloads as a multipart/mixed response"
+    initial_payload = {"data": initial_result.data}
+    if initial_result.errors:
+        initial_payload["errors"] = [error.formatted for error in initial_result.errors]
+
+    async def stream(writer):
+        async for part in multipart_parts(initial_payload, subsequent_results):
+            await writer.write(part)
+        if context is not None:
+            # Deferred fields have all been resolved now
+            _metrics.sql_statements.observe(context["num_sql_statements"], db.name)
+
+    return AsgiStream(
+        stream,
         headers=CORS_HEADERS if datasette.cors else {},
+        content_type=MULTIPART_CONTENT_TYPE,
+    )
+
+
+async def persisted_query_text(config, persisted_query, query):
+    """
+    Implements automatic persisted queries: returns (query, error) where
+    query is looked up using persistedQuery.sha256Hash if it was not
+    provided, or is stored against that hash for subsequent requests.
+    error is a (payload, status) tuple.
+    """
+
+    def error(message, code, status=200):
+        return None, (
+            {"errors": [{"message": message, "extensions": {"code": code}}]},
+            status,
+        )
+
+    if not config.get("persisted_queries", True):
+        return error("PersistedQueryNotSupported", "PERSISTED_QUERY_NOT_SUPPORTED")
+    if not isinstance(persisted_query, dict):
+        return error("Invalid persistedQuery", "BAD_REQUEST", 400)
+    sha256_hash = persisted_query.get("sha256Hash")
+    if persisted_query.get("version", 1) != 1 or not sha256_re.match(str(sha256_hash)):
+        return error("Invalid persistedQuery", "BAD_REQUEST", 400)
+    if query:
+        if query_hash(query) != sha256_hash:
+            return error("provided sha does not match query", "BAD_REQUEST", 400)
+        await _persisted_queries.set(sha256_hash, query)
+        return query, None
+    query = await _persisted_queries.get(sha256_hash)
+    if query is None:
+        return error("PersistedQueryNotFound", "PERSISTED_QUERY_NOT_FOUND")
+    return query, None
+
+
+async def view_index_advisor(request, datasette):
+    if not await datasette.allowed(actor=request.actor, action="debug-menu"):
+        raise Forbidden("debug-menu")
+    config = datasette.plugin_config("datasette-graphql") or {}
+    data = {
+        "enabled": bool(config.get("query_plan_advisor")),
+        "suggestions": _query_plan_advisor.suggestions(),
+        "queries": _query_plan_advisor.queries(),
+    }
+    if request.url_vars.get("format"):
+        return json_response(data)
+    return Response.html(
+        await datasette.render_template(
+            "index_advisor.html",
+            dict(data, graphql_path=_graphql_path(datasette)),
+            request=request,
+        )
+    )
+
+
+async def view_metrics(request, datasette):
+    if not await datasette.allowed(actor=request.actor, action="view-instance"):
+        raise Forbidden("view-instance")
+    return Response(
+        _metrics.render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
     )
 
 
@@ -143,6 +423,17 @@ async def check_permissions(request, datasette, database):
         raise Forbidden("view-database")
 
 
+@hookimpl
+def register_actions(datasette):
+    return [
+        Action(
+            name="graphql-tracing",
+            description="Include resolver timings in GraphQL API responses",
+            resource_class=DatabaseResource,
+        )
+    ]
+
+
 @hookimpl
 def menu_links(datasette, actor):
     graphql_path = _graphql_path(datasette)
@@ -168,6 +459,11 @@ def _graphql_path(datasette):
 def register_routes(datasette):
     graphql_path = _graphql_path(datasette)
     return [
+        (r"^{}/-/metrics$".format(graphql_path), view_metrics),
+        (
+            r"^{}/-/index-advisor(?P<format>\.json)?$".format(graphql_path),
+            view_index_advisor,
+        ),
         (
             r"^{}/(?P<database>[^/]+)\.graphql$".format(graphql_path),
             view_graphql_schema,
@@ -183,9 +479,11 @@ def extra_template_vars(datasette):
         schema = (
             await schema_for_database_via_cache(datasette, database=database)
         ).schema
-        result = await schema.execute_async(
+        result = await execute_graphql(
+            schema,
             query,
             variable_values=variables or {},
+            context_value={},
         )
         if result.errors:
             raise Exception(result.errors)
@@ -201,16 +499,61 @@ def extra_template_vars(datasette):
 def startup(datasette):
     # Validate configuration
     config = datasette.plugin_config("datasette-graphql") or {}
-    if "databases" in config:
-        for database_name in config["databases"].keys():
-            try:
-                datasette.get_database(database_name)
-            except KeyError:
-                raise ClickException(
-                    "datasette-graphql config error: '{}' is not a connected database".format(
-                        database_name
-                    )
+    _document_cache.resize(
+        config.get("document_cache_size", DEFAULT_DOCUMENT_CACHE_SIZE)
+    )
+    _response_cache.resize(config.get("response_cache_size", 0))
+    _schema_cache.resize(config.get("schema_cache_size", DEFAULT_SCHEMA_CACHE_SIZE))
+    _query_plan_advisor.resize(
+        config.get("query_plan_advisor_size", DEFAULT_QUERY_PLAN_ADVISOR_SIZE)
+    )
+    _persisted_queries.configure(
+        config.get("persisted_queries_size", DEFAULT_PERSISTED_QUERIES_SIZE),
+        config.get("persisted_queries_path"),
+    )
+    _query_limiter.resize(
+        config.get("max_concurrent_queries", default_max_concurrent_queries(datasette))
+    )
+    warm_up = config.get("warm_up")
+    database_names = list(config.get("databases", {}).keys())
+    if isinstance(warm_up, list):
+        database_names.extend(warm_up)
+    for database_name in database_names:
+        try:
+            datasette.get_database(database_name)
+        except KeyError:
+            raise ClickException(
+                "datasette-graphql config error: '{}' is not a connected database".format(
+                    database_name
                 )
+            )
+
+    if warm_up:
+        if not isinstance(warm_up, list):
+            warm_up = list(datasette.databases.keys())
+
+        async def inner():
+            # Build in the background so startup is not delayed
+            task = asyncio.get_running_loop().create_task(
+                warm_up_schemas(datasette, warm_up)
+            )
+            _warm_up_tasks.add(task)
+            task.add_done_callback(_warm_up_tasks.discard)
+
+        return inner
+
+
+# Keep references to running warm-up tasks so they are not garbage collected
+_warm_up_tasks = set()
+
+
+async def warm_up_schemas(datasette, database_names):
+    for database_name in database_names:
+        try:
+            await schema_for_database_via_cache(datasette, database=database_name)
+        except Exception:
+            # The error will be raised again by the first request instead
+            pass
 
 
 @hookimpl
@@ -0,0 +1,149 @@
+from datasette.database import QueryInterrupted
+from datasette.utils import escape_sqlite
+from .cache import LRUCache
+import re
+import sqlite3
+import sqlite_utils
+
+DEFAULT_QUERY_PLAN_ADVISOR_SIZE = 1000
+
+# Filter operations that an index can use to find rows directly
+EQUALITY_OPERATIONS = {"exact", "in", "isnull"}
+RANGE_OPERATIONS = {"gt", "gte", "lt", "lte"}
+
+
+def index_columns(pairs, sort_column=None):
+    """
+    Columns for an index that would serve a query with these column__op
+    filter pairs and sort column: equality columns first, then the sort
+    column or else the first range filter column
+    """
+    equality, ranges = [], []
+    for key, _ in pairs or []:
+        column, _, operation = key.rpartition("__")
+        if operation in EQUALITY_OPERATIONS and column not in equality:
+            equality.append(column)
+        elif operation in RANGE_OPERATIONS and column not in ranges:
+            ranges.append(column)
+    columns = list(equality)
+    last = sort_column or (ranges[0] if ranges else None)
+    if last and last not in columns and last != "rowid":
+        columns.append(last)
+    return columns
+
+
+def create_index_sql(table, columns):
+    return "create index {} on {} ({})".format(
+        escape_sqlite("idx_{}_{}".format(table, "_".join(columns))),
+        escape_sqlite(table),
+        ", ".join(escape_sqlite(column) for column in columns),
+    )
+
+
+def needs_index(plan, table):
+    "Does this EXPLAIN QUERY PLAN output scan the table or sort it in memory?"
+    scan_re = re.compile(r"^SCAN {}(?: |$)".format(re.escape(table)))
+    return any(
+        scan_re.match(detail) or detail.startswith("USE TEMP B-TREE FOR ORDER BY")
+        for detail in plan
+    )
+
+
+class QueryPlanAdvisor:
+    """
+    Records the SQL executed by resolvers along with the time it took,
+    runs EXPLAIN QUERY PLAN once for each distinct SQL statement and
+    suggests indexes for the tables those plans scan.
+
+    It never creates the indexes itself.
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUERY_PLAN_ADVISOR_SIZE):
+        self._queries = LRUCache(maxsize)
+
+    def resize(self, maxsize):
+        self._queries.resize(maxsize)
+
+    def clear(self):
+        self._queries.clear()
+
+    async def record(self, db, sql, params, duration_ms, index_hint=None):
+        """
+        Record one execution of sql. index_hint is a (table, columns) tuple
+        describing the index that would help this query, if any.
+        """
+        key = (db.name, sql)
+        stats = self._queries.get(key)
+        if stats is None:
+            try:
+                plan = [
+                    row["detail"]
+                    for row in (
+                        await db.execute("explain query plan " + sql, params)
+                    ).rows
+                ]
+            except (sqlite3.DatabaseError, QueryInterrupted):
+                return
+            stats = {
+                "database": db.name,
+                "sql": sql,
+                "plan": plan,
+                "suggestion": await suggested_index(db, plan, index_hint),
+                "count": 0,
+                "total_ms": 0.0,
+            }
+            self._queries.set(key, stats)
+        stats["count"] += 1
+        stats["total_ms"] += duration_ms
+
+    def queries(self):
+        return sorted(
+            (self._queries.get(key) for key in self._queries.keys()),
+            key=lambda stats: stats["total_ms"],
+            reverse=True,
+        )
+
+    def suggestions(self):
+        """
+        Suggested indexes, ranked by the total time spent executing the
+        queries that would use them
+        """
+        suggestions = {}
+        for stats in self.queries():
+            suggestion = stats["suggestion"]
+            if suggestion is None:
+                continue
+            key = (stats["database"], suggestion["create_index"])
+            item = suggestions.setdefault(
+                key,
+                dict(suggestion, database=stats["database"], count=0, total_ms=0.0),
+            )
+            item.setdefault("queries", []).append(stats["sql"])
+            item["count"] += stats["count"]
+            item["total_ms"] += stats["total_ms"]
+        return sorted(
+            suggestions.values(), key=lambda item: item["total_ms"], reverse=True
+        )
+
+
+async def suggested_index(db, plan, index_hint):
+    if not index_hint:
+        return None
+    table, columns = index_hint
+    if not columns or not needs_index(plan, table):
+        return None
+
+    def existing_indexes(conn):
+        return [index.columns for index in sqlite_utils.Database(conn)[table].indexes]
+
+    for existing in await db.execute_fn(existing_indexes):
+        if existing[: len(columns)] == columns:
+            return None
+    return {
+        "table": table,
+        "columns": columns,
+        "create_index": create_index_sql(table, columns),
+    }
+
+
+_query_plan_advisor = QueryPlanAdvisor()
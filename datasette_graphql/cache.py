@@ -0,0 +1,78 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used items once it
+    holds more than maxsize of them. Setting maxsize to 0 disables it.
+
+    Counts hits and misses for .get() so the size can be tuned.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        "Like .get() but without counting a hit or miss or marking it as used"
+        return self._items.get(key, default)
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return
+        self._items[key] = value
+        self._items.move_to_end(key)
+        self._evict()
+
+    def pop(self, key, default=None):
+        return self._items.pop(key, default)
+
+    def discard(self, key):
+        self._items.pop(key, None)
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        self._evict()
+
+    def keys(self):
+        return list(self._items.keys())
+
+    def remove_where(self, predicate):
+        "Remove every item for which predicate(key) is true"
+        for key in [key for key in self._items if predicate(key)]:
+            del self._items[key]
+
+    def clear(self):
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            "size": len(self._items),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _evict(self):
+        while len(self._items) > max(self.maxsize, 0):
+            self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
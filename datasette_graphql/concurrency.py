@@ -0,0 +1,90 @@
+from .metrics import _metrics
+import asyncio
+import time
+import weakref
+
+DEFAULT_MAX_CONCURRENT_QUERIES_PER_REQUEST = 2
+
+
+def default_max_concurrent_queries(datasette):
+    "Leave one of Datasette's read threads free for other pages"
+    return max((datasette.setting("num_sql_threads") or 0) - 1, 1)
+
+
+class QueryLimiter:
+    """
+    Limits how many SQL queries for GraphQL requests run at the same time
+    across the whole instance, so that sibling fields of a heavy query
+    cannot occupy every one of Datasette's read threads.
+
+    A limit of 0 or None means there is no limit.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        # asyncio.Semaphore is bound to the first event loop it waits in
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def resize(self, limit):
+        self.limit = limit
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def semaphore(self):
+        if not self.limit:
+            return None
+        loop = asyncio.get_running_loop()
+        try:
+            return self._semaphores[loop]
+        except KeyError:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.limit)
+            return semaphore
+
+
+_query_limiter = QueryLimiter()
+
+
+def request_semaphore(limit):
+    "The per-request limit, for the context of a GraphQL request"
+    return asyncio.Semaphore(limit) if limit else None
+
+
+class QuerySlot:
+    """
+    Async context manager that waits until both the per-request limit in
+    context and the global limit allow another query to run:
+
+        async with QuerySlot(context):
+            results = await db.execute(sql, params)
+    """
+
+    def __init__(self, context):
+        self.semaphores = [
+            semaphore
+            for semaphore in (
+                context.get("query_semaphore") if isinstance(context, dict) else None,
+                _query_limiter.semaphore(),
+            )
+            if semaphore is not None
+        ]
+        self.acquired = []
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        try:
+            # The per-request slot is taken first, so a request waiting on its
+            # own limit does not hold one of the global slots
+            for semaphore in self.semaphores:
+                await semaphore.acquire()
+                self.acquired.append(semaphore)
+        except BaseException:
+            self.release()
+            raise
+        _metrics.query_slot_wait.observe(time.perf_counter() - start)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def release(self):
+        while self.acquired:
+            self.acquired.pop().release()
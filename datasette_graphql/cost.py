@@ -0,0 +1,102 @@
+from collections import namedtuple
+from graphql import (
+    FieldNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    GraphQLInt,
+    GraphQLObjectType,
+    InlineFragmentNode,
+    get_named_type,
+    value_from_ast,
+)
+from graphql.utilities import get_operation_ast
+
+# Collections return this many nodes if first: or last: is not specified
+DEFAULT_PAGE_SIZE = 10
+
+QueryCost = namedtuple("QueryCost", ("cost", "depth", "aliases"))
+
+
+def query_cost(schema, document, operation_name=None, variable_values=None):
+    """
+    Estimate the cost of a validated query without executing it.
+
+    The cost is the number of fields that will be resolved: fields inside
+    the nodes or edges of a table collection count once for each of the
+    first: or last: rows on the page, multiplied through every level of nesting.
+    """
+    operation = get_operation_ast(document, operation_name)
+    if operation is None:
+        return QueryCost(0, 0, 0)
+    fragments = {
+        definition.name.value: definition
+        for definition in document.definitions
+        if hasattr(definition, "type_condition")
+    }
+    totals = {"cost": 0, "depth": 0, "aliases": 0}
+
+    def walk(selection_set, parent_type, multiplier, depth, page_size=None):
+        for selection in selection_set.selections:
+            if isinstance(selection, FragmentSpreadNode):
+                fragment = fragments[selection.name.value]
+                walk(fragment.selection_set, parent_type, multiplier, depth, page_size)
+            elif isinstance(selection, InlineFragmentNode):
+                type_ = parent_type
+                if selection.type_condition:
+                    type_ = schema.get_type(selection.type_condition.name.value)
+                walk(selection.selection_set, type_, multiplier, depth, page_size)
+            elif isinstance(selection, FieldNode):
+                field = parent_type.fields.get(selection.name.value)
+                if field is None:
+                    # __typename and introspection fields
+                    continue
+                field_multiplier = multiplier
+                if selection.name.value in ("nodes", "edges") and page_size is not None:
+                    field_multiplier *= page_size
+                totals["cost"] += field_multiplier
+                totals["depth"] = max(totals["depth"], depth)
+                if selection.alias:
+                    totals["aliases"] += 1
+                field_type = get_named_type(field.type)
+                if selection.selection_set and isinstance(
+                    field_type, GraphQLObjectType
+                ):
+                    child_page_size = None
+                    if "nodes" in field_type.fields:
+                        child_page_size = first_argument(selection, variable_values)
+                    walk(
+                        selection.selection_set,
+                        field_type,
+                        field_multiplier,
+                        depth + 1,
+                        child_page_size,
+                    )
+
+    walk(operation.selection_set, schema.get_root_type(operation.operation), 1, 1)
+    return QueryCost(**totals)
+
+
+def first_argument(field_node, variable_values):
+    for argument in field_node.arguments or []:
+        if argument.name.value in ("first", "last"):
+            value = value_from_ast(argument.value, GraphQLInt, variable_values)
+            if isinstance(value, int):
+                return max(value, 0)
+    return DEFAULT_PAGE_SIZE
+
+
+def query_cost_errors(cost, cost_limit=None, depth_limit=None, alias_limit=None):
+    "Errors for any of the limits that the QueryCost exceeds, 0 is no limit"
+    errors = []
+    for value, limit, description in (
+        (cost.cost, cost_limit, "Query cost"),
+        (cost.depth, depth_limit, "Query depth"),
+        (cost.aliases, alias_limit, "Number of aliases"),
+    ):
+        if limit and value > limit:
+            errors.append(
+                GraphQLError(
+                    "{} {} exceeds the limit of {}".format(description, value, limit)
+                )
+            )
+    return errors
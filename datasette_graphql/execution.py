@@ -0,0 +1,196 @@
+from graphql import (
+    ExecutionResult,
+    GraphQLError,
+    execute,
+    parse,
+    print_ast,
+    validate,
+)
+from .cache import LRUCache
+from .cost import query_cost, query_cost_errors
+from .incremental import execute_incrementally
+from .tracing import TracingMiddleware, _current_trace
+import hashlib
+import inspect
+import json
+import time
+import weakref
+
+DEFAULT_DOCUMENT_CACHE_SIZE = 500
+
+# Keys are (graphene schema, sha256 of query) tuples, values are
+# (document, validation_errors) tuples
+_document_cache = LRUCache(DEFAULT_DOCUMENT_CACHE_SIZE)
+
+# Disabled unless response_cache_size is configured. Values are
+# (expires_at, response) tuples - see response_cache_key() for the keys
+_response_cache = LRUCache(0)
+
+
+def parse_and_validate(schema, query, tracer=None):
+    """
+    Returns (document, errors) for the query against this graphene schema,
+    reusing the results from previous calls with the same query text
+    """
+    start = time.perf_counter_ns()
+    key = (schema, hashlib.sha256(query.encode("utf-8")).hexdigest())
+    cached = _document_cache.get(key)
+    if cached is not None:
+        if tracer is not None:
+            tracer.parsing = tracer.timing(start, time.perf_counter_ns())
+        return cached
+    try:
+        document = parse(query)
+    except GraphQLError as error:
+        cached = (None, [error])
+    else:
+        parsed = time.perf_counter_ns()
+        cached = (document, validate(schema.graphql_schema, document))
+        if tracer is not None:
+            tracer.parsing = tracer.timing(start, parsed)
+            tracer.validation = tracer.timing(parsed, time.perf_counter_ns())
+    _document_cache.set(key, cached)
+    return cached
+
+
+async def execute_graphql(
+    schema,
+    query,
+    operation_name=None,
+    variable_values=None,
+    context_value=None,
+    cost_limit=None,
+    depth_limit=None,
+    alias_limit=None,
+    incremental=False,
+    tracer=None,
+):
+    """
+    Equivalent to schema.execute_async() but using the document cache, and
+    rejecting queries that exceed the cost limits before executing them.
+
+    If incremental is True then @defer and @stream are respected, and an
+    IncrementalResult is returned if any results were deferred.
+
+    If a Tracer is provided every resolver is timed using that tracer.
+    """
+    # SQL statements are credited to the resolver in _current_trace
+    token = _current_trace.set((tracer, None)) if tracer is not None else None
+    try:
+        return await _execute_graphql(
+            schema,
+            query,
+            operation_name,
+            variable_values,
+            context_value,
+            cost_limit,
+            depth_limit,
+            alias_limit,
+            incremental,
+            tracer,
+        )
+    finally:
+        if token is not None:
+            _current_trace.reset(token)
+
+
+async def _execute_graphql(
+    schema,
+    query,
+    operation_name,
+    variable_values,
+    context_value,
+    cost_limit,
+    depth_limit,
+    alias_limit,
+    incremental,
+    tracer,
+):
+    document, errors = parse_and_validate(schema, query, tracer)
+    if errors:
+        return ExecutionResult(data=None, errors=errors)
+    if cost_limit or depth_limit or alias_limit:
+        cost = query_cost(
+            schema.graphql_schema, document, operation_name, variable_values
+        )
+        errors = query_cost_errors(cost, cost_limit, depth_limit, alias_limit)
+        if errors:
+            return ExecutionResult(data=None, errors=errors)
+    if incremental:
+        return await execute_incrementally(
+            schema.graphql_schema,
+            document,
+            context_value=context_value,
+            variable_values=variable_values,
+            operation_name=operation_name,
+        )
+    result = execute(
+        schema.graphql_schema,
+        document,
+        context_value=context_value,
+        variable_values=variable_values,
+        operation_name=operation_name,
+        middleware=[TracingMiddleware(tracer)] if tracer is not None else None,
+    )
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+# Connections used to check PRAGMA data_version, one per database
+_data_version_connections = weakref.WeakKeyDictionary()
+
+
+def data_version(db):
+    """
+    A value that changes whenever the data in this database might have
+    changed. PRAGMA data_version only reflects commits made by other
+    connections, so it uses a dedicated connection that never writes.
+    """
+    if not db.is_mutable:
+        return "immutable"
+    conn = _data_version_connections.get(db)
+    if conn is None:
+        conn = db.connect()
+        _data_version_connections[db] = conn
+    return conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+async def response_cache_key(
+    db, schema, query, operation_name=None, variable_values=None, actor=None
+):
+    """
+    Key for the response to this request in the response cache, or None if
+    the query is invalid. Two requests get the same key if they run the same
+    normalised query with the same variables against unchanged data, on
+    behalf of the same actor - as permission checks can change the results.
+    """
+    document, errors = parse_and_validate(schema, query)
+    if errors:
+        return None
+    return (
+        db.name,
+        data_version(db),
+        schema,
+        print_ast(document),
+        operation_name,
+        json.dumps(variable_values or {}, sort_keys=True, default=repr),
+        json.dumps(actor, sort_keys=True, default=repr),
+    )
+
+
+def get_cached_response(key):
+    cached = _response_cache.get(key)
+    if cached is None:
+        return None
+    expires_at, response = cached
+    if expires_at is not None and time.monotonic() > expires_at:
+        _response_cache.discard(key)
+        return None
+    return response
+
+
+def cache_response(key, response, ttl=None):
+    "Store a response, expiring it after ttl seconds if ttl is set"
+    expires_at = time.monotonic() + ttl if ttl else None
+    _response_cache.set(key, (expires_at, response))
@@ -0,0 +1,342 @@
+from collections import namedtuple
+from graphql import (
+    DirectiveLocation,
+    ExecutionContext,
+    ExecutionResult,
+    FieldNode,
+    GraphQLArgument,
+    GraphQLBoolean,
+    GraphQLDirective,
+    GraphQLError,
+    GraphQLInt,
+    GraphQLNonNull,
+    GraphQLString,
+    InlineFragmentNode,
+    located_error,
+)
+from graphql.execution.collect_fields import (
+    does_fragment_condition_match,
+    get_field_entry_key,
+    should_include_node,
+)
+from graphql.execution.values import get_directive_values
+from graphql.pyutils import is_iterable
+from .serializers import dumps
+import asyncio
+import copy
+
+GraphQLDeferDirective = GraphQLDirective(
+    name="defer",
+    locations=[DirectiveLocation.FRAGMENT_SPREAD, DirectiveLocation.INLINE_FRAGMENT],
+    args={
+        "if": GraphQLArgument(
+            GraphQLNonNull(GraphQLBoolean),
+            default_value=True,
+            description="Deferred when true or undefined.",
+        ),
+        "label": GraphQLArgument(GraphQLString, description="Unique name"),
+    },
+    description="Directs the executor to defer this fragment when the `if`"
+    " argument is true or undefined.",
+)
+
+GraphQLStreamDirective = GraphQLDirective(
+    name="stream",
+    locations=[DirectiveLocation.FIELD],
+    args={
+        "if": GraphQLArgument(
+            GraphQLNonNull(GraphQLBoolean),
+            default_value=True,
+            description="Stream when true or undefined.",
+        ),
+        "label": GraphQLArgument(GraphQLString, description="Unique name"),
+        "initialCount": GraphQLArgument(
+            GraphQLInt,
+            default_value=0,
+            description="Number of items to return immediately",
+        ),
+    },
+    description="Directs the executor to stream plural fields when the `if`"
+    " argument is true or undefined.",
+)
+
+# Mirrors graphql-core 3.3's ExperimentalIncrementalExecutionResults
+IncrementalResult = namedtuple(
+    "IncrementalResult", ("initial_result", "subsequent_results")
+)
+
+MULTIPART_CONTENT_TYPE = 'multipart/mixed; boundary="-"; deferSpec=20220824'
+
+# A deferred fragment: fields is {response_name: [field_nodes]} and patches
+# are any fragments deferred inside this one, sent after it
+Patch = namedtuple("Patch", ("label", "fields", "patches"))
+
+
+def collect_fields_and_patches(
+    schema, fragments, variable_values, runtime_type, selection_sets
+):
+    """
+    Like graphql-core's collect_fields(), but fragments marked with @defer
+    are returned as a separate list of patches instead of being merged in
+    """
+    fields = {}
+    patches = []
+    visited_fragment_names = set()
+
+    def collect(selection_set, fields, patches):
+        for selection in selection_set.selections:
+            if not should_include_node(variable_values, selection):
+                continue
+            if isinstance(selection, FieldNode):
+                fields.setdefault(get_field_entry_key(selection), []).append(selection)
+                continue
+            if isinstance(selection, InlineFragmentNode):
+                fragment = selection
+            else:
+                name = selection.name.value
+                if name in visited_fragment_names:
+                    continue
+                visited_fragment_names.add(name)
+                fragment = fragments.get(name)
+                if fragment is None:
+                    continue
+            if not does_fragment_condition_match(schema, fragment, runtime_type):
+                continue
+            defer = get_directive_values(
+                GraphQLDeferDirective, selection, variable_values
+            )
+            if defer and defer["if"]:
+                patch = Patch(defer.get("label"), {}, [])
+                collect(fragment.selection_set, patch.fields, patch.patches)
+                patches.append(patch)
+            else:
+                collect(fragment.selection_set, fields, patches)
+
+    for selection_set in selection_sets:
+        collect(selection_set, fields, patches)
+    return fields, patches
+
+
+class IncrementalExecutionContext(ExecutionContext):
+    """
+    Executes @defer fragments and the items after initialCount of @stream
+    fields after the rest of the operation, queueing them in self.pending
+    to be run by subsequent_results()
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Shared with the contexts created by fork()
+        self.pending = []
+        self._patches_cache = {}
+
+    def fork(self):
+        "A context for one subsequent payload, collecting its own errors"
+        context = copy.copy(self)
+        context.collected_errors = type(self.collected_errors)()
+        return context
+
+    def execute_operation(self, operation, root_value):
+        root_type = self.schema.get_root_type(operation.operation)
+        if root_type is None:
+            return super().execute_operation(operation, root_value)
+        fields, patches = collect_fields_and_patches(
+            self.schema,
+            self.fragments,
+            self.variable_values,
+            root_type,
+            [operation.selection_set],
+        )
+        self.add_patches(root_type, root_value, None, patches)
+        execute_fields = self.execute_fields
+        if operation.operation.value == "mutation":
+            execute_fields = self.execute_fields_serially
+        return execute_fields(root_type, root_value, None, fields)
+
+    def collect_subfields(self, return_type, field_nodes):
+        return self.collect_subfields_and_patches(return_type, field_nodes)[0]
+
+    def collect_subfields_and_patches(self, return_type, field_nodes):
+        key = (return_type, *map(id, field_nodes))
+        cached = self._patches_cache.get(key)
+        if cached is None:
+            cached = collect_fields_and_patches(
+                self.schema,
+                self.fragments,
+                self.variable_values,
+                return_type,
+                [node.selection_set for node in field_nodes if node.selection_set],
+            )
+            self._patches_cache[key] = cached
+        return cached
+
+    def complete_object_value(self, return_type, field_nodes, info, path, result):
+        completed = super().complete_object_value(
+            return_type, field_nodes, info, path, result
+        )
+        patches = self.collect_subfields_and_patches(return_type, field_nodes)[1]
+        self.add_patches(return_type, result, path, patches)
+        return completed
+
+    def complete_list_value(self, return_type, field_nodes, info, path, result):
+        stream = get_directive_values(
+            GraphQLStreamDirective, field_nodes[0], self.variable_values
+        )
+        if not stream or not stream["if"] or not is_iterable(result):
+            return super().complete_list_value(
+                return_type, field_nodes, info, path, result
+            )
+        initial_count = stream["initialCount"]
+        if initial_count is None or initial_count < 0:
+            raise GraphQLError("initialCount must be a positive integer")
+        result = list(result)
+        if len(result) > initial_count:
+            self.pending.append(
+                lambda: self.fork().execute_stream(
+                    stream.get("label"),
+                    return_type.of_type,
+                    field_nodes,
+                    info,
+                    path,
+                    result[initial_count:],
+                    initial_count,
+                )
+            )
+        return super().complete_list_value(
+            return_type, field_nodes, info, path, result[:initial_count]
+        )
+
+    def add_patches(self, parent_type, source, path, patches):
+        for patch in patches:
+            # Default arguments bind the loop variable
+            self.pending.append(
+                lambda patch=patch: self.fork().execute_patch(
+                    patch, parent_type, source, path
+                )
+            )
+
+    async def execute_patch(self, patch, parent_type, source, path):
+        self.add_patches(parent_type, source, path, patch.patches)
+        try:
+            data = self.execute_fields(parent_type, source, path, patch.fields)
+            if self.is_awaitable(data):
+                data = await data
+        except GraphQLError as error:
+            self.collected_errors.add(error, path)
+            data = None
+        return self.payload(
+            {"data": data, "path": path.as_list() if path else []}, patch.label
+        )
+
+    async def execute_stream(
+        self, label, item_type, field_nodes, info, path, items, start
+    ):
+        async def complete_item(index, item):
+            item_path = path.add_key(index, None)
+            try:
+                completed = self.complete_value(
+                    item_type, field_nodes, info, item_path, item
+                )
+                if self.is_awaitable(completed):
+                    completed = await completed
+                return completed
+            except Exception as raw_error:
+                error = located_error(raw_error, field_nodes, item_path.as_list())
+                self.handle_field_error(error, item_type, item_path)
+                return None
+
+        try:
+            completed_items = await asyncio.gather(
+                *(
+                    complete_item(index, item)
+                    for index, item in enumerate(items, start=start)
+                )
+            )
+        except GraphQLError as error:
+            # A non-null item failed, which nulls the whole payload
+            self.collected_errors.add(error, path)
+            completed_items = None
+        return self.payload(
+            {"items": completed_items, "path": path.as_list() + [start]}, label
+        )
+
+    def payload(self, payload, label):
+        if label is not None:
+            payload["label"] = label
+        errors = self.build_response(None, self.collected_errors.errors).errors
+        if errors:
+            payload["errors"] = [error.formatted for error in errors]
+        return payload
+
+    async def subsequent_results(self):
+        """
+        Yields {"incremental": [...], "hasNext": bool} payloads. Pending work
+        is started together so DataLoaders can batch it, and each payload is
+        sent as soon as it is ready rather than waiting for the slowest.
+        """
+        running = set()
+        # Payloads completed together are sent in the order they were queued
+        order = {}
+        try:
+            while self.pending or running:
+                for fn in self.pending:
+                    task = asyncio.ensure_future(fn())
+                    order[task] = len(order)
+                    running.add(task)
+                self.pending.clear()
+                done, running = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                yield {
+                    "incremental": [
+                        task.result() for task in sorted(done, key=order.pop)
+                    ],
+                    "hasNext": bool(running or self.pending),
+                }
+        finally:
+            for task in running:
+                task.cancel()
+
+
+async def execute_incrementally(
+    schema, document, context_value=None, variable_values=None, operation_name=None
+):
+    """
+    Execute a document that may use @defer and @stream. Returns an
+    ExecutionResult if nothing was deferred, otherwise an IncrementalResult
+    """
+    context = IncrementalExecutionContext.build(
+        schema,
+        document,
+        context_value=context_value,
+        raw_variable_values=variable_values,
+        operation_name=operation_name,
+    )
+    if isinstance(context, list):
+        return ExecutionResult(data=None, errors=context)
+    try:
+        data = context.execute_operation(context.operation, None)
+        if context.is_awaitable(data):
+            data = await data
+    except GraphQLError as error:
+        context.collected_errors.add(error, None)
+        context.pending.clear()
+        data = None
+    result = context.build_response(data, context.collected_errors.errors)
+    if not context.pending:
+        return result
+    return IncrementalResult(result, context.subsequent_results())
+
+
+async def multipart_parts(initial_payload, subsequent_results):
+    "The chunks of a multipart/mixed response body, see MULTIPART_CONTENT_TYPE"
+    yield multipart_part(dict(initial_payload, hasNext=True))
+    async for payload in subsequent_results:
+        yield multipart_part(payload)
+    yield "\r\n-----\r\n"
+
+
+def multipart_part(payload):
+    return "\r\n---\r\nContent-Type: application/json; charset=utf-8\r\n\r\n{}".format(
+        dumps(payload).decode("utf-8")
+    )
@@ -0,0 +1,324 @@
+from datasette.utils import escape_sqlite
+from .advisor import index_columns
+from .sql import (
+    aggregate_select,
+    aggregate_terms,
+    aggregates_from_values,
+    check_limits,
+    cursor_columns,
+    encode_cursor,
+    execute_sql,
+    filter_pairs,
+    make_cursor_for,
+    select_columns,
+    sort_column_and_order_by,
+    uses_rowid,
+    where_clauses_for_arguments,
+)
+import asyncio
+
+# Keep well below SQLite's default SQLITE_MAX_VARIABLE_NUMBER of 999
+MAX_BATCH_SIZE = 500
+
+
+class DataLoader:
+    """
+    Collects every key passed to .load() during the same tick of the event
+    loop and resolves them with a single call to batch_load_fn(keys), which
+    should return a list of values in the same order as the keys.
+
+    Results are cached per key for the lifetime of the loader, which is
+    normally a single GraphQL request.
+    """
+
+    def __init__(self, batch_load_fn, max_batch_size=MAX_BATCH_SIZE):
+        self.batch_load_fn = batch_load_fn
+        self.max_batch_size = max_batch_size
+        self._cache = {}
+        self._queue = []
+
+    def load(self, key):
+        if key in self._cache:
+            return self._cache[key]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._cache[key] = future
+        self._queue.append((key, future))
+        if len(self._queue) == 1:
+            # First key this tick - dispatch once the other resolvers have run
+            loop.call_soon(self._schedule_dispatch, loop)
+        return future
+
+    def _schedule_dispatch(self, loop):
+        queue, self._queue = self._queue, []
+        for i in range(0, len(queue), self.max_batch_size):
+            loop.create_task(self._dispatch(queue[i : i + self.max_batch_size]))
+
+    async def _dispatch(self, queue):
+        keys = [key for key, _ in queue]
+        try:
+            values = await self.batch_load_fn(keys)
+            assert len(values) == len(
+                keys
+            ), "batch_load_fn returned {} values for {} keys".format(
+                len(values), len(keys)
+            )
+        except Exception as ex:
+            for key, future in queue:
+                # Don't cache failures, a later load() should try again
+                self._cache.pop(key, None)
+                if not future.done():
+                    future.set_exception(ex)
+            return
+        for (_, future), value in zip(queue, values):
+            if not future.done():
+                future.set_result(value)
+
+
+def get_loader(info, key, make_loader):
+    """
+    Returns the DataLoader for key from the per-request context, creating it
+    with make_loader() if necessary. Falls back to an un-shared loader if the
+    query was executed without a context dictionary.
+    """
+    context = info.context
+    if not isinstance(context, dict):
+        return make_loader()
+    loaders = context.setdefault("loaders", {})
+    if key not in loaders:
+        loaders[key] = make_loader()
+    return loaders[key]
+
+
+def rows_by_key(rows, column, keys, many=False):
+    """
+    Match rows back up to the keys that were used to select them, returning
+    one row (or None) per key in the same order as keys - or a list of rows
+    per key if many=True.
+    """
+    by_value = {}
+    for row in rows:
+        if many:
+            by_value.setdefault(row[column], []).append(row)
+        else:
+            by_value.setdefault(row[column], row)
+    by_string = None
+    matched = []
+    for key in keys:
+        value = by_value.get(key)
+        if value is None:
+            # SQLite column affinity may have compared 1 with '1' - so the
+            # value returned from the database could be a different type
+            if by_string is None:
+                by_string = {}
+                for other_key, other_value in by_value.items():
+                    by_string.setdefault(str(other_key), other_value)
+            value = by_string.get(str(key))
+        if value is None and many:
+            value = []
+        matched.append(value)
+    return matched
+
+
+def make_fk_loader(db, table, column, from_row, context=None, meta=None):
+    # select * leaves out the rowid, which is the key for foreign keys that
+    # do not name a column and is needed by the rows' own related fields
+    columns = "*"
+    if meta is not None and uses_rowid(meta) and "rowid" not in meta.columns:
+        columns = "rowid, *"
+
+    async def batch_load(keys):
+        sql = "select {} from [{}] where [{}] in ({})".format(
+            columns, table, column, ", ".join("?" for _ in keys)
+        )
+        results = await execute_sql(db, sql, list(keys), context, (table, [column]))
+        return [
+            from_row(row) if row is not None else None
+            for row in rows_by_key(results.rows, column, keys)
+        ]
+
+    return DataLoader(batch_load)
+
+
+def make_related_rows_loader(
+    datasette,
+    db,
+    table,
+    meta,
+    fk,
+    from_row,
+    context,
+    first,
+    filter=None,
+    where=None,
+    search=None,
+    sort=None,
+    sort_desc=None,
+    include_rows=True,
+    include_count=True,
+):
+    """
+    Loader for the rows in table that have fk.column pointing at each key,
+    returning {"rows", "count", "next", "previous", "cursor_for"} dictionaries.
+    Every parent is fetched using one window function query plus one group by
+    count query, either of which is skipped if include_rows or include_count
+    are False.
+    """
+    actor = context.get("actor") if isinstance(context, dict) else None
+
+    async def batch_load(keys):
+        if first < 0:
+            assert False, "first must be >= 0"
+        if first > datasette.max_returned_rows:
+            assert False, "first must be <= {}".format(datasette.max_returned_rows)
+        where_clauses, params = await where_clauses_for_arguments(
+            datasette,
+            db,
+            table,
+            meta,
+            actor,
+            filter=filter,
+            where=where,
+            search=search,
+        )
+        sort_column, _, order_by = await sort_column_and_order_by(
+            datasette, db, table, meta, sort=sort, sort_desc=sort_desc
+        )
+        fk_column = escape_sqlite(fk.column)
+        where_clauses.append(
+            "{} in ({})".format(
+                fk_column, ", ".join(":k{}".format(i) for i in range(len(keys)))
+            )
+        )
+        params.update({"k{}".format(i): key for i, key in enumerate(keys)})
+        where_sql = " and ".join(where_clauses)
+
+        # Fetch one extra row per parent to find out if there is a next page
+        sql = (
+            "select * from (select {columns}, row_number() over "
+            "(partition by {fk_column} order by {order_by}) as _rank "
+            "from {table} where {where}) where _rank <= {limit} "
+            "order by {fk_column}, _rank"
+        ).format(
+            columns=select_columns(meta),
+            fk_column=fk_column,
+            order_by=order_by,
+            table=escape_sqlite(table),
+            where=where_sql,
+            limit=first + 1,
+        )
+        count_sql = "select {fk_column}, count(*) from {table} where {where} group by {fk_column}".format(
+            fk_column=fk_column, table=escape_sqlite(table), where=where_sql
+        )
+        if include_rows or include_count:
+            check_limits(context, sql if include_rows else count_sql)
+        pairs = filter_pairs(meta, filter) + [["{}__in".format(fk.column), keys]]
+        rows = []
+        if include_rows:
+            rows = (
+                await execute_sql(
+                    db, sql, params, context, (table, index_columns(pairs, sort_column))
+                )
+            ).rows
+        counts = []
+        if include_count:
+            counts = (
+                await execute_sql(
+                    db, count_sql, params, context, (table, index_columns(pairs))
+                )
+            ).rows
+
+        columns = cursor_columns(meta, sort_column)
+        cursor_for = make_cursor_for(meta, sort_column)
+        collections = []
+        for key_rows, count_row in zip(
+            rows_by_key(rows, fk.column, keys, many=True),
+            rows_by_key(counts, fk.column, keys),
+        ):
+            next_value = None
+            if 0 < first < len(key_rows):
+                next_value = encode_cursor(
+                    [key_rows[first - 1][column] for column in columns]
+                )
+            count = None
+            if include_count:
+                count = count_row[1] if count_row is not None else 0
+            collections.append(
+                {
+                    "rows": [
+                        from_row({k: row[k] for k in row.keys() if k != "_rank"})
+                        for row in key_rows[:first]
+                    ],
+                    "count": count,
+                    "next": next_value,
+                    "previous": None,
+                    "cursor_for": cursor_for,
+                }
+            )
+        return collections
+
+    return DataLoader(batch_load)
+
+
+def make_related_aggregates_loader(
+    datasette,
+    db,
+    table,
+    meta,
+    fk,
+    context,
+    functions,
+    include_count=True,
+    filter=None,
+    where=None,
+    search=None,
+):
+    """
+    Loader for the aggregates of the rows in table that have fk.column
+    pointing at each key, returning the same dictionaries as
+    fetch_aggregates() using one group by query for every parent.
+    """
+    actor = context.get("actor") if isinstance(context, dict) else None
+    terms = aggregate_terms(meta, functions, include_count)
+
+    async def batch_load(keys):
+        if not terms:
+            return [{} for _ in keys]
+        where_clauses, params = await where_clauses_for_arguments(
+            datasette,
+            db,
+            table,
+            meta,
+            actor,
+            filter=filter,
+            where=where,
+            search=search,
+        )
+        fk_column = escape_sqlite(fk.column)
+        where_clauses.append(
+            "{} in ({})".format(
+                fk_column, ", ".join(":k{}".format(i) for i in range(len(keys)))
+            )
+        )
+        params.update({"k{}".format(i): key for i, key in enumerate(keys)})
+        sql = "select {fk_column}, {select} from {table} where {where} group by {fk_column}".format(
+            fk_column=fk_column,
+            select=aggregate_select(terms),
+            table=escape_sqlite(table),
+            where=" and ".join(where_clauses),
+        )
+        check_limits(context, sql)
+        pairs = filter_pairs(meta, filter) + [["{}__in".format(fk.column), keys]]
+        results = await execute_sql(
+            db, sql, params, context, (table, index_columns(pairs))
+        )
+        # Parents without any matching rows get a count of 0
+        empty = [0 if column is None else None for _, column in terms]
+        return [
+            aggregates_from_values(
+                meta, terms, list(row)[1:] if row is not None else empty
+            )
+            for row in rows_by_key(results.rows, fk.column, keys)
+        ]
+
+    return DataLoader(batch_load)
@@ -0,0 +1,224 @@
+from bisect import bisect_left
+
+# Operation names come from clients, so cap the label combinations kept
+MAX_LABEL_SETS = 1000
+OVERFLOW_LABEL = "__other__"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _label_key(values, labels):
+    if labels in values or len(values) < MAX_LABEL_SETS:
+        return labels
+    return tuple(OVERFLOW_LABEL for _ in labels)
+
+
+def _format_labels(names, labels, extra=()):
+    pairs = list(zip(names, labels)) + list(extra)
+    if not pairs:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for name, value in pairs
+        )
+    )
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        values = self.values
+        key = _label_key(values, labels)
+        values[key] = values.get(key, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+    def clear(self):
+        self.values.clear()
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [count per bucket plus one for +Inf, sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        values = self.values
+        key = _label_key(values, labels)
+        try:
+            counts = values[key]
+        except KeyError:
+            counts = values[key] = [0] * (len(self.buckets) + 1) + [0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for labels, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield self.name + "_bucket", _format_labels(
+                    self.labelnames, labels, [("le", bound)]
+                ), cumulative
+            formatted = _format_labels(self.labelnames, labels)
+            yield self.name + "_sum", formatted, counts[-1]
+            yield self.name + "_count", formatted, cumulative
+
+    def clear(self):
+        self.values.clear()
+
+
+class CallbackMetric:
+    "A metric whose {labels: value} samples are read from callback() on demand"
+
+    def __init__(self, name, help, type, labelnames, callback):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = labelnames
+        self.callback = callback
+
+    def samples(self):
+        for labels, value in self.callback().items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+    def clear(self):
+        pass
+
+
+class Metrics:
+    """
+    Counters and histograms describing GraphQL execution, rendered in the
+    Prometheus text exposition format by render().
+
+    Recording a value is a dictionary update, so these can be used on the
+    hot path without measurable overhead.
+    """
+
+    def __init__(self):
+        self.requests = Counter(
+            "datasette_graphql_requests_total",
+            "GraphQL operations executed",
+            ("database", "operation"),
+        )
+        self.request_duration = Histogram(
+            "datasette_graphql_request_duration_seconds",
+            "Time taken to execute each GraphQL operation",
+            ("database",),
+        )
+        self.sql_statements = Histogram(
+            "datasette_graphql_sql_statements",
+            "SQL statements executed for each GraphQL request",
+            ("database",),
+            buckets=STATEMENT_BUCKETS,
+        )
+        self.rows = Counter(
+            "datasette_graphql_rows_total",
+            "Rows returned by SQL statements executed by resolvers",
+            ("database",),
+        )
+        self.limit_exceeded = Counter(
+            "datasette_graphql_limit_exceeded_total",
+            "Operations stopped by an execution limit",
+            ("limit",),
+        )
+        self.schema_cache = Counter(
+            "datasette_graphql_schema_cache_total",
+            "Schema cache lookups by result, hit or miss",
+            ("database", "result"),
+        )
+        self.schema_build_duration = Histogram(
+            "datasette_graphql_schema_build_seconds",
+            "Time taken to build the GraphQL schema for a database",
+            ("database",),
+        )
+        self.query_slot_wait = Histogram(
+            "datasette_graphql_query_slot_wait_seconds",
+            "Time SQL queries waited for the max_concurrent_queries limits",
+        )
+        # name -> LRUCache
+        self.caches = {}
+        self.extra = [
+            CallbackMetric(
+                "datasette_graphql_cache_{}".format(name),
+                help,
+                type,
+                ("cache",),
+                lambda stat=stat: {
+                    (cache_name,): cache.stats()[stat]
+                    for cache_name, cache in self.caches.items()
+                },
+            )
+            for name, stat, type, help in (
+                ("hits_total", "hits", "counter", "Cache lookups that found an item"),
+                (
+                    "misses_total",
+                    "misses",
+                    "counter",
+                    "Cache lookups that did not find an item",
+                ),
+                ("size", "size", "gauge", "Items in the cache"),
+                ("maxsize", "maxsize", "gauge", "Maximum items in the cache"),
+            )
+        ]
+
+    def register_cache(self, name, cache):
+        "Report the hits, misses and size of an LRUCache"
+        self.caches[name] = cache
+
+    def all(self):
+        return [
+            self.requests,
+            self.request_duration,
+            self.sql_statements,
+            self.rows,
+            self.limit_exceeded,
+            self.schema_cache,
+            self.schema_build_duration,
+            self.query_slot_wait,
+        ] + self.extra
+
+    def render(self):
+        lines = []
+        for metric in self.all():
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, labels, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        for metric in self.all():
+            metric.clear()
+
+
+_metrics = Metrics()
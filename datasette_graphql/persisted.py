@@ -0,0 +1,96 @@
+from .cache import LRUCache
+import asyncio
+import hashlib
+import re
+import sqlite3
+
+DEFAULT_PERSISTED_QUERIES_SIZE = 1000
+
+sha256_re = re.compile(r"^[0-9a-f]{64}$")
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+
+class PersistedQueryStore:
+    """
+    Stores query text by its sha256 hash for automatic persisted queries.
+
+    Queries are held in an in-memory LRU cache. If path is set they are
+    also written to a SQLite database file, so they survive restarts and
+    can be shared between processes.
+    """
+
+    def __init__(self, maxsize=DEFAULT_PERSISTED_QUERIES_SIZE, path=None):
+        self._memory = LRUCache(maxsize)
+        self.path = path
+        self._table_created = False
+
+    def configure(self, maxsize=DEFAULT_PERSISTED_QUERIES_SIZE, path=None):
+        self._memory.resize(maxsize)
+        if path != self.path:
+            self.path = path
+            self._table_created = False
+
+    async def get(self, sha256_hash):
+        query = self._memory.get(sha256_hash)
+        if query is None and self.path:
+            query = await self._in_thread(self._read, sha256_hash)
+            if query is not None:
+                self._memory.set(sha256_hash, query)
+        return query
+
+    async def set(self, sha256_hash, query):
+        assert query_hash(query) == sha256_hash, "Hash does not match query"
+        if sha256_hash in self._memory:
+            return
+        self._memory.set(sha256_hash, query)
+        if self.path:
+            await self._in_thread(self._write, sha256_hash, query)
+
+    def clear(self):
+        self._memory.clear()
+
+    def stats(self):
+        "Hits, misses and size of the in-memory cache"
+        return self._memory.stats()
+
+    async def _in_thread(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        if not self._table_created:
+            with conn:
+                conn.execute(
+                    "create table if not exists persisted_queries "
+                    "(sha256 text primary key, query text)"
+                )
+            self._table_created = True
+        return conn
+
+    def _read(self, sha256_hash):
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "select query from persisted_queries where sha256 = ?",
+                [sha256_hash],
+            ).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def _write(self, sha256_hash, query):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "insert or replace into persisted_queries (sha256, query) values (?, ?)",
+                    [sha256_hash, query],
+                )
+        finally:
+            conn.close()
+
+
+_persisted_queries = PersistedQueryStore()
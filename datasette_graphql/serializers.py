@@ -0,0 +1,34 @@
+from datasette.utils.asgi import Response
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+JSON_CONTENT_TYPE = "application/json; charset=utf-8"
+
+
+def dumps(value):
+    "Encode value as JSON bytes, using orjson if it is installed"
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers larger than 64 bits - the standard library copes
+            pass
+    return json.dumps(value, separators=(",", ":"), default=repr).encode("utf-8")
+
+
+def loads(data):
+    "Decode JSON from bytes or a string, using orjson if it is installed"
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_response(value, status=200, headers=None):
+    "Like Response.json() but with a pre-encoded body"
+    return Response(
+        dumps(value), status=status, headers=headers, content_type=JSON_CONTENT_TYPE
+    )
@@ -0,0 +1,747 @@
+from datasette.database import QueryInterrupted
+from datasette.filters import Filters
+from datasette.plugins import pm
+from datasette.resources import DatabaseResource, TableResource
+from datasette.utils import (
+    compound_keys_after_sql,
+    escape_sqlite,
+    tilde_encode,
+    urlsafe_components,
+)
+from datasette.utils.asgi import Forbidden
+from datasette.utils.sqlite import sqlite_version
+from .advisor import _query_plan_advisor, index_columns
+from .concurrency import QuerySlot
+from .metrics import _metrics
+from .tracing import record_sql
+import base64
+import json
+import math
+import time
+
+
+def filter_pairs(meta, filter):
+    "Turn filter: arguments into Datasette-style column__op=value pairs"
+    pairs = []
+    column_name_rev = {v: k for k, v in meta.graphql_columns.items()}
+    for filter_ in filter or []:
+        for column_name, operations in filter_.items():
+            for operation_name, value in operations.items():
+                if isinstance(value, list):
+                    value = ",".join(map(str, value))
+                pairs.append(
+                    [
+                        "{}__{}".format(
+                            column_name_rev[column_name], operation_name.rstrip("_")
+                        ),
+                        value,
+                    ]
+                )
+    return pairs
+
+
+def filter_plugins_installed():
+    """
+    Do plugins other than Datasette itself add filters to the table view
+    using the filters_from_request hook? The table JSON API applies those
+    filters, but the SQL built by where_clauses_for_arguments() does not.
+    """
+    return any(
+        hookimpl.plugin_name != "datasette.filters"
+        for hookimpl in pm.hook.filters_from_request.get_hookimpls()
+    )
+
+
+async def where_clauses_for_arguments(
+    datasette,
+    db,
+    table,
+    meta,
+    actor,
+    filter=None,
+    where=None,
+    search=None,
+    pairs=None,
+):
+    """
+    Returns (where_clauses, params) for the filter:, where: and search:
+    arguments plus any extra column=value pairs, following the same rules
+    as Datasette's table view
+    """
+    if not await datasette.allowed(
+        action="view-table",
+        resource=TableResource(database=db.name, table=table),
+        actor=actor,
+    ):
+        raise Forbidden("You do not have permission to view this table")
+    # Values are stringified just as they would be in a query string
+    pairs = [
+        (key, str(value)) for key, value in filter_pairs(meta, filter) + (pairs or [])
+    ]
+    where_clauses, params = Filters(sorted(pairs)).build_where_clauses(table)
+    if where:
+        if not await datasette.allowed(
+            action="execute-sql",
+            resource=DatabaseResource(database=db.name),
+            actor=actor,
+        ):
+            raise Forbidden("where: is not allowed")
+        where_clauses.append("({})".format(where))
+    if search and meta.supports_fts:
+        table_config = await datasette.table_config(db.name, table)
+        fts_table = table_config.get("fts_table") or await db.fts_table(table)
+        fts_pk = table_config.get("fts_pk", "rowid")
+        where_clauses.append(
+            "{fts_pk} in (select rowid from {fts_table} where {fts_table} match {match_clause})".format(
+                fts_table=escape_sqlite(fts_table),
+                fts_pk=escape_sqlite(fts_pk),
+                match_clause=(
+                    ":search"
+                    if table_config.get("searchmode") == "raw"
+                    else "escape_fts(:search)"
+                ),
+            )
+        )
+        params["search"] = search
+    return where_clauses, params
+
+
+def uses_rowid(meta):
+    return not meta.is_view and (not meta.pks or meta.pks == ["rowid"])
+
+
+async def sort_column_and_order_by(
+    datasette, db, table, meta, sort=None, sort_desc=None
+):
+    """
+    Returns (sort_column, is_descending, order_by) - sort_column is None if
+    the table is sorted by its primary keys alone
+    """
+    column_name_rev = {v: k for k, v in meta.graphql_columns.items()}
+    table_config = await datasette.table_config(db.name, table)
+    sort = column_name_rev[sort.value] if sort else None
+    sort_desc = column_name_rev[sort_desc.value] if sort_desc else None
+    if not sort and not sort_desc:
+        sort = table_config.get("sort")
+        sort_desc = table_config.get("sort_desc")
+    sort_column = sort or sort_desc
+    if sort_column and (
+        "sortable_columns" in table_config
+        and sort_column not in set(table_config["sortable_columns"])
+    ):
+        assert False, "Cannot sort table by {}".format(sort_column)
+    order_by = order_by_sql(order_terms(meta, sort_column, bool(sort_desc)))
+    return sort_column, bool(sort_desc), order_by
+
+
+def cursor_columns(meta, sort_column=None):
+    "The columns that identify a row's position, in order by order"
+    columns = [sort_column] if sort_column else []
+    if meta.is_view:
+        # Views have no primary keys to use as a tie-breaker
+        pass
+    elif uses_rowid(meta):
+        columns.append("rowid")
+    else:
+        columns.extend(meta.pks)
+    return columns
+
+
+def order_terms(meta, sort_column=None, descending=False):
+    "(column_sql, is_descending) pairs for the order by clause"
+    return [
+        (
+            "rowid" if column == "rowid" else escape_sqlite(column),
+            descending if i == 0 and sort_column else False,
+        )
+        for i, column in enumerate(cursor_columns(meta, sort_column))
+    ]
+
+
+def order_by_sql(terms, reverse=False):
+    return ", ".join(
+        "{}{}".format(column, " desc" if descending != reverse else "")
+        for column, descending in terms
+    )
+
+
+def encode_cursor(values):
+    "Opaque pagination cursor for a row's sort and primary key values"
+    data = json.dumps({"k": values}, separators=(",", ":"), default=_bytes_to_json)
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    "Values from encode_cursor(), or None if this is not one of those cursors"
+    try:
+        data = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)),
+            object_hook=_bytes_from_json,
+        )
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("k"), list):
+        return None
+    return data["k"]
+
+
+def _bytes_to_json(value):
+    if isinstance(value, bytes):
+        return {"$base64": True, "encoded": base64.b64encode(value).decode("ascii")}
+    raise TypeError("Cannot encode {!r} in a cursor".format(value))
+
+
+def _bytes_from_json(data):
+    if data.get("$base64"):
+        return base64.b64decode(data["encoded"])
+    return data
+
+
+def legacy_token_from_cursor(cursor):
+    "Convert a cursor into a Datasette _next token, for the table JSON API"
+    values = decode_cursor(cursor)
+    if values is None:
+        return cursor
+    return ",".join(
+        "$null" if value is None else tilde_encode(str(value)) for value in values
+    )
+
+
+def view_offset(cursor):
+    "The row offset from a cursor for a view, see make_cursor_for()"
+    try:
+        offset = int(cursor)
+    except ValueError:
+        offset = -1
+    if offset < 0:
+        assert False, "Invalid cursor"
+    return offset
+
+
+def make_cursor_for(meta, sort_column=None, offset=0):
+    """
+    Returns a cursor_for(index, row) function, returning the cursor for the
+    index'th node object on a page. Cursors for views are row offsets.
+    """
+    if meta.is_view:
+        return lambda index, row: str(offset + index + 1)
+    attributes = [
+        meta.graphql_columns.get(column, column)
+        for column in cursor_columns(meta, sort_column)
+    ]
+    return lambda index, row: encode_cursor(
+        [getattr(row, attribute) for attribute in attributes]
+    )
+
+
+def keyset_clause(terms, values, params, reverse=False, nullable_sort=False):
+    """
+    Where clause matching rows after the row with these values for the order
+    by terms, or before that row if reverse is True. Uses row values where
+    possible, e.g. (sort_column, id) > (:p0, :p1), so SQLite can seek
+    straight to that row using an index.
+
+    If nullable_sort is True the first term is a sort column that can be
+    null - SQLite sorts nulls before every other value.
+    """
+    if len(values) != len(terms):
+        assert False, "Invalid cursor"
+
+    def param(value):
+        name = "p{}".format(len(params))
+        params[name] = value
+        return ":" + name
+
+    def after(i):
+        column, descending = terms[i]
+        descending = descending != reverse
+        value = values[i]
+        op = "<" if descending else ">"
+        remaining = terms[i:]
+        same_direction = all((d != reverse) == descending for _, d in remaining)
+        can_be_null = nullable_sort and i == 0
+        if value is None and can_be_null:
+            rest = after(i + 1) if i + 1 < len(terms) else "0"
+            if descending:
+                # Nulls come last, so only other nulls can follow
+                return "({column} is null and {rest})".format(column=column, rest=rest)
+            return "({column} is not null or ({column} is null and {rest}))".format(
+                column=column, rest=rest
+            )
+        nulls_follow = (
+            " or {} is null".format(column) if can_be_null and descending else ""
+        )
+        if same_direction and sqlite_version() >= (3, 15, 0):
+            if len(remaining) == 1:
+                comparison = "{} {} {}".format(column, op, param(value))
+            else:
+                comparison = "({}) {} ({})".format(
+                    ", ".join(c for c, _ in remaining),
+                    op,
+                    ", ".join(param(v) for v in values[i:]),
+                )
+            return (
+                "({}{})".format(comparison, nulls_follow)
+                if nulls_follow
+                else comparison
+            )
+        if i + 1 == len(terms):
+            return "{} {} {}".format(column, op, param(value))
+        p = param(value)
+        return (
+            "({column} {op} {p} or ({column} = {p} and {rest}){nulls_follow})".format(
+                column=column, op=op, p=p, rest=after(i + 1), nulls_follow=nulls_follow
+            )
+        )
+
+    return after(0)
+
+
+def select_columns(meta):
+    columns = [escape_sqlite(column) for column in meta.columns]
+    if uses_rowid(meta) and "rowid" not in meta.columns:
+        columns.insert(0, "rowid")
+    return ", ".join(columns)
+
+
+def after_clauses(after, meta, sort_column, descending, params):
+    """
+    Where clauses for the page that starts after a Datasette-style _next
+    token, see table_view_data() in datasette/views/table.py - these were
+    used as cursors by earlier versions of this plugin
+    """
+    components = urlsafe_components(after)
+    sort_value = None
+    # If a sort order is applied and there are multiple components,
+    # the first of these is the sort value
+    if sort_column and len(components) > 1:
+        sort_value = components[0]
+        # Special case for if non-urlencoded first token was $null
+        if after.split(",")[0] == "$null":
+            sort_value = None
+        components = components[1:]
+
+    next_by_pk_clauses = []
+    if uses_rowid(meta):
+        next_by_pk_clauses.append("rowid > :p{}".format(len(params)))
+        params["p{}".format(len(params))] = components[0]
+    elif len(components) == len(meta.pks):
+        param_len = len(params)
+        next_by_pk_clauses.append(compound_keys_after_sql(meta.pks, param_len))
+        for i, pk_value in enumerate(components):
+            params["p{}".format(param_len + i)] = pk_value
+
+    if not sort_column:
+        return next_by_pk_clauses
+    column = escape_sqlite(sort_column)
+    next_clauses = " and ".join(next_by_pk_clauses)
+    if sort_value is None:
+        if descending:
+            # Just items where column is null ordered by pk
+            return ["({} is null and {})".format(column, next_clauses)]
+        return [
+            "({column} is not null or ({column} is null and {next_clauses}))".format(
+                column=column, next_clauses=next_clauses
+            )
+        ]
+    p = "p{}".format(len(params))
+    params[p] = sort_value
+    return [
+        "({column} {op} :{p}{extra_desc_only} or ({column} = :{p} and {next_clauses}))".format(
+            column=column,
+            op="<" if descending else ">",
+            p=p,
+            extra_desc_only=" or {} is null".format(column) if descending else "",
+            next_clauses=next_clauses,
+        )
+    ]
+
+
+async def fetch_table_page(
+    datasette,
+    db,
+    table,
+    meta,
+    context,
+    first,
+    filter=None,
+    where=None,
+    search=None,
+    sort=None,
+    sort_desc=None,
+    after=None,
+    pairs=None,
+    include_rows=True,
+    include_count=True,
+    before=None,
+    last=None,
+):
+    """
+    Execute SQL directly against the database to fetch a page of rows,
+    returning a {"rows", "count", "next", "previous", "cursor_for"}
+    dictionary - the rows or count queries are skipped if include_rows or
+    include_count are False
+
+    Pages start after the after: cursor, or end before the before: cursor
+    if last: is used to paginate backwards.
+    """
+    backwards = last is not None
+    limit = last if backwards else first
+    argument = "last" if backwards else "first"
+    if limit < 0:
+        # SQLite treats a negative limit as no limit at all
+        assert False, "{} must be >= 0".format(argument)
+    if limit > datasette.max_returned_rows:
+        assert False, "{} must be <= {}".format(argument, datasette.max_returned_rows)
+    actor = context.get("actor") if isinstance(context, dict) else None
+    where_clauses, params = await where_clauses_for_arguments(
+        datasette,
+        db,
+        table,
+        meta,
+        actor,
+        filter=filter,
+        where=where,
+        search=search,
+        pairs=pairs,
+    )
+    sort_column, descending, order_by = await sort_column_and_order_by(
+        datasette, db, table, meta, sort=sort, sort_desc=sort_desc
+    )
+    count_where_sql = ""
+    if where_clauses:
+        count_where_sql = " where {}".format(" and ".join(where_clauses))
+    count_sql = "select count(*) from {}{}".format(
+        escape_sqlite(table), count_where_sql
+    )
+    count_params = dict(params)
+
+    offset = 0
+    if meta.is_view:
+        # Views have no primary keys, so their cursors are row offsets
+        if after:
+            offset = view_offset(after)
+        if backwards:
+            if before is None:
+                assert False, "last: requires before: for views"
+            end = max(view_offset(before) - 1 - offset, 0)
+            offset += max(end - limit, 0)
+            limit = min(limit, end)
+    else:
+        terms = order_terms(meta, sort_column, descending)
+        for cursor, reverse in ((after, False), (before, True)):
+            if not cursor:
+                continue
+            values = decode_cursor(cursor)
+            if values is None and not reverse:
+                # A Datasette-style _next token
+                where_clauses.extend(
+                    after_clauses(cursor, meta, sort_column, descending, params)
+                )
+                continue
+            if values is None:
+                assert False, "Invalid cursor"
+            where_clauses.append(
+                keyset_clause(
+                    terms,
+                    values,
+                    params,
+                    reverse=reverse,
+                    nullable_sort=bool(sort_column),
+                )
+            )
+        if backwards:
+            # Fetch the rows closest to the before: cursor, then flip them
+            order_by = order_by_sql(terms, reverse=True)
+
+    sql = "select {columns} from {table}{where}{order_by} limit {limit}{offset}".format(
+        columns=select_columns(meta),
+        table=escape_sqlite(table),
+        where=" where {}".format(" and ".join(where_clauses)) if where_clauses else "",
+        order_by=" order by {}".format(order_by) if order_by else "",
+        limit=limit + 1,
+        offset=" offset {}".format(offset) if offset else "",
+    )
+    if include_rows or include_count:
+        check_limits(context, sql if include_rows else count_sql)
+    all_pairs = filter_pairs(meta, filter) + (pairs or [])
+    index_hint = (table, index_columns(all_pairs, sort_column))
+    rows = []
+    if include_rows:
+        rows = list((await execute_sql(db, sql, params, context, index_hint)).rows)
+
+    count = None
+    if include_count:
+        if (
+            not db.is_mutable
+            and datasette.inspect_data
+            and not count_where_sql
+            and not meta.is_view
+        ):
+            # We can use a previously cached table row count
+            try:
+                count = datasette.inspect_data[db.name]["tables"][table]["count"]
+            except KeyError:
+                pass
+        if count is None:
+            try:
+                count = (
+                    await execute_sql(
+                        db,
+                        count_sql,
+                        count_params,
+                        context,
+                        (table, index_columns(all_pairs)),
+                    )
+                ).single_value()
+            except QueryInterrupted:
+                # Hit sql_time_limit_ms - the count is optional
+                pass
+
+    fetched_more = 0 < limit < len(rows)
+    rows = rows[:limit]
+    if backwards:
+        if not meta.is_view:
+            rows.reverse()
+        has_next = bool(before and rows)
+        has_previous = offset > int(after or 0) if meta.is_view else fetched_more
+    else:
+        has_next = fetched_more
+        has_previous = bool(after and rows)
+
+    cursor_for = make_cursor_for(meta, sort_column, offset)
+    columns = cursor_columns(meta, sort_column)
+
+    def cursor(index):
+        if meta.is_view:
+            return cursor_for(index, rows[index])
+        return encode_cursor([rows[index][column] for column in columns])
+
+    return {
+        "rows": rows,
+        "count": count,
+        "next": cursor(len(rows) - 1) if has_next else None,
+        "previous": cursor(0) if has_previous else None,
+        "cursor_for": cursor_for,
+    }
+
+
+AGGREGATE_FUNCTIONS = ("sum", "avg", "min", "max")
+
+
+def numeric_columns(meta):
+    return [
+        column
+        for column, column_type in meta.columns.items()
+        if column_type in (int, float)
+    ]
+
+
+def aggregate_terms(meta, functions, include_count=True):
+    """
+    Returns [(function, column)] for count(*) plus each of the aggregate
+    functions applied to every numeric column - count(*) has a column of None
+    """
+    terms = [("count", None)] if include_count else []
+    for function in functions:
+        terms.extend((function, column) for column in numeric_columns(meta))
+    return terms
+
+
+def aggregate_select(terms):
+    return ", ".join(
+        "count(*)"
+        if column is None
+        else "{}({})".format(function, escape_sqlite(column))
+        for function, column in terms
+    )
+
+
+def aggregates_from_values(meta, terms, values):
+    "Turn the values selected by aggregate_select(terms) into nested dicts"
+    aggregates = {}
+    for (function, column), value in zip(terms, values):
+        if column is None:
+            aggregates["count"] = value
+        else:
+            aggregates.setdefault(function, {})[meta.graphql_columns[column]] = value
+    return aggregates
+
+
+async def fetch_aggregates(
+    datasette,
+    db,
+    table,
+    meta,
+    context,
+    functions,
+    include_count=True,
+    filter=None,
+    where=None,
+    search=None,
+    pairs=None,
+):
+    """
+    Compute count(*) and the sum, avg, min or max functions for every numeric
+    column over the rows matching the arguments, using a single SQL query.
+    Returns {"count": 3, "sum": {"column": 1.5}} style dictionaries.
+    """
+    terms = aggregate_terms(meta, functions, include_count)
+    if not terms:
+        return {}
+    actor = context.get("actor") if isinstance(context, dict) else None
+    where_clauses, params = await where_clauses_for_arguments(
+        datasette,
+        db,
+        table,
+        meta,
+        actor,
+        filter=filter,
+        where=where,
+        search=search,
+        pairs=pairs,
+    )
+    sql = "select {} from {}{}".format(
+        aggregate_select(terms),
+        escape_sqlite(table),
+        " where {}".format(" and ".join(where_clauses)) if where_clauses else "",
+    )
+    check_limits(context, sql)
+    all_pairs = filter_pairs(meta, filter) + (pairs or [])
+    results = await execute_sql(
+        db, sql, params, context, (table, index_columns(all_pairs))
+    )
+    return aggregates_from_values(meta, terms, results.first())
+
+
+async def fetch_groups(
+    datasette,
+    db,
+    table,
+    meta,
+    context,
+    column,
+    first,
+    filter=None,
+    where=None,
+    search=None,
+    pairs=None,
+):
+    """
+    Count the rows matching the arguments for each distinct value of column,
+    returning up to first [{"value", "count"}] dictionaries with the largest
+    counts first
+    """
+    if first < 0:
+        assert False, "first must be >= 0"
+    if first > datasette.max_returned_rows:
+        assert False, "first must be <= {}".format(datasette.max_returned_rows)
+    actor = context.get("actor") if isinstance(context, dict) else None
+    where_clauses, params = await where_clauses_for_arguments(
+        datasette,
+        db,
+        table,
+        meta,
+        actor,
+        filter=filter,
+        where=where,
+        search=search,
+        pairs=pairs,
+    )
+    escaped = escape_sqlite(column)
+    sql = (
+        "select {column}, count(*) from {table}{where} group by {column} "
+        "order by count(*) desc, {column} limit {limit}"
+    ).format(
+        column=escaped,
+        table=escape_sqlite(table),
+        where=" where {}".format(" and ".join(where_clauses)) if where_clauses else "",
+        limit=first,
+    )
+    check_limits(context, sql)
+    all_pairs = filter_pairs(meta, filter) + (pairs or [])
+    results = await execute_sql(
+        db, sql, params, context, (table, index_columns(all_pairs, column))
+    )
+    return [{"value": row[0], "count": row[1]} for row in results.rows]
+
+
+def time_remaining_ms(context):
+    "Milliseconds left before the time_limit_ms deadline, or None for no limit"
+    if not context or not context.get("time_limit_ms"):
+        return None
+    elapsed_ms = (time.monotonic() - context["time_started"]) * 1000
+    return context["time_limit_ms"] - elapsed_ms
+
+
+async def execute_sql(db, sql, params, context, index_hint=None):
+    """
+    Execute SQL with a time limit of whatever is left of the time_limit_ms
+    budget for this GraphQL request, so a slow query is interrupted as soon
+    as the budget runs out rather than after it has finished.
+
+    QueryInterrupted is raised as before if Datasette's own sql_time_limit_ms
+    was the tighter of the two limits.
+
+    The query waits for a slot from the max_concurrent_queries and
+    max_concurrent_queries_per_request limits before it starts.
+
+    If the query_plan_advisor is enabled the query is recorded along with
+    index_hint, a (table, columns) tuple for the index that could serve it.
+    """
+    async with QuerySlot(context):
+        remaining_ms = time_remaining_ms(context)
+        custom_time_limit = None
+        if remaining_ms is not None:
+            # Datasette treats 0 as no custom time limit
+            custom_time_limit = max(math.ceil(remaining_ms), 1)
+        start = time.perf_counter_ns()
+        try:
+            results = await db.execute(sql, params, custom_time_limit=custom_time_limit)
+        except QueryInterrupted:
+            if custom_time_limit is not None and (
+                custom_time_limit < db.ds.sql_time_limit_ms
+            ):
+                elapsed_ms = (time.monotonic() - context["time_started"]) * 1000
+                _metrics.limit_exceeded.inc("time_limit_ms")
+                assert False, "Time limit exceeded: {:.2f}ms > {}ms - {}".format(
+                    elapsed_ms, context["time_limit_ms"], sql
+                )
+            raise
+        end = time.perf_counter_ns()
+    count_sql_statement(context)
+    _metrics.rows.inc(db.name, amount=len(results.rows))
+    record_sql(sql, start, end)
+    if context and context.get("query_plan_advisor"):
+        await _query_plan_advisor.record(
+            db, sql, params, (end - start) / 1000000, index_hint
+        )
+    return results
+
+
+def count_sql_statement(context):
+    "Count a statement towards the sql_statements metric for this request"
+    if context and "num_sql_statements" in context:
+        context["num_sql_statements"] += 1
+
+
+def check_limits(context, description):
+    "Enforce the time_limit_ms and num_queries_limit execution limits"
+    if context and "time_started" in context:
+        elapsed_ms = (time.monotonic() - context["time_started"]) * 1000
+        if context["time_limit_ms"] and elapsed_ms > context["time_limit_ms"]:
+            _metrics.limit_exceeded.inc("time_limit_ms")
+            assert False, "Time limit exceeded: {:.2f}ms > {}ms - {}".format(
+                elapsed_ms, context["time_limit_ms"], description
+            )
+        context["num_queries_executed"] += 1
+        if (
+            context["num_queries_limit"]
+            and context["num_queries_executed"] > context["num_queries_limit"]
+        ):
+            _metrics.limit_exceeded.inc("num_queries_limit")
+            assert False, "Query limit exceeded: {} > {} - {}".format(
+                context["num_queries_executed"],
+                context["num_queries_limit"],
+                description,
+            )
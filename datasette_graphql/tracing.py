@@ -0,0 +1,106 @@
+from contextvars import ContextVar
+import datetime
+import inspect
+import time
+
+TRACING_HEADER = "x-graphql-tracing"
+
+# (Tracer, resolver entry or None) for the operation being executed
+_current_trace = ContextVar("datasette_graphql_trace", default=None)
+
+
+def _iso(dt):
+    return dt.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+class Tracer:
+    """
+    Collects timings for one operation in the Apollo tracing format:
+    https://github.com/apollographql/apollo-tracing
+
+    Each resolver entry also lists the SQL statements it executed, with
+    statements run by a DataLoader credited to the resolver that
+    triggered the batch.
+    """
+
+    def __init__(self):
+        self.start_time = datetime.datetime.now(datetime.timezone.utc)
+        self.start = time.perf_counter_ns()
+        self.parsing = None
+        self.validation = None
+        self.resolvers = []
+        # SQL executed outside of any resolver
+        self.sql = []
+
+    def offset(self, ns=None):
+        return (ns if ns is not None else time.perf_counter_ns()) - self.start
+
+    def timing(self, start_ns, end_ns):
+        return {"startOffset": self.offset(start_ns), "duration": end_ns - start_ns}
+
+    def record_sql(self, entry, sql, start_ns, end_ns):
+        statements = self.sql if entry is None else entry.setdefault("sql", [])
+        statements.append(dict(self.timing(start_ns, end_ns), sql=sql))
+
+    def to_dict(self):
+        end = time.perf_counter_ns()
+        tracing = {
+            "version": 1,
+            "startTime": _iso(self.start_time),
+            "endTime": _iso(
+                self.start_time
+                + datetime.timedelta(microseconds=(end - self.start) // 1000)
+            ),
+            "duration": end - self.start,
+            "parsing": self.parsing or {"startOffset": 0, "duration": 0},
+            "validation": self.validation or {"startOffset": 0, "duration": 0},
+            "execution": {"resolvers": self.resolvers},
+        }
+        if self.sql:
+            tracing["sql"] = self.sql
+        return tracing
+
+
+class TracingMiddleware:
+    "graphql-core middleware that times every resolver for a Tracer"
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def resolve(self, next_, root, info, **args):
+        entry = {
+            "path": info.path.as_list(),
+            "parentType": info.parent_type.name,
+            "fieldName": info.field_name,
+            "returnType": str(info.return_type),
+        }
+        self.tracer.resolvers.append(entry)
+        start = time.perf_counter_ns()
+        token = _current_trace.set((self.tracer, entry))
+        try:
+            result = next_(root, info, **args)
+        except Exception:
+            entry.update(self.tracer.timing(start, time.perf_counter_ns()))
+            raise
+        finally:
+            _current_trace.reset(token)
+        if inspect.isawaitable(result):
+            return self.await_result(result, entry, start)
+        entry.update(self.tracer.timing(start, time.perf_counter_ns()))
+        return result
+
+    async def await_result(self, result, entry, start):
+        token = _current_trace.set((self.tracer, entry))
+        try:
+            return await result
+        finally:
+            _current_trace.reset(token)
+            entry.update(self.tracer.timing(start, time.perf_counter_ns()))
+
+
+def record_sql(sql, start_ns, end_ns):
+    "Credit a SQL statement to the resolver being traced, if there is one"
+    current = _current_trace.get()
+    if current is not None:
+        tracer, entry = current
+        tracer.record_sql(entry, sql, start_ns, end_ns)
@@ -3,10 +3,48 @@ from collections import namedtuple
 from datasette.utils import await_me_maybe
 from datasette.plugins import pm
 from enum import Enum
+from datasette.utils.sqlite import sqlite_version
+from .cache import LRUCache
+from .concurrency import QuerySlot
+from .execution import _document_cache
+from .loaders import (
+    get_loader,
+    make_fk_loader,
+    make_related_aggregates_loader,
+    make_related_rows_loader,
+)
+from .incremental import GraphQLDeferDirective, GraphQLStreamDirective
+from .metrics import _metrics
+from .sql import (
+    AGGREGATE_FUNCTIONS,
+    check_limits,
+    count_sql_statement,
+    cursor_columns,
+    encode_cursor,
+    fetch_aggregates,
+    fetch_groups,
+    fetch_table_page,
+    filter_pairs,
+    filter_plugins_installed,
+    legacy_token_from_cursor,
+    make_cursor_for,
+    numeric_columns,
+    sort_column_and_order_by,
+    time_remaining_ms,
+    view_offset,
+)
 import graphene
 from graphene.types import generic
+from graphql import get_named_type, specified_directives
+from graphql.execution.collect_fields import collect_sub_fields
+import asyncio
+import functools
+import hashlib
 import json
 import keyword
+import math
+import os
+import pathlib
 import urllib
 import re
 import sqlite_utils
@@ -60,36 +98,132 @@ types = {
 class PageInfo(graphene.ObjectType):
     endCursor = graphene.String()
     hasNextPage = graphene.Boolean()
+    startCursor = graphene.String()
+    hasPreviousPage = graphene.Boolean()
+
+
+class ClassLookup:
+    """
+    Finds the node or collection class for a table, in the dictionary of
+    classes for the schema that a node class belongs to
+    """
+
+    def __init__(self, classes):
+        self.classes = classes
+        self.previous = None
+
+    def __getitem__(self, table):
+        return self.classes[table]
 
 
 class DatabaseSchema:
-    def __init__(self, schema, table_classes, table_collection_classes):
+    def __init__(
+        self,
+        schema,
+        table_classes,
+        table_collection_classes,
+        datasette=None,
+        db=None,
+        fingerprints=None,
+        table_filters=None,
+        table_collection_kwargs=None,
+    ):
         self.schema = schema
         self.table_classes = table_classes
         self.table_collection_classes = table_collection_classes
+        # Used to reuse types for unchanged tables when the schema changes
+        self.datasette = datasette
+        self.db = db
+        self.fingerprints = fingerprints or {}
+        self.table_filters = table_filters or {}
+        self.table_collection_kwargs = table_collection_kwargs or {}
+
 
+DEFAULT_SCHEMA_CACHE_SIZE = 100
 
 # cache keys are (database, schema_version) tuples
-_schema_cache = {}
+_schema_cache = LRUCache(DEFAULT_SCHEMA_CACHE_SIZE)
+# In-progress schema builds, so concurrent requests share a single build
+_schema_builds = {}
+# database -> (time checked, schema_version)
+_schema_versions = {}
+
+
+async def schema_version_for_database(datasette, db):
+    """
+    Returns PRAGMA schema_version, checking it at most once every
+    schema_version_check_ms milliseconds - or only once for immutable
+    databases, since their schema cannot change
+    """
+    config = datasette.plugin_config("datasette-graphql") or {}
+    check_ms = config.get("schema_version_check_ms") or 0
+    previous = _schema_versions.get(db.name)
+    if previous is not None:
+        checked_at, schema_version = previous
+        if not db.is_mutable or (
+            check_ms and (time.monotonic() - checked_at) * 1000 < check_ms
+        ):
+            return schema_version
+    schema_version = (await db.execute("PRAGMA schema_version")).first()[0]
+    _schema_versions[db.name] = (time.monotonic(), schema_version)
+    return schema_version
 
 
 async def schema_for_database_via_cache(datasette, database=None):
     db = datasette.get_database(database)
-    schema_version = (await db.execute("PRAGMA schema_version")).first()[0]
-    cache_key = (database, schema_version)
-    if cache_key not in _schema_cache:
-        schema = await schema_for_database(datasette, database)
-        _schema_cache[cache_key] = schema
-        # Delete other cached versions of this database
-        to_delete = [
-            key for key in _schema_cache if key[0] == database and key != cache_key
-        ]
-        for key in to_delete:
-            del _schema_cache[key]
-    return _schema_cache[cache_key]
-
-
-async def schema_for_database(datasette, database=None):
+    schema_version = await schema_version_for_database(datasette, db)
+    cache_key = (db.name, schema_version)
+    schema = _schema_cache.get(cache_key)
+    if schema is not None:
+        _metrics.schema_cache.inc(db.name, "hit")
+        return schema
+    _metrics.schema_cache.inc(db.name, "miss")
+    build = _schema_builds.get(cache_key)
+    if build is None:
+        build = asyncio.ensure_future(
+            _build_and_cache_schema(datasette, database, cache_key)
+        )
+        _schema_builds[cache_key] = build
+        build.add_done_callback(lambda _: _schema_builds.pop(cache_key, None))
+    # shield() so one cancelled request does not cancel everyone else's build
+    return await asyncio.shield(build)
+
+
+async def _build_and_cache_schema(datasette, database, cache_key):
+    previous = None
+    for key in _schema_cache.keys():
+        if key[0] == cache_key[0]:
+            previous = _schema_cache.peek(key)
+    start = time.perf_counter()
+    schema = await schema_for_database(datasette, database, previous=previous)
+    _metrics.schema_build_duration.observe(time.perf_counter() - start, cache_key[0])
+    _schema_cache.set(cache_key, schema)
+    # Delete other cached versions of this database
+    for key in _schema_cache.keys():
+        if key[0] == cache_key[0] and key != cache_key:
+            # Documents validated against the old schema are no longer needed
+            old_schema = _schema_cache.pop(key).schema
+            _document_cache.remove_where(lambda doc_key: doc_key[0] is old_schema)
+    return schema
+
+
+def table_fingerprint(datasette, db_name, table, meta, table_config, is_hidden):
+    "Everything that affects the graphene types generated for a table"
+    return (
+        meta,
+        table_config,
+        datasette.plugin_config("datasette-graphql", database=db_name, table=table),
+        is_hidden,
+    )
+
+
+async def schema_for_database(datasette, database=None, previous=None):
+    """
+    Build the DatabaseSchema for a database. If previous is the schema
+    from before a change, types for tables that have not changed - and are
+    not connected to a changed table by foreign keys - are reused from it.
+    previous itself is not modified.
+    """
     db = datasette.get_database(database)
     hidden_tables = await db.hidden_table_names()
 
@@ -103,19 +237,80 @@ async def schema_for_database(datasette, database=None):
         )
 
     # Perform all introspection in a single call to the execute_fn thread
-    table_metadata = await db.execute_fn(
-        lambda conn: introspect_tables(conn, datasette, db.name, table_configs)
+    cache_dir = (datasette.plugin_config("datasette-graphql") or {}).get(
+        "introspection_cache_dir"
     )
+    if cache_dir and db.path:
+        table_metadata = await db.execute_fn(
+            lambda conn: introspect_tables_via_cache(
+                conn, datasette, db.name, table_configs, cache_dir, db.path
+            )
+        )
+    else:
+        table_metadata = await db.execute_fn(
+            lambda conn: introspect_tables(conn, datasette, db.name, table_configs)
+        )
+
+    fingerprints = {
+        table: table_fingerprint(
+            datasette,
+            db.name,
+            table,
+            meta,
+            table_configs.get(table),
+            table in hidden_tables,
+        )
+        for table, meta in table_metadata.items()
+    }
+    if previous is None or previous.datasette is not datasette or previous.db is not db:
+        previous = DatabaseSchema(None, {}, {})
+    unchanged = {
+        table
+        for table, fingerprint in fingerprints.items()
+        if previous.fingerprints.get(table) == fingerprint
+    }
+    # Node classes refer to the classes, filters and arguments of the tables
+    # they are linked to. A node class can only be shared with the previous
+    # schema if every class it can reach is shared too, so a change to one
+    # table rebuilds every table connected to it by foreign keys - including
+    # the tables that were linked to a table that has been dropped
+    linked = {
+        table: {fk.other_table for fk in meta.foreign_keys}
+        | {fk.table for fk in meta.fks_back}
+        for table, meta in table_metadata.items()
+    }
+    to_rebuild = set(table_metadata) - unchanged
+    to_rebuild.update(
+        table
+        for table, others in linked.items()
+        if any(other not in unchanged for other in others)
+    )
+    pending = list(to_rebuild)
+    while pending:
+        for other in linked.get(pending.pop(), ()):
+            if other in table_metadata and other not in to_rebuild:
+                to_rebuild.add(other)
+                pending.append(other)
 
     # Construct the tableFilter classes
     table_filters = {
-        table: make_table_filter_class(table, meta)
+        table: (
+            previous.table_filters[table]
+            if table in unchanged
+            else make_table_filter_class(table, meta)
+        )
         for table, meta in table_metadata.items()
     }
     # And the table_collection_kwargs
-    table_collection_kwargs = {}
+    table_collection_kwargs = {
+        table: previous.table_collection_kwargs[table]
+        for table in unchanged
+        if table in previous.table_collection_kwargs
+    }
 
     for table, meta in table_metadata.items():
+        if table in table_collection_kwargs:
+            continue
         column_names = meta.graphql_columns.values()
         options = list(zip(column_names, column_names))
         sort_enum = graphene.Enum.from_enum(
@@ -136,7 +331,13 @@ async def schema_for_database(datasette, database=None):
             ),
             first=graphene.Int(description="Number of results to return"),
             after=graphene.String(
-                description="Start at this pagination cursor (from tableInfo { endCursor })"
+                description="Start at this pagination cursor (from pageInfo { endCursor })"
+            ),
+            last=graphene.Int(
+                description="Number of results to return, counting back from before:"
+            ),
+            before=graphene.String(
+                description="End at this pagination cursor (from pageInfo { startCursor })"
             ),
             sort=sort_enum(),
             sort_desc=sort_desc_enum(),
@@ -147,32 +348,39 @@ async def schema_for_database(datasette, database=None):
 
     # For each table, expose a graphene.List
     to_add = []
+    # Each schema has its own dictionaries, so a schema that is still being
+    # used to execute queries never sees the classes of a newer one
     table_classes = {}
     table_collection_classes = {}
+    reused = []
 
     for table, meta in table_metadata.items():
         table_name = meta.graphql_name
         if table in hidden_tables:
             continue
 
-        # (columns, foreign_keys, fks_back, pks, supports_fts) = table_meta
-        table_node_class = await make_table_node_class(
-            datasette,
-            db,
-            table,
-            table_classes,
-            table_filters,
-            table_metadata,
-            table_collection_classes,
-            table_collection_kwargs,
-        )
+        if table in to_rebuild or table not in previous.table_classes:
+            # (columns, foreign_keys, fks_back, pks, supports_fts) = table_meta
+            table_node_class = await make_table_node_class(
+                datasette,
+                db,
+                table,
+                table_classes,
+                table_filters,
+                table_metadata,
+                table_collection_classes,
+                table_collection_kwargs,
+            )
+            # We also need a table collection class - this is the thing with the
+            # nodes, edges, pageInfo and totalCount fields for that table
+            table_collection_class = make_table_collection_class(
+                datasette, db, table, table_node_class, meta
+            )
+        else:
+            table_node_class = previous.table_classes[table]
+            table_collection_class = previous.table_collection_classes[table]
+            reused.append(table_node_class)
         table_classes[table] = table_node_class
-
-        # We also need a table collection class - this is the thing with the
-        # nodes, edges, pageInfo and totalCount fields for that table
-        table_collection_class = make_table_collection_class(
-            table, table_node_class, meta
-        )
         table_collection_classes[table] = table_collection_class
         to_add.append(
             (
@@ -249,21 +457,44 @@ async def schema_for_database(datasette, database=None):
         (graphene.ObjectType,),
         {key: value for key, value in to_add},
     )
-    database_schema = DatabaseSchema(
-        schema=graphene.Schema(
+    # Reused classes only link to other reused classes, which are the same in
+    # both schemas - pointing them at the new dictionaries lets the previous
+    # schema's dictionaries be garbage collected along with it
+    for table_node_class in reused:
+        for lookup, classes in zip(
+            table_node_class.class_lookups, (table_classes, table_collection_classes)
+        ):
+            lookup.previous, lookup.classes = lookup.classes, classes
+    try:
+        schema = graphene.Schema(
             query=Query,
+            directives=list(specified_directives)
+            + [GraphQLDeferDirective, GraphQLStreamDirective],
             auto_camelcase=(datasette.plugin_config("datasette-graphql") or {}).get(
                 "auto_camelcase", False
             ),
-        ),
+        )
+    except Exception:
+        for table_node_class in reused:
+            for lookup in table_node_class.class_lookups:
+                lookup.classes = lookup.previous
+        raise
+    database_schema = DatabaseSchema(
+        schema=schema,
         table_classes=table_classes,
         table_collection_classes=table_collection_classes,
+        datasette=datasette,
+        db=db,
+        fingerprints=fingerprints,
+        table_filters=table_filters,
+        table_collection_kwargs=table_collection_kwargs,
     )
     return database_schema
 
 
-def make_table_collection_class(table, table_class, meta):
+def make_table_collection_class(datasette, db, table, table_class, meta):
     table_name = meta.graphql_name
+    aggregate_class = make_table_aggregate_class(datasette, db, table, meta)
 
     class _Edge(graphene.ObjectType):
         cursor = graphene.String()
@@ -277,6 +508,9 @@ def make_table_collection_class(table, table_class, meta):
         pageInfo = graphene.Field(PageInfo)
         nodes = graphene.List(table_class)
         edges = graphene.List(_Edge)
+        aggregate = graphene.Field(
+            aggregate_class, description="Aggregates calculated over every row"
+        )
 
         def resolve_totalCount(parent, info):
             return parent["count"]
@@ -285,26 +519,147 @@ def make_table_collection_class(table, table_class, meta):
             return parent["rows"]
 
         def resolve_edges(parent, info):
+            cursor_for = parent.get("cursor_for")
             return [
                 {
-                    "cursor": path_from_row_pks(row, meta.pks, use_rowid=not meta.pks),
+                    "cursor": cursor_for(i, row)
+                    if cursor_for
+                    else path_from_row_pks(row, meta.pks, use_rowid=not meta.pks),
                     "node": row,
                 }
-                for row in parent["rows"]
+                for i, row in enumerate(parent["rows"])
             ]
 
         def resolve_pageInfo(parent, info):
             return {
                 "endCursor": parent["next"],
                 "hasNextPage": parent["next"] is not None,
+                "startCursor": parent.get("previous"),
+                "hasPreviousPage": parent.get("previous") is not None,
             }
 
+        async def resolve_aggregate(parent, info):
+            if filter_plugins_installed():
+                assert (
+                    False
+                ), "aggregate is not available while plugins add table filters"
+            arguments = parent["aggregate_arguments"]
+            fields = selected_field_names(info)
+            functions = [f for f in AGGREGATE_FUNCTIONS if f in fields]
+            include_count = "count" in fields
+            related_fk = arguments["related_fk"]
+            if related_fk:
+                # Aggregate the related rows for every parent at once
+                key_arguments = json.dumps(
+                    [
+                        functions,
+                        include_count,
+                        arguments["filter"],
+                        arguments["where"],
+                        arguments["search"],
+                    ],
+                    default=str,
+                )
+                loader = get_loader(
+                    info,
+                    ("aggregate", db.name, table, related_fk.column, key_arguments),
+                    lambda: make_related_aggregates_loader(
+                        datasette,
+                        db,
+                        table,
+                        meta,
+                        related_fk,
+                        info.context,
+                        functions,
+                        include_count=include_count,
+                        filter=arguments["filter"],
+                        where=arguments["where"],
+                        search=arguments["search"],
+                    ),
+                )
+                aggregates = await loader.load(arguments["related_key"])
+            else:
+                aggregates = await fetch_aggregates(
+                    datasette,
+                    db,
+                    table,
+                    meta,
+                    info.context,
+                    functions,
+                    include_count=include_count,
+                    filter=arguments["filter"],
+                    where=arguments["where"],
+                    search=arguments["search"],
+                    pairs=arguments["pairs"],
+                )
+            return dict(aggregates, aggregate_arguments=arguments)
+
         class Meta:
             name = "{}Collection".format(table_name)
 
     return _TableCollection
 
 
+def make_table_aggregate_class(datasette, db, table, meta):
+    table_name = meta.graphql_name
+    column_names = list(meta.graphql_columns.values())
+    column_name_rev = {v: k for k, v in meta.graphql_columns.items()}
+    column_enum = graphene.Enum.from_enum(
+        Enum("{}Column".format(table_name), list(zip(column_names, column_names))),
+        description="A column of the {} table".format(table),
+    )
+
+    class _Group(graphene.ObjectType):
+        value = generic.GenericScalar()
+        count = graphene.Int()
+
+        class Meta:
+            name = "{}Group".format(table_name)
+
+    aggregate_dict = {
+        "count": graphene.Int(description="Number of rows"),
+        "groupBy": graphene.List(
+            _Group,
+            column=graphene.Argument(column_enum, required=True),
+            first=graphene.Int(description="Number of groups to return"),
+            description="Number of rows for each value of column, largest first",
+        ),
+    }
+    numeric = numeric_columns(meta)
+    if numeric:
+        values_class = type(
+            "{}AggregateValues".format(table_name),
+            (graphene.ObjectType,),
+            {meta.graphql_columns[column]: graphene.Float() for column in numeric},
+        )
+        for function in AGGREGATE_FUNCTIONS:
+            aggregate_dict[function] = graphene.Field(
+                values_class,
+                description="{}() of each numeric column".format(function),
+            )
+
+    async def resolve_groupBy(parent, info, column, first=None):
+        arguments = parent["aggregate_arguments"]
+        return await fetch_groups(
+            datasette,
+            db,
+            table,
+            meta,
+            info.context,
+            column_name_rev[column.value],
+            10 if first is None else first,
+            filter=arguments["filter"],
+            where=arguments["where"],
+            search=arguments["search"],
+            pairs=arguments["pairs"],
+        )
+
+    aggregate_dict["resolve_groupBy"] = resolve_groupBy
+    return type(
+        "{}Aggregate".format(table_name), (graphene.ObjectType,), aggregate_dict
+    )
+
+
 class StringOperations(graphene.InputObjectType):
     exact = graphene.String(name="eq", description="Exact match")
     not_ = graphene.String(name="not", description="Not exact match")
@@ -376,6 +731,10 @@ async def make_table_node_class(
 ):
     meta = table_metadata[table]
     fks_by_column = {fk.column: fk for fk in meta.foreign_keys}
+    # Used in place of the dictionaries, so the class can be reused by a
+    # later schema with dictionaries of its own
+    table_classes = ClassLookup(table_classes)
+    table_collection_classes = ClassLookup(table_collection_classes)
 
     table_plugin_config = datasette.plugin_config(
         "datasette-graphql", database=db.name, table=table
@@ -390,6 +749,7 @@ async def make_table_node_class(
     table_dict = {}
     if meta.pks == ["rowid"]:
         table_dict["rowid"] = graphene.Int()
+        table_dict["resolve_rowid"] = make_column_resolver("rowid")
         plain_columns.append("rowid")
 
     columns_to_graphql_names = {}
@@ -404,7 +764,11 @@ async def make_table_node_class(
                 make_table_getter(table_classes, fk.other_table)
             )
             table_dict["resolve_{}".format(graphql_name)] = make_fk_resolver(
-                db, table, table_classes, fk
+                db,
+                graphql_name,
+                table_classes,
+                fk,
+                other_meta=table_metadata.get(fk.other_table),
             )
         else:
             plain_columns.append(graphql_name)
@@ -413,6 +777,9 @@ async def make_table_node_class(
                 table_dict["resolve_{}".format(graphql_name)] = resolve_generic
             else:
                 table_dict[graphql_name] = types[coltype]
+                table_dict["resolve_{}".format(graphql_name)] = make_column_resolver(
+                    graphql_name
+                )
 
     # Now add the backwards foreign key fields for related items
     fk_table_counts = {}
@@ -445,11 +812,8 @@ async def make_table_node_class(
             related_fk=fk,
         )
 
-    table_dict["from_row"] = classmethod(
-        lambda cls, row: cls(
-            **dict([(meta.graphql_columns.get(k, k), v) for k, v in dict(row).items()])
-        )
-    )
+    table_dict["from_row"] = classmethod(make_from_row(meta))
+    table_dict["class_lookups"] = (table_classes, table_collection_classes)
 
     table_dict["graphql_name_for_column"] = columns_to_graphql_names.get
 
@@ -501,6 +865,46 @@ async def make_table_node_class(
     return type(meta.graphql_name, (graphene.ObjectType,), table_dict)
 
 
+def make_from_row(meta):
+    """
+    Returns a from_row(cls, row) function for a table node class. Rather than
+    instantiating the graphene ObjectType for every row it returns compact
+    __slots__ objects, which the default resolvers read using getattr().
+    """
+    names = list(meta.graphql_columns.values())
+    if "rowid" not in names:
+        names.append("rowid")
+    row_class = type("{}Row".format(meta.graphql_name), (), {"__slots__": names})
+    # Attribute names for each tuple of column names seen so far
+    names_for_keys = {}
+
+    def from_row(cls, row):
+        if isinstance(row, dict):
+            keys, values = tuple(row), row.values()
+        else:
+            keys, values = tuple(row.keys()), row
+        try:
+            attributes = names_for_keys[keys]
+        except KeyError:
+            attributes = names_for_keys[keys] = [
+                meta.graphql_columns.get(key, key) for key in keys
+            ]
+        obj = row_class()
+        for attribute, value in zip(attributes, values):
+            setattr(obj, attribute, value)
+        return obj
+
+    return from_row
+
+
+def make_column_resolver(name):
+    # Cheaper than graphene's default resolver, which also handles dicts
+    def resolve(root, info):
+        return getattr(root, name, None)
+
+    return resolve
+
+
 def make_table_resolver(
     datasette,
     database_name,
@@ -512,6 +916,18 @@ def make_table_resolver(
     return_first_row=False,
 ):
     meta = table_metadata[table_name]
+    config = datasette.plugin_config("datasette-graphql") or {}
+    # The table JSON API is the only way to apply filters added by plugins
+    direct_sql = config.get("direct_sql", True) and not filter_plugins_installed()
+    # The JSON API returns these as strings or {"$base64": true, "encoded": ...}
+    blob_columns = [
+        column for column, column_type in meta.columns.items() if column_type is bytes
+    ]
+    related_other_column = None
+    if related_fk:
+        related_other_column = table_metadata[
+            related_fk.other_table
+        ].graphql_columns.get(related_fk.other_column, related_fk.other_column)
 
     async def resolve_table(
         root,
@@ -523,92 +939,132 @@ def make_table_resolver(
         search=None,
         sort=None,
         sort_desc=None,
+        last=None,
+        before=None,
         **kwargs
     ):
+        if first is not None and last is not None:
+            assert False, "Use first: or last: but not both"
         if first is None:
             first = 10
 
         if return_first_row:
             first = 1
 
-        pairs = []
-        column_name_rev = {v: k for k, v in meta.graphql_columns.items()}
-        for filter_ in filter or []:
-            for column_name, operations in filter_.items():
-                for operation_name, value in operations.items():
-                    if isinstance(value, list):
-                        value = ",".join(map(str, value))
-                    pairs.append(
-                        [
-                            "{}__{}".format(
-                                column_name_rev[column_name], operation_name.rstrip("_")
-                            ),
-                            value,
-                        ]
-                    )
+        db = datasette.get_database(database_name)
+        klass = table_classes[table_name]
 
+        if return_first_row:
+            include_rows, include_count = True, False
+        else:
+            fields = selected_field_names(info)
+            include_rows = bool(fields & {"nodes", "edges", "pageInfo"})
+            include_count = "totalCount" in fields
+
+        # Primary key arguments and the related foreign key are exact matches
+        pairs = []
         if pk_args is not None:
             for pk in pk_args:
-                if kwargs.get(pk) is not None:
-                    pairs.append([pk, kwargs[pk]])
+                value = kwargs.get(meta.graphql_columns.get(pk, pk))
+                if value is not None:
+                    pairs.append(["{}__exact".format(pk), value])
+        if related_fk:
+            pairs.append(
+                [
+                    "{}__exact".format(related_fk.column),
+                    getattr(root, related_other_column),
+                ]
+            )
 
-        qs = {
-            "_nofacet": 1,
-            "_extra": "columns,count",
+        # Used by the aggregate field to select the same rows
+        aggregate_arguments = {
+            "filter": filter,
+            "where": where,
+            "search": search,
+            "pairs": pairs,
+            "related_fk": related_fk,
+            "related_key": getattr(root, related_other_column) if related_fk else None,
         }
-        qs.update(pairs)
-        if after:
-            qs["_next"] = after
-        qs["_size"] = first
-
-        if search and meta.supports_fts:
-            qs["_search"] = search
+        if not (include_rows or include_count or return_first_row):
+            # Only aggregate or __typename were selected
+            return {
+                "rows": [],
+                "count": None,
+                "next": None,
+                "previous": None,
+                "aggregate_arguments": aggregate_arguments,
+            }
 
-        if related_fk:
-            related_column = meta.graphql_columns.get(
-                related_fk.column, related_fk.column
+        if (
+            direct_sql
+            and related_fk
+            and not (after or before or last is not None)
+            and sqlite_version() >= (3, 25, 0)
+        ):
+            # Fetch the related rows for every parent in the page at once
+            arguments = json.dumps(
+                [
+                    first,
+                    filter,
+                    where,
+                    search,
+                    sort,
+                    sort_desc,
+                    include_rows,
+                    include_count,
+                ],
+                default=str,
             )
-            related_other_column = table_metadata[
-                related_fk.other_table
-            ].graphql_columns.get(related_fk.other_column, related_fk.other_column)
-            qs[related_column] = getattr(root, related_other_column)
-
-        if where:
-            qs["_where"] = where
-        if sort:
-            qs["_sort"] = column_name_rev[sort.value]
-        elif sort_desc:
-            qs["_sort_desc"] = column_name_rev[sort_desc.value]
+            loader = get_loader(
+                info,
+                ("related", database_name, table_name, related_fk.column, arguments),
+                lambda: make_related_rows_loader(
+                    datasette,
+                    db,
+                    table_name,
+                    meta,
+                    related_fk,
+                    klass.from_row,
+                    info.context,
+                    first,
+                    filter=filter,
+                    where=where,
+                    search=search,
+                    sort=sort,
+                    sort_desc=sort_desc,
+                    include_rows=include_rows,
+                    include_count=include_count,
+                ),
+            )
+            data = dict(await loader.load(getattr(root, related_other_column)))
+            data["aggregate_arguments"] = aggregate_arguments
+            return data
 
-        path_with_query_string = "/{}/{}.json?{}".format(
-            database_name, table_name, urllib.parse.urlencode(qs)
+        if direct_sql:
+            fetch_page = fetch_table_page
+        else:
+            fetch_page = functools.partial(
+                fetch_table_page_via_json_api, blob_columns=blob_columns
+            )
+        data = await fetch_page(
+            datasette,
+            db,
+            table_name,
+            meta,
+            info.context,
+            first,
+            filter=filter,
+            where=where,
+            search=search,
+            sort=sort,
+            sort_desc=sort_desc,
+            after=after,
+            pairs=pairs,
+            include_rows=include_rows,
+            include_count=include_count,
+            before=before,
+            last=last,
         )
-
-        context = info.context
-        if context and "time_started" in context:
-            elapsed_ms = (time.monotonic() - context["time_started"]) * 1000
-            if context["time_limit_ms"] and elapsed_ms > context["time_limit_ms"]:
-                assert False, "Time limit exceeded: {:.2f}ms > {}ms - {}".format(
-                    elapsed_ms, context["time_limit_ms"], path_with_query_string
-                )
-            context["num_queries_executed"] += 1
-            if (
-                context["num_queries_limit"]
-                and context["num_queries_executed"] > context["num_queries_limit"]
-            ):
-                assert False, "Query limit exceeded: {} > {} - {}".format(
-                    context["num_queries_executed"],
-                    context["num_queries_limit"],
-                    path_with_query_string,
-                )
-
-        data = (await datasette.client.get(path_with_query_string)).json()
-        # If any cells are $base64, decode them into bytes objects
-        for row in data["rows"]:
-            for key, value in row.items():
-                if isinstance(value, dict) and value.get("$base64"):
-                    row[key] = b64decode(value["encoded"])
-        klass = table_classes[table_name]
         data["rows"] = [klass.from_row(r) for r in data["rows"]]
         if return_first_row:
             try:
@@ -616,25 +1072,144 @@ def make_table_resolver(
             except IndexError:
                 return None
         else:
+            data["aggregate_arguments"] = aggregate_arguments
             return data
 
     return resolve_table
 
 
-def make_fk_resolver(db, table, table_classes, fk):
+async def fetch_table_page_via_json_api(
+    datasette,
+    db,
+    table,
+    meta,
+    context,
+    first,
+    filter=None,
+    where=None,
+    search=None,
+    sort=None,
+    sort_desc=None,
+    after=None,
+    pairs=None,
+    include_rows=True,
+    include_count=True,
+    before=None,
+    last=None,
+    blob_columns=None,
+):
+    """
+    Fetch a page of rows using an internal request to the table JSON API,
+    decoding the values of any blob_columns back into bytes
+    """
+    if before or last is not None:
+        assert False, "before: and last: are not supported with direct_sql: false"
+    column_name_rev = {v: k for k, v in meta.graphql_columns.items()}
+    qs = {
+        "_nofacet": 1,
+        "_extra": "columns,count" if include_count else "columns",
+    }
+    qs.update(filter_pairs(meta, filter))
+    qs.update(pairs or [])
+    offset = 0
+    if after and meta.is_view:
+        offset = view_offset(after)
+        qs["_next"] = offset
+    elif after:
+        qs["_next"] = legacy_token_from_cursor(after)
+    qs["_size"] = first if include_rows else 0
+
+    if search and meta.supports_fts:
+        qs["_search"] = search
+
+    if where:
+        qs["_where"] = where
+    if sort:
+        qs["_sort"] = column_name_rev[sort.value]
+    elif sort_desc:
+        qs["_sort_desc"] = column_name_rev[sort_desc.value]
+
+    check_limits(
+        context, "/{}/{}.json?{}".format(db.name, table, urllib.parse.urlencode(qs))
+    )
+
+    async with QuerySlot(context):
+        remaining_ms = time_remaining_ms(context)
+        if remaining_ms is not None:
+            qs["_timelimit"] = max(math.ceil(remaining_ms), 1)
+        path_with_query_string = "/{}/{}.json?{}".format(
+            db.name, table, urllib.parse.urlencode(qs)
+        )
+        data = (await datasette.client.get(path_with_query_string)).json()
+    # Counted as one statement, whatever the table view ran to answer it
+    count_sql_statement(context)
+    if data.get("ok") is False:
+        if remaining_ms is not None and time_remaining_ms(context) <= 0:
+            assert False, "Time limit exceeded: {} - {}".format(
+                data.get("error"), path_with_query_string
+            )
+        assert False, data.get("error")
+    for column in blob_columns or ():
+        for row in data["rows"]:
+            value = row.get(column)
+            if isinstance(value, dict) and value.get("$base64"):
+                row[column] = b64decode(value["encoded"])
+            elif isinstance(value, str):
+                # Datasette returns blobs that are valid UTF-8 as strings
+                row[column] = value.encode("utf-8")
+    data.setdefault("count", None)
+    # The JSON API does not say which column it sorted by, so work that out
+    # the same way it does
+    sort_column, _, _ = await sort_column_and_order_by(
+        datasette, db, table, meta, sort=sort, sort_desc=sort_desc
+    )
+    if data.get("next") and not meta.is_view:
+        # Use a cursor in place of Datasette's _next token
+        data["next"] = encode_cursor(
+            [data["rows"][-1][column] for column in cursor_columns(meta, sort_column)]
+        )
+    data["cursor_for"] = make_cursor_for(meta, sort_column, offset)
+    return data
+
+
+def selected_field_names(info):
+    """
+    Names of the fields selected on the value returned by this resolver,
+    including those selected using fragments and respecting @skip/@include
+    """
+    fields = collect_sub_fields(
+        info.schema,
+        info.fragments,
+        info.variable_values,
+        get_named_type(info.return_type),
+        info.field_nodes,
+    )
+    return {field_nodes[0].name.value for field_nodes in fields.values()}
+
+
+def make_fk_resolver(db, graphql_column, table_classes, fk, other_meta=None):
+    def make_loader(context):
+        return make_fk_loader(
+            db,
+            fk.other_table,
+            fk.other_column,
+            lambda row: table_classes[fk.other_table].from_row(row),
+            context,
+            meta=other_meta,
+        )
+
     async def resolve_foreign_key(parent, info):
         # retrieve the correct column from parent
-        pk = getattr(parent, fk.column)
-        sql = "select * from [{}] where [{}] = :v".format(
-            fk.other_table, fk.other_column
-        )
-        params = {"v": pk}
-        results = await db.execute(sql, params)
-        fk_class = table_classes[fk.other_table]
-        try:
-            return [fk_class.from_row(row) for row in results.rows][0]
-        except IndexError:
+        value = getattr(parent, graphql_column)
+        if value is None:
             return None
+        # Batched with the same foreign key for every other row in this page
+        loader = get_loader(
+            info,
+            ("fk", db.name, fk.other_table, fk.other_column),
+            lambda: make_loader(info.context),
+        )
+        return await loader.load(value)
 
     return resolve_foreign_key
 
@@ -668,53 +1243,199 @@ def path_from_row_pks(row, pks, use_rowid, quote=True):
     return ",".join(bits)
 
 
+ForeignKey = namedtuple(
+    "ForeignKey", ("table", "column", "other_table", "other_column")
+)
+
+_fts_content_re = r"virtual\s+table.*using\s+fts.*content=(\[{name}\]|\"{name}\")"
+
+
 def introspect_tables(conn, datasette, db_name, table_configs):
-    db = sqlite_utils.Database(conn)
+    """
+    Reads the columns, primary keys and foreign keys for every table and
+    view using a fixed number of queries, however many tables there are
+    """
+    tables_and_views = conn.execute(
+        "select name, type from sqlite_master where type in ('table', 'view')"
+    ).fetchall()
+    table_names = [name for name, type in tables_and_views if type == "table"]
+    view_names = [name for name, type in tables_and_views if type == "view"]
+
+    columns = {name: {} for name, _ in tables_and_views}
+    pk_positions = {name: [] for name, _ in tables_and_views}
+    for table, column, column_type, pk in conn.execute(
+        "select m.name, p.name, p.type, p.pk from sqlite_master m "
+        "join pragma_table_info(m.name) p "
+        "where m.type in ('table', 'view') order by m.rowid, p.cid"
+    ):
+        columns[table][column] = sqlite_utils.db.column_affinity(column_type)
+        if pk:
+            pk_positions[table].append((pk, column))
+    pks = {
+        table: [column for _, column in sorted(positions)] or ["rowid"]
+        for table, positions in pk_positions.items()
+    }
 
-    table_names = db.table_names()
-    view_names = db.view_names()
+    # Compound foreign keys are not supported, so they are skipped
+    fk_rows = {}
+    for table, fk_id, other_table, column, other_column in conn.execute(
+        'select m.name, p.id, p."table", p."from", p."to" from sqlite_master m '
+        "join pragma_foreign_key_list(m.name) p where m.type = 'table' "
+        "order by m.rowid, p.id, p.seq"
+    ):
+        fk_rows.setdefault((table, fk_id), []).append(
+            (other_table, column, other_column)
+        )
+    foreign_keys = {table: [] for table in table_names}
+    fks_back = {table: [] for table in table_names}
+    for (table, _), rows in fk_rows.items():
+        if len(rows) != 1:
+            continue
+        other_table, column, other_column = rows[0]
+        if other_column is None:
+            # REFERENCES other_table with no column uses its primary key
+            other_pks = pks.get(other_table, ["rowid"])
+            if len(other_pks) != 1:
+                continue
+            other_column = other_pks[0]
+        fk = ForeignKey(table, column, other_table, other_column)
+        if other_table in fks_back:
+            foreign_keys[table].append(fk)
+            fks_back[other_table].append(fk)
+
+    fts_tables = conn.execute(
+        "select name, tbl_name, sql from sqlite_master where rootpage = 0 "
+        "and sql like '%VIRTUAL TABLE%USING FTS%'"
+    ).fetchall()
+
+    def detect_fts(table):
+        content_re = re.compile(
+            _fts_content_re.format(name=re.escape(table)), re.IGNORECASE | re.DOTALL
+        )
+        return any(
+            tbl_name == table or content_re.search(sql)
+            for _, tbl_name, sql in fts_tables
+        )
 
     table_metadata = {}
     table_namer = Namer("t")
 
     for table in table_names + view_names:
         datasette_table_config = table_configs.get(table, {})
-        columns = db[table].columns_dict
-        foreign_keys = []
-        pks = []
         supports_fts = bool(datasette_table_config.get("fts_table"))
-        fks_back = []
-        if hasattr(db[table], "foreign_keys"):
-            # Views don't have .foreign_keys
-            foreign_keys = [
-                fk
-                for fk in db[table].foreign_keys
-                # filter out keys to tables that do not exist
-                if fk.other_table in table_names
-            ]
-            pks = db[table].pks
-            supports_fts = bool(db[table].detect_fts()) or supports_fts
-            # Gather all foreign keys pointing back here
-            collected = []
-            for t in db.tables:
-                collected.extend(t.foreign_keys)
-            fks_back = [f for f in collected if f.other_table == table]
         is_view = table in view_names
+        if not is_view:
+            supports_fts = detect_fts(table) or supports_fts
         column_namer = Namer("c")
         table_metadata[table] = TableMetadata(
-            columns=columns,
-            foreign_keys=foreign_keys,
-            fks_back=fks_back,
-            pks=pks,
+            columns=columns[table],
+            foreign_keys=foreign_keys.get(table, []),
+            fks_back=fks_back.get(table, []),
+            pks=[] if is_view else pks[table],
             supports_fts=supports_fts,
             is_view=is_view,
             graphql_name=table_namer.name(table),
-            graphql_columns={column: column_namer.name(column) for column in columns},
+            graphql_columns={
+                column: column_namer.name(column) for column in columns[table]
+            },
         )
 
     return table_metadata
 
 
+# Bump this if the format of TableMetadata changes
+INTROSPECTION_CACHE_VERSION = 1
+_column_types = {column_type.__name__: column_type for column_type in types}
+
+
+def introspect_tables_via_cache(
+    conn, datasette, db_name, table_configs, cache_dir, db_path
+):
+    """
+    introspect_tables(), but using a JSON file in cache_dir that is reused
+    for as long as the database schema and table configuration stay the
+    same - so new processes can skip introspection entirely
+    """
+    # A file rebuilt at the same path can have the same schema_version, so
+    # the key includes the schema itself too
+    schema_sql = [
+        tuple(row)
+        for row in conn.execute(
+            "select type, name, tbl_name, sql from sqlite_master order by type, name"
+        )
+    ]
+    cache_key = hashlib.sha256(
+        json.dumps(
+            [
+                INTROSPECTION_CACHE_VERSION,
+                conn.execute("PRAGMA schema_version").fetchone()[0],
+                schema_sql,
+                table_configs,
+            ],
+            sort_keys=True,
+            default=repr,
+        ).encode("utf-8")
+    ).hexdigest()
+    path = pathlib.Path(cache_dir) / "{}.json".format(
+        hashlib.sha256(str(pathlib.Path(db_path).resolve()).encode("utf-8")).hexdigest()
+    )
+    try:
+        cached = json.loads(path.read_text())
+        if cached["key"] == cache_key:
+            return {
+                table: metadata_from_json(meta)
+                for table, meta in cached["tables"].items()
+            }
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    table_metadata = introspect_tables(conn, datasette, db_name, table_configs)
+    try:
+        tables = {
+            table: metadata_to_json(meta) for table, meta in table_metadata.items()
+        }
+    except ValueError:
+        # A column type that cannot be serialized, e.g. ANY
+        return table_metadata
+    # Write then rename, so other processes never see a partial file
+    tmp_path = path.with_name("{}.{}.tmp".format(path.name, os.getpid()))
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_text(json.dumps({"key": cache_key, "tables": tables}))
+        os.replace(tmp_path, path)
+    except OSError:
+        # The cache is an optimization, so failing to write it is not fatal
+        pass
+    return table_metadata
+
+
+def metadata_to_json(meta):
+    columns = {}
+    for column, column_type in meta.columns.items():
+        if _column_types.get(getattr(column_type, "__name__", None)) is not column_type:
+            raise ValueError("Cannot serialize column type {!r}".format(column_type))
+        columns[column] = column_type.__name__
+    return dict(
+        meta._asdict(),
+        columns=columns,
+        foreign_keys=[list(fk) for fk in meta.foreign_keys],
+        fks_back=[list(fk) for fk in meta.fks_back],
+    )
+
+
+def metadata_from_json(data):
+    return TableMetadata(
+        **dict(
+            data,
+            columns={
+                column: _column_types[column_type]
+                for column, column_type in data["columns"].items()
+            },
+            foreign_keys=[ForeignKey(*fk) for fk in data["foreign_keys"]],
+            fks_back=[ForeignKey(*fk) for fk in data["fks_back"]],
+        )
+    )
+
+
 def resolve_generic(root, info):
     json_string = getattr(root, info.field_name, "")
     return json.loads(json_string)
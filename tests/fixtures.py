@@ -1,4 +1,7 @@
 from datasette.app import Datasette
+from datasette_graphql.advisor import _query_plan_advisor
+from datasette_graphql.execution import _document_cache, _response_cache
+from datasette_graphql.utils import DEFAULT_SCHEMA_CACHE_SIZE, _schema_cache
 import pytest
 import sqlite_utils
 
@@ -139,6 +142,33 @@ def db_path2(tmp_path_factory):
     return db_path
 
 
+@pytest.fixture
+def fresh_db_path(tmp_path):
+    """
+    Returns a function that builds a new copy of the test database called
+    name, for tests that count schema builds, cache hits or queries. The
+    caches that outlive a Datasette instance are emptied before and after.
+    """
+
+    def make(name):
+        db_path = tmp_path / "{}.db".format(name)
+        build_database(sqlite_utils.Database(db_path))
+        return db_path
+
+    reset_caches()
+    yield make
+    reset_caches()
+
+
+def reset_caches():
+    _schema_cache.clear()
+    _schema_cache.resize(DEFAULT_SCHEMA_CACHE_SIZE)
+    _document_cache.clear()
+    _response_cache.clear()
+    _response_cache.resize(0)
+    _query_plan_advisor.clear()
+
+
 @pytest.fixture(scope="session")
 def ds(db_path):
     datasette = Datasette([str(db_path)], pdb=True)
@@ -0,0 +1,114 @@
+from datasette.app import Datasette
+from datasette_graphql.advisor import index_columns
+import sqlite_utils
+import pytest
+from .fixtures import fresh_db_path
+
+QUERY = '{ repos(filter: {name: {eq: "datasette"}}, sort: full_name) { nodes { full_name } } }'
+SUGGESTION = "create index idx_repos_name_full_name on repos (name, full_name)"
+
+
+@pytest.fixture
+def advisor_db(fresh_db_path):
+    return fresh_db_path("advisor")
+
+
+def make_ds(db_path, enabled=True):
+    ds = Datasette(
+        [str(db_path)],
+        metadata={"plugins": {"datasette-graphql": {"query_plan_advisor": enabled}}},
+    )
+    ds.root_enabled = True
+    return ds
+
+
+async def report(ds):
+    response = await ds.client.get(
+        "/graphql/-/index-advisor.json",
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+@pytest.mark.parametrize(
+    "pairs,sort_column,expected",
+    (
+        ([], None, []),
+        ([["name__exact", "x"]], None, ["name"]),
+        ([["score__gt", 1], ["name__exact", "x"]], None, ["name", "score"]),
+        ([["score__gt", 1], ["name__exact", "x"]], "created", ["name", "created"]),
+        ([["owner__in", [1, 2]]], "rowid", ["owner"]),
+        ([["name__contains", "x"]], None, []),
+    ),
+)
+def test_index_columns(pairs, sort_column, expected):
+    assert index_columns(pairs, sort_column) == expected
+
+
+@pytest.mark.asyncio
+async def test_index_advisor(advisor_db):
+    ds = make_ds(advisor_db)
+    for _ in range(2):
+        response = await ds.client.post("/graphql", json={"query": QUERY})
+        assert response.status_code == 200
+    # Related rows are fetched using the owner foreign key, which has no index
+    response = await ds.client.post(
+        "/graphql", json={"query": "{ users { nodes { repos_list { totalCount } } } }"}
+    )
+    assert response.status_code == 200
+    data = await report(ds)
+    assert data["enabled"]
+    suggestions = {
+        suggestion["create_index"]: suggestion for suggestion in data["suggestions"]
+    }
+    assert set(suggestions) == {
+        SUGGESTION,
+        "create index idx_repos_owner on repos (owner)",
+    }
+    suggestion = suggestions[SUGGESTION]
+    assert suggestion["database"] == "advisor"
+    assert suggestion["table"] == "repos"
+    assert suggestion["columns"] == ["name", "full_name"]
+    assert suggestion["count"] == 2
+    assert suggestion["total_ms"] > 0
+    assert suggestion["queries"][0].startswith("select ")
+    # Every query is listed along with its plan
+    (query,) = [q for q in data["queries"] if q["sql"] in suggestion["queries"]]
+    assert query["plan"] == ["SCAN repos", "USE TEMP B-TREE FOR ORDER BY"]
+    # The advisor never creates indexes itself
+    assert sqlite_utils.Database(advisor_db)["repos"].indexes == []
+
+
+@pytest.mark.asyncio
+async def test_index_advisor_skips_existing_indexes(advisor_db):
+    sqlite_utils.Database(advisor_db)["repos"].create_index(["name", "full_name"])
+    ds = make_ds(advisor_db)
+    response = await ds.client.post("/graphql", json={"query": QUERY})
+    assert response.status_code == 200
+    data = await report(ds)
+    assert data["suggestions"] == []
+    assert len(data["queries"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_index_advisor_disabled(advisor_db):
+    ds = make_ds(advisor_db, enabled=False)
+    response = await ds.client.post("/graphql", json={"query": QUERY})
+    assert response.status_code == 200
+    assert await report(ds) == {"enabled": False, "suggestions": [], "queries": []}
+
+
+@pytest.mark.asyncio
+async def test_index_advisor_page(advisor_db):
+    ds = make_ds(advisor_db)
+    await ds.client.post("/graphql", json={"query": QUERY})
+    response = await ds.client.get("/graphql/-/index-advisor")
+    assert response.status_code == 403
+    response = await ds.client.get(
+        "/graphql/-/index-advisor",
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+    )
+    assert response.status_code == 200
+    assert "<h1>GraphQL index advisor</h1>" in response.text
+    assert SUGGESTION + ";" in response.text
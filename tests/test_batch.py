@@ -0,0 +1,91 @@
+from datasette.app import Datasette
+from datasette_graphql import loaders
+from datasette_graphql.utils import _schema_cache
+import pytest
+from unittest import mock
+from .fixtures import ds, db_path
+
+REPO_OWNERS = "{ repos(first: %d) { nodes { full_name owner { name } } } }"
+
+
+@pytest.mark.asyncio
+async def test_batch(ds):
+    response = await ds.client.post(
+        "/graphql",
+        json=[
+            {"query": "{ users { totalCount } }"},
+            {
+                "query": "query($id: Int) { users_row(id: $id) { name } }",
+                "variables": {"id": 2},
+            },
+            {
+                "query": "query A { a: users { totalCount } } query B { b: repos { totalCount } }",
+                "operationName": "B",
+            },
+        ],
+    )
+    assert response.status_code == 200
+    assert response.json() == [
+        {"data": {"users": {"totalCount": 2}}},
+        {"data": {"users_row": {"name": "simonw"}}},
+        {"data": {"b": {"totalCount": 3}}},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_batch_shares_loaders(ds):
+    calls = []
+
+    async def execute_sql(db, sql, params, context, index_hint=None):
+        calls.append(sql)
+        return await original_execute_sql(db, sql, params, context, index_hint)
+
+    original_execute_sql = loaders.execute_sql
+    with mock.patch.object(loaders, "execute_sql", execute_sql):
+        response = await ds.client.post(
+            "/graphql",
+            json=[{"query": REPO_OWNERS % 2}, {"query": REPO_OWNERS % 3}],
+        )
+    assert response.status_code == 200
+    assert [len(item["data"]["repos"]["nodes"]) for item in response.json()] == [2, 3]
+    # Owners for both operations were fetched by a single query
+    assert len([sql for sql in calls if sql.startswith("select * from [users]")]) == 1
+
+
+@pytest.mark.asyncio
+async def test_batch_errors(ds):
+    response = await ds.client.post(
+        "/graphql",
+        json=[{"query": "{ users { totalCount } }"}, {"query": "{ nope }"}, {}, []],
+    )
+    assert response.status_code == 500
+    data = response.json()
+    assert data[0] == {"data": {"users": {"totalCount": 2}}}
+    assert data[1]["errors"][0]["message"] == (
+        "Cannot query field 'nope' on type 'Query'."
+    )
+    assert data[2] == {"error": "Missing query"}
+    assert data[3] == {"error": "Operation must be a JSON object"}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "batch,expected_error",
+    (
+        ([], "Missing query"),
+        (
+            [{"query": "{ users { totalCount } }"}] * 3,
+            "Batch of 3 operations exceeds the limit of 2",
+        ),
+    ),
+)
+async def test_batch_size_limit(db_path, batch, expected_error):
+    _schema_cache.clear()
+    ds = Datasette(
+        [str(db_path)],
+        metadata={"plugins": {"datasette-graphql": {"batch_size_limit": 2}}},
+    )
+    response = await ds.client.post("/graphql", json=batch)
+    assert response.status_code == 400
+    assert response.json() == {"error": expected_error}
+    _schema_cache.clear()
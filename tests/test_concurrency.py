@@ -0,0 +1,145 @@
+from datasette.app import Datasette
+from datasette_graphql.concurrency import QueryLimiter, QuerySlot, _query_limiter
+from datasette_graphql.utils import _schema_cache
+import asyncio
+import pytest
+from unittest import mock
+from .fixtures import db_path
+
+QUERY = """
+{
+    users { totalCount }
+    repos { totalCount }
+    issues { totalCount }
+    licenses { totalCount }
+}
+"""
+
+
+@pytest.fixture
+def limited_ds(db_path):
+    def make(config):
+        _schema_cache.clear()
+        return Datasette(
+            [str(db_path)],
+            settings={"num_sql_threads": 5},
+            metadata={"plugins": {"datasette-graphql": config}},
+        )
+
+    yield make
+    _schema_cache.clear()
+    _query_limiter.resize(None)
+
+
+async def max_concurrent_queries(ds, query=QUERY):
+    "Execute query, returning the largest number of SQL queries run at once"
+    db = ds.get_database("test")
+    execute = db.execute
+    running = 0
+    peak = 0
+
+    async def slow_execute(*args, **kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        try:
+            # Give the other root fields a chance to start
+            await asyncio.sleep(0.01)
+            return await execute(*args, **kwargs)
+        finally:
+            running -= 1
+
+    with mock.patch.object(db, "execute", slow_execute):
+        response = await ds.client.post("/graphql", json={"query": query})
+    assert response.status_code == 200
+    assert "errors" not in response.json()
+    return peak
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "config,expected",
+    (
+        # Defaults to num_sql_threads - 1 globally and 2 per request
+        ({}, 2),
+        ({"max_concurrent_queries_per_request": 3}, 3),
+        ({"max_concurrent_queries_per_request": 3, "max_concurrent_queries": 1}, 1),
+        ({"max_concurrent_queries_per_request": 0, "max_concurrent_queries": 0}, 4),
+    ),
+)
+async def test_max_concurrent_queries(limited_ds, config, expected):
+    ds = limited_ds(config)
+    assert await max_concurrent_queries(ds) == expected
+
+
+@pytest.mark.asyncio
+async def test_max_concurrent_queries_json_api(limited_ds):
+    ds = limited_ds({"direct_sql": False, "max_concurrent_queries_per_request": 1})
+    # The table JSON API executes more than one query for each request, but
+    # only one of those requests is made at a time
+    get = ds.client.get
+    running = 0
+    peak = 0
+
+    async def slow_get(*args, **kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        try:
+            await asyncio.sleep(0.01)
+            return await get(*args, **kwargs)
+        finally:
+            running -= 1
+
+    response = await ds.client.post(
+        "/graphql", json={"query": "{ users { totalCount } }"}
+    )
+    assert response.status_code == 200
+    with mock.patch.object(ds.client, "get", slow_get):
+        response = await ds.client.post("/graphql", json={"query": QUERY})
+    assert response.status_code == 200
+    assert peak == 1
+
+
+@pytest.mark.asyncio
+async def test_global_limit_is_shared_between_requests(limited_ds):
+    ds = limited_ds({"max_concurrent_queries": 3})
+    await ds.invoke_startup()
+    # Each request may run two queries at once, but three between them
+    peaks = []
+    db = ds.get_database("test")
+    execute = db.execute
+    running = 0
+
+    async def slow_execute(*args, **kwargs):
+        nonlocal running
+        running += 1
+        peaks.append(running)
+        try:
+            await asyncio.sleep(0.01)
+            return await execute(*args, **kwargs)
+        finally:
+            running -= 1
+
+    with mock.patch.object(db, "execute", slow_execute):
+        responses = await asyncio.gather(
+            *(ds.client.post("/graphql", json={"query": QUERY}) for _ in range(3))
+        )
+    assert all(response.status_code == 200 for response in responses)
+    assert max(peaks) == 3
+
+
+@pytest.mark.asyncio
+async def test_query_slot_releases_on_error():
+    limiter = QueryLimiter(1)
+    with mock.patch("datasette_graphql.concurrency._query_limiter", limiter):
+        context = {"query_semaphore": asyncio.Semaphore(1)}
+        with pytest.raises(ValueError):
+            async with QuerySlot(context):
+                raise ValueError
+        # Both slots are available again
+        async with QuerySlot(context):
+            assert limiter.semaphore().locked()
+            assert context["query_semaphore"].locked()
+        assert not limiter.semaphore().locked()
+        assert not context["query_semaphore"].locked()
@@ -0,0 +1,96 @@
+from datasette.app import Datasette
+from datasette_graphql.cost import QueryCost, query_cost
+from datasette_graphql.utils import _schema_cache, schema_for_database_via_cache
+from graphql import parse
+import pytest
+from .fixtures import ds, db_path
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query,variables,expected",
+    (
+        ("{ users_row(id: 1) { name } }", None, QueryCost(2, 2, 0)),
+        # 1 for users, 1 for totalCount
+        ("{ users { totalCount } }", None, QueryCost(2, 2, 0)),
+        # 1 + 10 nodes + 10 * 2 fields
+        ("{ users { nodes { id name } } }", None, QueryCost(31, 3, 0)),
+        ("{ users(first: 2) { nodes { id name } } }", None, QueryCost(7, 3, 0)),
+        (
+            "query($first: Int) { users(first: $first) { nodes { id name } } }",
+            {"first": 3},
+            QueryCost(10, 3, 0),
+        ),
+        # Nested lists multiply
+        (
+            """{
+                users(first: 2) {
+                    nodes {
+                        repos_list(first: 5) {
+                            edges { node { name owner { name } } }
+                        }
+                    }
+                }
+            }""",
+            None,
+            # 1 + 2 nodes + 2 repos_list + 10 edges + 10 node + 30 fields
+            QueryCost(55, 7, 0),
+        ),
+        # Fragments and aliases count too
+        (
+            """{
+                a: users(first: 1) { ...names }
+                b: users(first: 1) { ... on usersCollection { nodes { name } } }
+            }
+            fragment names on usersCollection { nodes { name } }""",
+            None,
+            QueryCost(6, 3, 2),
+        ),
+    ),
+)
+async def test_query_cost(ds, query, variables, expected):
+    schema = (await schema_for_database_via_cache(ds, "test")).schema
+    assert query_cost(schema.graphql_schema, parse(query), None, variables) == expected
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "config,query,expected_error",
+    (
+        (
+            {"query_cost_limit": 20},
+            "{ users { nodes { id name } } }",
+            "Query cost 31 exceeds the limit of 20",
+        ),
+        (
+            {"query_depth_limit": 2},
+            "{ users { nodes { id name } } }",
+            "Query depth 3 exceeds the limit of 2",
+        ),
+        (
+            {"query_alias_limit": 1},
+            "{ a: users { totalCount } b: users { totalCount } }",
+            "Number of aliases 2 exceeds the limit of 1",
+        ),
+        ({"query_cost_limit": 31}, "{ users { nodes { id name } } }", None),
+        # There is no cost limit by default
+        (
+            {},
+            "{ users(first: 1000) { nodes { repos_list(first: 1000) { nodes { id } } } } }",
+            None,
+        ),
+    ),
+)
+async def test_query_cost_limits(db_path, config, query, expected_error):
+    _schema_cache.clear()
+    ds = Datasette([str(db_path)], metadata={"plugins": {"datasette-graphql": config}})
+    response = await ds.client.post("/graphql", json={"query": query})
+    if expected_error:
+        assert response.status_code == 500
+        assert response.json() == {
+            "data": None,
+            "errors": [{"message": expected_error}],
+        }
+    else:
+        assert response.status_code == 200
+    _schema_cache.clear()
@@ -0,0 +1,73 @@
+from datasette.app import Datasette
+from datasette_graphql.cache import LRUCache
+from datasette_graphql.execution import _document_cache
+from datasette_graphql.utils import _schema_cache
+import sqlite_utils
+import pytest
+from .fixtures import build_database
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # b is now the least recently used
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 2, "misses": 1}
+    # peek() is not counted and does not change the order
+    assert cache.peek("a") == 1
+    assert cache.peek("b") is None
+    assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 2, "misses": 1}
+    cache.set("e", 5)
+    assert "a" not in cache
+    cache.resize(1)
+    assert len(cache) == 1
+    assert "e" in cache
+    cache.resize(0)
+    cache.set("d", 4)
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_document_cache(tmp_path_factory):
+    db_path = tmp_path_factory.mktemp("dbs") / "docs.db"
+    db = sqlite_utils.Database(db_path)
+    build_database(db)
+    _schema_cache.clear()
+    _document_cache.clear()
+    ds = Datasette([str(db_path)])
+    query = "{ users { nodes { name } } }"
+
+    for _ in range(3):
+        response = await ds.client.post("/graphql", json={"query": query})
+        assert response.status_code == 200
+        assert response.json()["data"]["users"]["nodes"][0]["name"] == "cleopaws"
+    assert _document_cache.hits == 2
+    assert _document_cache.misses == 1
+    assert len(_document_cache) == 1
+
+    # Invalid documents are cached along with their errors
+    for _ in range(2):
+        response = await ds.client.post(
+            "/graphql", json={"query": "{ users { nodes { bad } } }"}
+        )
+        assert response.status_code == 500
+        assert response.json()["errors"][0]["message"].startswith(
+            "Cannot query field 'bad' on type 'users'."
+        )
+    assert _document_cache.hits == 3
+    assert len(_document_cache) == 2
+
+    # Changing the schema discards documents validated against the old one
+    db["new_table"].insert({"new_column": 1})
+    response = await ds.client.post(
+        "/graphql", json={"query": "{ new_table { nodes { new_column } } }"}
+    )
+    assert response.status_code == 200
+    assert response.json()["data"] == {"new_table": {"nodes": [{"new_column": 1}]}}
+    assert len(_document_cache) == 1
+    _schema_cache.clear()
@@ -1,11 +1,16 @@
 from datasette.app import Datasette
+from datasette_graphql.sql import encode_cursor
 from datasette_graphql.utils import _schema_cache
+import base64
 import json
 import pathlib
 import pytest
 import re
+import sqlite3
 import urllib
 import textwrap
+import time
+from unittest import mock
 from .fixtures import ds, db_path, db_path2
 
 graphql_re = re.compile(r"```graphql(.*?)```", re.DOTALL)
@@ -167,6 +172,166 @@ async def test_graphql_examples(ds, path):
     assert response.json()["data"] == expected
 
 
+@pytest.mark.asyncio
+async def test_graphql_examples_table_json_api(db_path):
+    # The same examples should work using the table JSON API instead of SQL
+    _schema_cache.clear()
+    ds = Datasette(
+        [str(db_path)],
+        metadata={"plugins": {"datasette-graphql": {"direct_sql": False}}},
+    )
+    try:
+        for path in (pathlib.Path(__file__).parent.parent / "examples").glob("*.md"):
+            content = path.read_text()
+            query = graphql_re.search(content)[1]
+            try:
+                variables = variables_re.search(content)[1]
+            except TypeError:
+                variables = "{}"
+            expected = json.loads(json_re.search(content)[1])
+            response = await ds.client.post(
+                "/graphql",
+                json={
+                    "query": query,
+                    "variables": json.loads(variables),
+                },
+            )
+            assert response.status_code == 200, (path, response.json())
+            assert response.json()["data"] == expected, path
+    finally:
+        _schema_cache.clear()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("direct_sql", (True, False))
+@pytest.mark.parametrize("sort", ("sort", "sort_desc"))
+async def test_graphql_sorted_pagination(db_path, direct_sql, sort):
+    _schema_cache.clear()
+    ds = Datasette(
+        [str(db_path)],
+        metadata={"plugins": {"datasette-graphql": {"direct_sql": direct_sql}}},
+    )
+    after = None
+    names = []
+    while True:
+        args = ["first: 1", "{}: dog_award".format(sort)]
+        if after:
+            args.append('after: "{}"'.format(after))
+        query = "{ users(ARGS) { pageInfo { endCursor } nodes { name } } }".replace(
+            "ARGS", ", ".join(args)
+        )
+        response = await ds.client.post("/graphql", json={"query": query})
+        assert response.status_code == 200, response.json()
+        data = response.json()["data"]["users"]
+        names.extend(node["name"] for node in data["nodes"])
+        after = data["pageInfo"]["endCursor"]
+        if not after:
+            break
+    # dog_award for simonw is null, which sorts first
+    if sort == "sort":
+        assert names == ["simonw", "cleopaws"]
+    else:
+        assert names == ["cleopaws", "simonw"]
+    _schema_cache.clear()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("direct_sql", (True, False))
+@pytest.mark.parametrize("sort", ("sort", "sort_desc"))
+async def test_graphql_sorted_pagination_many_pages(tmp_path, direct_sql, sort):
+    _schema_cache.clear()
+    db_path = tmp_path / "many.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute("create table items (id integer primary key, v integer)")
+    # Duplicate and null values of v, so pages end part way through a value
+    conn.executemany(
+        "insert into items (id, v) values (?, ?)",
+        [(i, None if i % 10 == 0 else i % 7) for i in range(1, 51)],
+    )
+    conn.commit()
+    conn.close()
+    ds = Datasette(
+        [str(db_path)],
+        metadata={"plugins": {"datasette-graphql": {"direct_sql": direct_sql}}},
+    )
+    after = None
+    ids = []
+    pages = 0
+    while True:
+        args = "first: 7, {}: v".format(sort)
+        if after:
+            args += ', after: "{}"'.format(after)
+        response = await ds.client.post(
+            "/graphql",
+            json={
+                "query": "{ items(%s) { pageInfo { endCursor } nodes { id } } }" % args
+            },
+        )
+        assert response.status_code == 200, response.json()
+        data = response.json()["data"]["items"]
+        ids.extend(node["id"] for node in data["nodes"])
+        pages += 1
+        assert pages <= 8, "Still paginating after {} pages".format(pages)
+        after = data["pageInfo"]["endCursor"]
+        if not after:
+            break
+    expected = await ds.get_database("many").execute(
+        "select id from items order by v{}, id".format(
+            " desc" if sort == "sort_desc" else ""
+        )
+    )
+    assert ids == [row["id"] for row in expected.rows]
+    assert pages == 8
+    _schema_cache.clear()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "table,sort",
+    (
+        ("users", "sort: dog_award"),
+        ("users", "sort_desc: dog_award"),
+        ("repos", "sort: owner"),
+        ("repos", "sort_desc: license"),
+    ),
+)
+async def test_graphql_sorted_pagination_both_directions(ds, table, sort):
+    # Sort columns can contain nulls and duplicate values
+    async def walk(args, cursor_field, cursor_arg):
+        cursor = None
+        names = []
+        while True:
+            query = "{ TABLE(ARGS) { pageInfo { CURSOR } nodes { id } } }".replace(
+                "TABLE", table
+            ).replace("CURSOR", cursor_field)
+            page_args = [args, sort]
+            if cursor:
+                page_args.append('{}: "{}"'.format(cursor_arg, cursor))
+            response = await ds.client.post(
+                "/graphql", json={"query": query.replace("ARGS", ", ".join(page_args))}
+            )
+            assert response.status_code == 200, response.json()
+            data = response.json()["data"][table]
+            names.extend(node["id"] for node in data["nodes"])
+            cursor = data["pageInfo"][cursor_field]
+            if not cursor:
+                return names
+
+    forwards = await walk("first: 1", "endCursor", "after")
+    backwards = await walk("last: 1", "startCursor", "before")
+    response = await ds.client.post(
+        "/graphql",
+        json={
+            "query": "{ TABLE(first: 100, SORT) { nodes { id } } }".replace(
+                "TABLE", table
+            ).replace("SORT", sort)
+        },
+    )
+    expected = [node["id"] for node in response.json()["data"][table]["nodes"]]
+    assert forwards == expected
+    assert list(reversed(backwards)) == expected
+
+
 @pytest.mark.asyncio
 async def test_graphql_error(ds):
     response = await ds.client.post(
@@ -278,6 +443,194 @@ async def test_graphql_pagination(ds, table):
     assert len(set(names_from_edges)) == 21
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "table",
+    [
+        "table_with_pk",
+        "table_with_rowid",
+        "table_with_compound_pk",
+        "view_on_table_with_pk",
+    ],
+)
+async def test_graphql_pagination_backwards(ds, table):
+    query = """
+    query($first: Int, $last: Int, $before: String) {
+        TABLE(first: $first, last: $last, before: $before) {
+            pageInfo {
+                startCursor
+                hasPreviousPage
+                endCursor
+                hasNextPage
+            }
+            edges {
+                cursor
+                node {
+                    name
+                }
+            }
+        }
+    }
+    """.replace(
+        "TABLE", table
+    )
+
+    async def fetch(**variables):
+        response = await ds.client.post(
+            "/graphql", json={"query": query, "variables": variables}
+        )
+        assert response.status_code == 200, response.json()
+        return response.json()["data"][table]
+
+    everything = await fetch(first=100)
+    names = [edge["node"]["name"] for edge in everything["edges"]]
+    assert len(names) == 21
+    # Views need a before: cursor, start after the final row
+    before = None
+    if table.startswith("view_"):
+        before = str(len(names) + 1)
+    pages = []
+    while True:
+        data = await fetch(last=10, before=before)
+        pages.insert(0, [edge["node"]["name"] for edge in data["edges"]])
+        if data["edges"]:
+            assert data["pageInfo"]["endCursor"] == (
+                data["edges"][-1]["cursor"] if before else None
+            )
+        before = data["pageInfo"]["startCursor"]
+        assert data["pageInfo"]["hasPreviousPage"] == bool(before)
+        if not before:
+            break
+    assert [len(page) for page in pages] == [1, 10, 10]
+    assert [name for page in pages for name in page] == names
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "table", ["table_with_pk", "table_with_rowid", "table_with_compound_pk"]
+)
+async def test_graphql_pagination_edge_cursors(ds, table):
+    query = "{ TABLE(first: 21) { edges { cursor node { name } } } }".replace(
+        "TABLE", table
+    )
+    response = await ds.client.post("/graphql", json={"query": query})
+    edges = response.json()["data"][table]["edges"]
+    names = [edge["node"]["name"] for edge in edges]
+    for i in (0, 5, 20):
+        query = (
+            (
+                '{ TABLE(first: 3, after: "AFTER") { nodes { name } } '
+                'before: TABLE(last: 2, before: "AFTER") { nodes { name } } }'
+            )
+            .replace("TABLE", table)
+            .replace("AFTER", edges[i]["cursor"])
+        )
+        response = await ds.client.post("/graphql", json={"query": query})
+        data = response.json()["data"]
+        assert [node["name"] for node in data[table]["nodes"]] == names[i + 1 : i + 4]
+        assert [node["name"] for node in data["before"]["nodes"]] == names[
+            max(i - 2, 0) : i
+        ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "table,after,expected",
+    (
+        ("table_with_pk", "10", "Row 11"),
+        ("table_with_rowid", "10", "Row 11"),
+        ("table_with_compound_pk", "1,7", "Row 2 1"),
+    ),
+)
+async def test_graphql_pagination_accepts_datasette_tokens(ds, table, after, expected):
+    # Cursors returned by earlier versions of this plugin still work
+    query = '{ TABLE(first: 1, after: "AFTER") { nodes { name } } }'.replace(
+        "TABLE", table
+    ).replace("AFTER", after)
+    response = await ds.client.post("/graphql", json={"query": query})
+    assert response.json()["data"][table]["nodes"] == [{"name": expected}]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "table,cursor,expected_plan",
+    (
+        ("table_with_pk", [10], "USING INTEGER PRIMARY KEY (rowid>?)"),
+        (
+            "table_with_compound_pk",
+            [1, 7],
+            "USING INDEX sqlite_autoindex_table_with_compound_pk_1 ((pk1,pk2)>(?,?))",
+        ),
+    ),
+)
+async def test_graphql_pagination_uses_index(ds, table, cursor, expected_plan):
+    db = ds.get_database("test")
+    query = '{ TABLE(first: 2, after: "AFTER") { nodes { name } } }'.replace(
+        "TABLE", table
+    ).replace("AFTER", encode_cursor(cursor))
+    with mock.patch.object(db, "execute", wraps=db.execute) as spy:
+        response = await ds.client.post("/graphql", json={"query": query})
+    assert response.status_code == 200
+    select = next(
+        call for call in spy.call_args_list if call.args[0].startswith("select pk")
+    )
+    plan = await db.execute("explain query plan " + select.args[0], select.args[1])
+    details = " ".join(row["detail"] for row in plan.rows)
+    assert "SEARCH {} {}".format(table, expected_plan) in details
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "args,expected_error",
+    (
+        ("first: 1, last: 1", "Use first: or last: but not both"),
+        ("first: -5", "first must be >= 0"),
+        ('last: -5, before: "{}"'.format(encode_cursor([3])), "last must be >= 0"),
+        ('last: 1, before: "bad"', "Invalid cursor"),
+        (
+            'first: 1, after: "{}"'.format(encode_cursor([1, 2, 3])),
+            "Invalid cursor",
+        ),
+    ),
+)
+async def test_graphql_pagination_errors(ds, args, expected_error):
+    query = "{ table_with_pk(ARGS) { nodes { name } } }".replace("ARGS", args)
+    response = await ds.client.post("/graphql", json={"query": query})
+    assert response.json()["errors"][0]["message"] == expected_error
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "direct_sql,args",
+    (
+        (True, 'after: "bad"'),
+        (True, 'after: "-1"'),
+        (True, 'last: 1, before: "bad"'),
+        (False, 'after: "bad"'),
+        (False, 'after: "-1"'),
+    ),
+)
+async def test_graphql_view_pagination_errors(db_path, direct_sql, args):
+    _schema_cache.clear()
+    ds = Datasette(
+        [str(db_path)],
+        metadata={"plugins": {"datasette-graphql": {"direct_sql": direct_sql}}},
+    )
+    query = "{ view_on_table_with_pk(ARGS) { nodes { name } } }".replace("ARGS", args)
+    response = await ds.client.post("/graphql", json={"query": query})
+    assert response.json()["errors"][0]["message"] == "Invalid cursor"
+    _schema_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_graphql_related_pagination_errors(ds):
+    response = await ds.client.post(
+        "/graphql",
+        json={"query": "{ users { nodes { repos_list(first: -1) { totalCount } } } }"},
+    )
+    assert response.json()["errors"][0]["message"] == "first must be >= 0"
+
+
 @pytest.mark.asyncio
 async def test_graphql_multiple_databases(db_path, db_path2):
     ds = Datasette([str(db_path), str(db_path2)])
@@ -297,6 +650,52 @@ async def test_graphql_multiple_databases(db_path, db_path2):
     }
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("direct_sql", (True, False))
+async def test_graphql_blob_columns(tmp_path, direct_sql):
+    _schema_cache.clear()
+    db_path = tmp_path / "blobs.db"
+    base64_shaped = json.dumps({"$base64": True, "encoded": "aGVsbG8="})
+    conn = sqlite3.connect(db_path)
+    conn.execute("create table files (id integer primary key, data blob, notes text)")
+    conn.executemany(
+        "insert into files (id, data, notes) values (?, ?, ?)",
+        ((1, b"\x00\x01binary", base64_shaped), (2, b"\xff\xfe", "[1, 2]")),
+    )
+    conn.commit()
+    conn.close()
+    ds = Datasette(
+        [str(db_path)],
+        metadata={
+            "plugins": {"datasette-graphql": {"direct_sql": direct_sql}},
+            "databases": {
+                "blobs": {
+                    "tables": {
+                        "files": {
+                            "plugins": {
+                                "datasette-graphql": {"json_columns": ["notes"]}
+                            }
+                        }
+                    }
+                }
+            },
+        },
+    )
+    query = "{ files { nodes { data notes } } }"
+    response = await ds.client.post("/graphql/blobs", json={"query": query})
+    assert response.status_code == 200, response.json()
+    assert response.json()["data"]["files"]["nodes"] == [
+        # BLOB columns come back as bytes, which the Bytes scalar encodes
+        {
+            "data": base64.b64encode(b"\x00\x01binary").decode("ascii"),
+            # Text that looks like an encoded BLOB is left alone
+            "notes": {"$base64": True, "encoded": "aGVsbG8="},
+        },
+        {"data": base64.b64encode(b"\xff\xfe").decode("ascii"), "notes": [1, 2]},
+    ]
+    _schema_cache.clear()
+
+
 @pytest.mark.asyncio
 async def test_graphql_json_columns(db_path):
     _schema_cache.clear()
@@ -535,15 +934,73 @@ async def test_time_limit_ms(db_path):
     assert len(response_json["errors"]) == 1
     assert response_json["errors"][0]["message"].startswith("Time limit exceeded: ")
     assert response_json["errors"][0]["message"].endswith(
-        " > 0.1ms - /test/repos.json?_nofacet=1&_extra=columns%2Ccount&_size=10&_search=dogspotter"
+        " > 0.1ms - select id, full_name, name, owner, license, tags from repos "
+        "where rowid in (select rowid from repos_fts where repos_fts match "
+        "escape_fts(:search)) order by id limit 11"
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("table", ("repos", "users"))
+async def test_time_limit_ms_interrupts_running_query(db_path, table):
+    # This query would never finish without being interrupted
+    where = (
+        "id in (with recursive counter(x) as "
+        "(select 1 union all select x + 1 from counter) select x from counter)"
     )
+    ds = Datasette(
+        [str(db_path)],
+        metadata={"plugins": {"datasette-graphql": {"time_limit_ms": 50}}},
+    )
+    query = "query($where: String) { %s(where: $where) { nodes { id } } }" % table
+    start = time.monotonic()
+    response = await ds.client.post(
+        "/graphql", json={"query": query, "variables": {"where": where}}
+    )
+    # Interrupted well before Datasette's own one second sql_time_limit_ms
+    assert time.monotonic() - start < 0.9
+    assert response.status_code == 500
+    message = response.json()["errors"][0]["message"]
+    assert message.startswith("Time limit exceeded: ")
+    assert " > 50ms - select " in message
+    assert "with recursive counter(x)" in message
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query,expected",
+    (
+        (
+            '{ users(filter: {id: {eq: 1}}, where: "1=0 or 1=1") { totalCount } }',
+            {"users": {"totalCount": 1}},
+        ),
+        # after: uses the unbatched path, which adds the foreign key clause
+        (
+            """{ users { nodes {
+                repos_list(where: "1=0 or 1=1", after: "0") { nodes { id } }
+            } } }""",
+            {
+                "users": {
+                    "nodes": [
+                        {"repos_list": {"nodes": [{"id": 2}]}},
+                        {"repos_list": {"nodes": [{"id": 1}, {"id": 3}]}},
+                    ]
+                }
+            },
+        ),
+    ),
+)
+async def test_where_with_or_keeps_other_clauses(ds, query, expected):
+    response = await ds.client.post("/graphql", json={"query": query})
+    assert response.status_code == 200, response.json()
+    assert response.json() == {"data": expected}
 
 
 @pytest.mark.asyncio
 async def test_num_queries_limit(db_path):
     ds = Datasette(
         [str(db_path)],
-        metadata={"plugins": {"datasette-graphql": {"num_queries_limit": 2}}},
+        metadata={"plugins": {"datasette-graphql": {"num_queries_limit": 1}}},
     )
     query = """
     {
@@ -566,11 +1023,15 @@ async def test_num_queries_limit(db_path):
     data = data_and_errors["data"]
     errors = data_and_errors["errors"]
     users = data["users"]["nodes"]
-    # One of the two users should have an empty repos_list
-    assert (users[0]["repos_list"] is None) or (users[1]["repos_list"] is None)
+    # repos_list for both users is fetched by a single query, which fails
+    assert users[0]["repos_list"] is None
+    assert users[1]["repos_list"] is None
     # Errors should say query limit was exceeded
-    assert len(errors) == 1
-    assert errors[0]["message"].startswith("Query limit exceeded: 3 > 2 - ")
+    assert len(errors) == 2
+    assert all(
+        error["message"].startswith("Query limit exceeded: 2 > 1 - ")
+        for error in errors
+    )
 
 
 @pytest.mark.asyncio
@@ -820,6 +1281,405 @@ async def test_bad_foreign_keys(ds):
     assert response.json() == {"data": {"bad_foreign_key": {"nodes": [{"fk": 1}]}}}
 
 
+@pytest.mark.asyncio
+async def test_foreign_keys_are_batched(db_path):
+    _schema_cache.clear()
+    ds = Datasette([str(db_path)])
+    db = ds.get_database("test")
+    query = """
+    {
+        repos {
+            nodes {
+                name
+                owner {
+                    name
+                }
+                license {
+                    name
+                }
+            }
+        }
+    }
+    """
+    with mock.patch.object(db, "execute", wraps=db.execute) as spy:
+        response = await ds.client.post("/graphql", json={"query": query})
+    assert response.status_code == 200
+    assert response.json()["data"]["repos"]["nodes"] == [
+        {
+            "name": "datasette",
+            "owner": {"name": "simonw"},
+            "license": {"name": "Apache 2"},
+        },
+        {
+            "name": "dogspotter",
+            "owner": {"name": "cleopaws"},
+            "license": {"name": "MIT"},
+        },
+        {"name": "private", "owner": {"name": "simonw"}, "license": None},
+    ]
+    fk_queries = [
+        (call.args[0], call.args[1])
+        for call in spy.call_args_list
+        if " where [id] in " in call.args[0] or " where [$key] in " in call.args[0]
+    ]
+    # One query per foreign key table, with duplicate keys removed
+    assert sorted(fk_queries) == [
+        ("select * from [licenses] where [$key] in (?, ?)", ["apache2", "mit"]),
+        ("select * from [users] where [id] in (?, ?)", [2, 1]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_foreign_key_to_rowid_table(tmp_path):
+    _schema_cache.clear()
+    db_path = tmp_path / "rowid_fk.db"
+    conn = sqlite3.connect(db_path)
+    conn.executescript(
+        """
+        create table owners (name text);
+        create table pets (name text, owner integer references owners);
+        insert into owners (rowid, name) values (1, 'Cleo'), (2, 'Simon');
+        insert into pets (name, owner) values ('Pancakes', 2), ('Bubbles', 1);
+        """
+    )
+    conn.close()
+    ds = Datasette([str(db_path)])
+    query = """
+    {
+        pets {
+            nodes {
+                name
+                owner {
+                    rowid
+                    name
+                    pets_list {
+                        nodes {
+                            name
+                        }
+                    }
+                }
+            }
+        }
+    }
+    """
+    response = await ds.client.post("/graphql", json={"query": query})
+    assert response.status_code == 200
+    assert response.json() == {
+        "data": {
+            "pets": {
+                "nodes": [
+                    {
+                        "name": "Pancakes",
+                        "owner": {
+                            "rowid": 2,
+                            "name": "Simon",
+                            "pets_list": {"nodes": [{"name": "Pancakes"}]},
+                        },
+                    },
+                    {
+                        "name": "Bubbles",
+                        "owner": {
+                            "rowid": 1,
+                            "name": "Cleo",
+                            "pets_list": {"nodes": [{"name": "Bubbles"}]},
+                        },
+                    },
+                ]
+            }
+        }
+    }
+    _schema_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_related_rows_are_batched(db_path):
+    _schema_cache.clear()
+    ds = Datasette([str(db_path)])
+    db = ds.get_database("test")
+    query = """
+    {
+        users {
+            nodes {
+                name
+                repos_list(first: 1, sort_desc: name) {
+                    totalCount
+                    pageInfo {
+                        endCursor
+                        hasNextPage
+                    }
+                    nodes {
+                        name
+                    }
+                }
+            }
+        }
+    }
+    """
+    with mock.patch.object(db, "execute", wraps=db.execute) as spy:
+        response = await ds.client.post("/graphql", json={"query": query})
+    assert response.status_code == 200
+    assert response.json()["data"]["users"]["nodes"] == [
+        {
+            "name": "cleopaws",
+            "repos_list": {
+                "totalCount": 1,
+                "pageInfo": {"endCursor": None, "hasNextPage": False},
+                "nodes": [{"name": "dogspotter"}],
+            },
+        },
+        {
+            "name": "simonw",
+            "repos_list": {
+                "totalCount": 2,
+                "pageInfo": {
+                    "endCursor": encode_cursor(["private", 3]),
+                    "hasNextPage": True,
+                },
+                "nodes": [{"name": "private"}],
+            },
+        },
+    ]
+    repos_queries = [
+        call.args[0]
+        for call in spy.call_args_list
+        if call.args[0].startswith("select") and " from repos " in call.args[0]
+    ]
+    # One query for the rows and one for the counts, for both users
+    assert len(repos_queries) == 2
+    assert "row_number() over (partition by owner" in repos_queries[0]
+    assert "group by owner" in repos_queries[1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query,expected_data,expect_rows,expect_count",
+    (
+        (
+            "{ repos { nodes { name } } }",
+            {
+                "repos": {
+                    "nodes": [
+                        {"name": "datasette"},
+                        {"name": "dogspotter"},
+                        {"name": "private"},
+                    ]
+                }
+            },
+            True,
+            False,
+        ),
+        ("{ repos { totalCount } }", {"repos": {"totalCount": 3}}, False, True),
+        (
+            "{ repos { ...counted } } fragment counted on reposCollection { totalCount }",
+            {"repos": {"totalCount": 3}},
+            False,
+            True,
+        ),
+        (
+            "{ repos(first: 1) { ... on reposCollection { pageInfo { hasNextPage } } } }",
+            {"repos": {"pageInfo": {"hasNextPage": True}}},
+            True,
+            False,
+        ),
+        (
+            "{ users { nodes { repos_list { totalCount } } } }",
+            {
+                "users": {
+                    "nodes": [
+                        {"repos_list": {"totalCount": 1}},
+                        {"repos_list": {"totalCount": 2}},
+                    ]
+                }
+            },
+            False,
+            True,
+        ),
+    ),
+)
+async def test_count_and_rows_only_if_requested(
+    db_path, query, expected_data, expect_rows, expect_count
+):
+    _schema_cache.clear()
+    ds = Datasette([str(db_path)])
+    db = ds.get_database("test")
+    with mock.patch.object(db, "execute", wraps=db.execute) as spy:
+        response = await ds.client.post("/graphql", json={"query": query})
+    assert response.status_code == 200
+    assert response.json()["data"] == expected_data
+    repos_queries = [
+        call.args[0]
+        for call in spy.call_args_list
+        if call.args[0].startswith("select") and " from repos" in call.args[0]
+    ]
+    assert any("count(*)" in sql for sql in repos_queries) == expect_count
+    assert any("count(*)" not in sql for sql in repos_queries) == expect_rows
+
+
+@pytest.mark.asyncio
+async def test_aggregates_use_one_query(db_path):
+    _schema_cache.clear()
+    ds = Datasette([str(db_path)])
+    db = ds.get_database("test")
+    query = """
+    {
+        users(filter: {points: {gt: 1}}, where: "name != 'nobody'") {
+            aggregate {
+                count
+                sum {
+                    points
+                }
+                min {
+                    score
+                }
+            }
+        }
+    }
+    """
+    with mock.patch.object(db, "execute", wraps=db.execute) as spy:
+        response = await ds.client.post("/graphql", json={"query": query})
+    assert response.status_code == 200
+    assert response.json()["data"] == {
+        "users": {
+            "aggregate": {"count": 2, "sum": {"points": 8}, "min": {"score": 35.2}}
+        }
+    }
+    users_queries = [
+        call.args[0]
+        for call in spy.call_args_list
+        if call.args[0].startswith("select") and " from users" in call.args[0]
+    ]
+    # No rows or totalCount were requested, so only the aggregates are fetched
+    assert users_queries == [
+        "select count(*), sum(id), sum(points), sum(score), min(id), min(points), "
+        "min(score) from users where \"points\" > :p0 and (name != 'nobody')"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_related_aggregates_are_batched(db_path):
+    _schema_cache.clear()
+    ds = Datasette([str(db_path)])
+    db = ds.get_database("test")
+    query = """
+    {
+        users {
+            nodes {
+                name
+                repos_list(filter: {name: {not: "private"}}) {
+                    aggregate {
+                        count
+                        max {
+                            id
+                        }
+                        groupBy(column: license) {
+                            value
+                            count
+                        }
+                    }
+                }
+                issues_by_updated_by_list {
+                    aggregate {
+                        count
+                    }
+                }
+            }
+        }
+    }
+    """
+    with mock.patch.object(db, "execute", wraps=db.execute) as spy:
+        response = await ds.client.post("/graphql", json={"query": query})
+    assert response.status_code == 200
+    assert response.json()["data"]["users"]["nodes"] == [
+        {
+            "name": "cleopaws",
+            "repos_list": {
+                "aggregate": {
+                    "count": 1,
+                    "max": {"id": 2},
+                    "groupBy": [{"value": "mit", "count": 1}],
+                }
+            },
+            # Parents without related rows have a count of 0
+            "issues_by_updated_by_list": {"aggregate": {"count": 0}},
+        },
+        {
+            "name": "simonw",
+            "repos_list": {
+                "aggregate": {
+                    "count": 1,
+                    "max": {"id": 1},
+                    "groupBy": [{"value": "apache2", "count": 1}],
+                }
+            },
+            "issues_by_updated_by_list": {"aggregate": {"count": 1}},
+        },
+    ]
+    repos_queries = [
+        call.args[0]
+        for call in spy.call_args_list
+        if call.args[0].startswith("select") and " from repos " in call.args[0]
+    ]
+    # One aggregate query for both users, then groupBy for each of them
+    assert len(repos_queries) == 3
+    assert repos_queries[0] == (
+        "select owner, count(*), max(id), max(owner) from repos "
+        'where "name" != :p0 and owner in (:k0, :k1) group by owner'
+    )
+    assert all(" group by license " in sql for sql in repos_queries[1:])
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "args,expected",
+    (
+        ("column: owner", [{"value": 2, "count": 2}, {"value": 1, "count": 1}]),
+        ("column: owner, first: 1", [{"value": 2, "count": 2}]),
+        (
+            "column: license",
+            [
+                {"value": None, "count": 1},
+                {"value": "apache2", "count": 1},
+                {"value": "mit", "count": 1},
+            ],
+        ),
+    ),
+)
+async def test_aggregate_group_by(ds, args, expected):
+    response = await ds.client.post(
+        "/graphql",
+        json={
+            "query": "{ repos { aggregate { groupBy(%s) { value count } } } }" % args
+        },
+    )
+    assert response.status_code == 200
+    assert response.json()["data"]["repos"]["aggregate"]["groupBy"] == expected
+
+
+@pytest.mark.asyncio
+async def test_aggregate_errors(ds):
+    response = await ds.client.post(
+        "/graphql",
+        json={
+            "query": "{ repos { aggregate { groupBy(column: owner, first: 1001) { count } } } }"
+        },
+    )
+    assert response.json()["errors"][0]["message"] == "first must be <= 1000"
+    response = await ds.client.post(
+        "/graphql",
+        json={
+            "query": "{ repos { aggregate { groupBy(column: owner, first: -1) { count } } } }"
+        },
+    )
+    assert response.json()["errors"][0]["message"] == "first must be >= 0"
+    # Tables without numeric columns only have count and groupBy
+    response = await ds.client.post(
+        "/graphql", json={"query": "{ licenses { aggregate { sum { name } } } }"}
+    )
+    assert response.json()["errors"][0]["message"] == (
+        "Cannot query field 'sum' on type 'licensesAggregate'."
+    )
+
+
 @pytest.mark.asyncio
 async def test_alternative_graphql():
     graphql_path = "/-/graphql"
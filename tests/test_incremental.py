@@ -0,0 +1,170 @@
+import json
+import pytest
+from .fixtures import ds, db_path
+
+MULTIPART = {"accept": "multipart/mixed, application/json"}
+
+
+def multipart_payloads(response):
+    assert response.headers["content-type"] == (
+        'multipart/mixed; boundary="-"; deferSpec=20220824'
+    )
+    assert response.text.endswith("\r\n-----\r\n")
+    payloads = []
+    for part in response.text.split("\r\n---")[1:-1]:
+        headers, body = part.split("\r\n\r\n", 1)
+        assert headers.strip() == "Content-Type: application/json; charset=utf-8"
+        payloads.append(json.loads(body))
+    return payloads
+
+
+@pytest.mark.asyncio
+async def test_defer(ds):
+    query = """{
+        users {
+            nodes {
+                name
+                ... @defer(label: "repos") { repos_list { nodes { full_name } } }
+            }
+        }
+    }"""
+    response = await ds.client.post(
+        "/graphql", json={"query": query}, headers=MULTIPART
+    )
+    assert response.status_code == 200
+    assert multipart_payloads(response) == [
+        {
+            "data": {"users": {"nodes": [{"name": "cleopaws"}, {"name": "simonw"}]}},
+            "hasNext": True,
+        },
+        {
+            "incremental": [
+                {
+                    "data": {
+                        "repos_list": {"nodes": [{"full_name": "cleopaws/dogspotter"}]}
+                    },
+                    "path": ["users", "nodes", 0],
+                    "label": "repos",
+                },
+                {
+                    "data": {
+                        "repos_list": {
+                            "nodes": [
+                                {"full_name": "simonw/datasette"},
+                                {"full_name": "simonw/private"},
+                            ]
+                        }
+                    },
+                    "path": ["users", "nodes", 1],
+                    "label": "repos",
+                },
+            ],
+            "hasNext": False,
+        },
+    ]
+
+
+@pytest.mark.asyncio
+async def test_nested_defer(ds):
+    query = """{
+        users {
+            totalCount
+            ...userNodes @defer
+        }
+    }
+    fragment userNodes on usersCollection {
+        nodes { name ... @defer { id } }
+    }"""
+    response = await ds.client.post(
+        "/graphql", json={"query": query}, headers=MULTIPART
+    )
+    assert multipart_payloads(response) == [
+        {"data": {"users": {"totalCount": 2}}, "hasNext": True},
+        {
+            "incremental": [
+                {
+                    "data": {"nodes": [{"name": "cleopaws"}, {"name": "simonw"}]},
+                    "path": ["users"],
+                }
+            ],
+            "hasNext": True,
+        },
+        {
+            "incremental": [
+                {"data": {"id": 1}, "path": ["users", "nodes", 0]},
+                {"data": {"id": 2}, "path": ["users", "nodes", 1]},
+            ],
+            "hasNext": False,
+        },
+    ]
+
+
+@pytest.mark.asyncio
+async def test_stream(ds):
+    query = """{
+        repos(first: 3) {
+            nodes @stream(initialCount: 1, label: "rest") { full_name owner { name } }
+        }
+    }"""
+    response = await ds.client.post(
+        "/graphql", json={"query": query}, headers=MULTIPART
+    )
+    assert multipart_payloads(response) == [
+        {
+            "data": {
+                "repos": {
+                    "nodes": [
+                        {"full_name": "simonw/datasette", "owner": {"name": "simonw"}}
+                    ]
+                }
+            },
+            "hasNext": True,
+        },
+        {
+            "incremental": [
+                {
+                    "items": [
+                        {
+                            "full_name": "cleopaws/dogspotter",
+                            "owner": {"name": "cleopaws"},
+                        },
+                        {"full_name": "simonw/private", "owner": {"name": "simonw"}},
+                    ],
+                    "path": ["repos", "nodes", 1],
+                    "label": "rest",
+                }
+            ],
+            "hasNext": False,
+        },
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query,headers",
+    (
+        # Clients that do not accept multipart/mixed get a single response
+        ("{ users { nodes { name ... @defer { id } } } }", {}),
+        # Nothing to defer
+        ("{ users { nodes { name ... @defer(if: false) { id } } } }", MULTIPART),
+        ("{ users { nodes @stream(initialCount: 5) { name id } } }", MULTIPART),
+    ),
+)
+async def test_incremental_not_used(ds, query, headers):
+    response = await ds.client.post("/graphql", json={"query": query}, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/json")
+    assert response.json() == {
+        "data": {
+            "users": {
+                "nodes": [{"name": "cleopaws", "id": 1}, {"name": "simonw", "id": 2}]
+            }
+        }
+    }
+
+
+@pytest.mark.asyncio
+async def test_defer_directive_in_schema(ds):
+    response = await ds.client.get("/graphql/test.graphql")
+    assert "directive @defer(" in response.text
+    assert "directive @stream(" in response.text
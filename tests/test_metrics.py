@@ -0,0 +1,150 @@
+from datasette.app import Datasette
+from datasette_graphql.metrics import Counter, Histogram, Metrics, _metrics
+import pytest
+from unittest import mock
+from .fixtures import fresh_db_path
+
+
+@pytest.fixture
+def metrics_ds(fresh_db_path):
+    _metrics.clear()
+    ds = Datasette(
+        [str(fresh_db_path("metrics"))],
+        metadata={"plugins": {"datasette-graphql": {"num_queries_limit": 1}}},
+    )
+    yield ds
+    _metrics.clear()
+
+
+def samples(text):
+    return dict(
+        line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#")
+    )
+
+
+def test_render():
+    metrics = Metrics()
+    metrics.requests.inc("db", "Named")
+    metrics.requests.inc("db", "Named")
+    metrics.requests.inc("db", 'Has "quotes"')
+    metrics.request_duration.observe(0.003, "db")
+    metrics.request_duration.observe(20, "db")
+    text = metrics.render()
+    assert "# TYPE datasette_graphql_requests_total counter" in text
+    assert "# TYPE datasette_graphql_request_duration_seconds histogram" in text
+    values = samples(text)
+    assert (
+        values['datasette_graphql_requests_total{database="db",operation="Named"}']
+        == "2"
+    )
+    assert (
+        values[
+            'datasette_graphql_requests_total{database="db",operation="Has \\"quotes\\""}'
+        ]
+        == "1"
+    )
+    duration = "datasette_graphql_request_duration_seconds"
+    assert values[duration + '_bucket{database="db",le="0.001"}'] == "0"
+    assert values[duration + '_bucket{database="db",le="0.005"}'] == "1"
+    assert values[duration + '_bucket{database="db",le="10"}'] == "1"
+    assert values[duration + '_bucket{database="db",le="+Inf"}'] == "2"
+    assert values[duration + '_count{database="db"}'] == "2"
+    assert values[duration + '_sum{database="db"}'] == "20.003"
+
+
+def test_label_sets_are_capped():
+    counter = Counter("requests_total", "Requests", ("operation",))
+    histogram = Histogram("duration_seconds", "Duration", ("operation",))
+    with mock.patch("datasette_graphql.metrics.MAX_LABEL_SETS", 2):
+        for name in ("a", "b", "c", "d", "a"):
+            counter.inc(name)
+            histogram.observe(1, name)
+    assert counter.values == {("a",): 2, ("b",): 1, ("__other__",): 2}
+    assert set(histogram.values) == {("a",), ("b",), ("__other__",)}
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(metrics_ds):
+    ds = metrics_ds
+    for _ in range(2):
+        response = await ds.client.post(
+            "/graphql",
+            json={
+                "query": "query Users { users { nodes { name } } }",
+                "operationName": "Users",
+            },
+        )
+        assert response.status_code == 200
+    # Two queries, one more than the limit
+    response = await ds.client.post(
+        "/graphql", json={"query": "{ repos { totalCount } users { totalCount } }"}
+    )
+    assert response.json()["errors"][0]["message"].startswith("Query limit exceeded")
+
+    response = await ds.client.get("/graphql/-/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == (
+        "text/plain; version=0.0.4; charset=utf-8"
+    )
+    values = samples(response.text)
+    assert (
+        values['datasette_graphql_requests_total{database="metrics",operation="Users"}']
+        == "2"
+    )
+    assert (
+        values['datasette_graphql_requests_total{database="metrics",operation=""}']
+        == "1"
+    )
+    assert (
+        values['datasette_graphql_request_duration_seconds_count{database="metrics"}']
+        == "3"
+    )
+    # The request that hit the limit still ran its first statement
+    statements = "datasette_graphql_sql_statements_bucket"
+    assert values[statements + '{database="metrics",le="1"}'] == "3"
+    # Two users for each users query, plus one row for a count
+    assert values['datasette_graphql_rows_total{database="metrics"}'] == "5"
+    assert (
+        values['datasette_graphql_limit_exceeded_total{limit="num_queries_limit"}']
+        == "1"
+    )
+    assert (
+        values['datasette_graphql_schema_cache_total{database="metrics",result="miss"}']
+        == "1"
+    )
+    assert (
+        values['datasette_graphql_schema_cache_total{database="metrics",result="hit"}']
+        == "2"
+    )
+    assert (
+        values['datasette_graphql_schema_build_seconds_count{database="metrics"}']
+        == "1"
+    )
+    assert values['datasette_graphql_cache_size{cache="schema"}'] == "1"
+    assert 'datasette_graphql_cache_hits_total{cache="document"}' in values
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_permission(metrics_ds):
+    ds = Datasette(
+        [str(next(iter(metrics_ds.databases.values())).path)],
+        config={"allow": False},
+    )
+    response = await ds.client.get("/graphql/-/metrics")
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_sql_statements_counts_every_statement(metrics_ds):
+    # Rows and count for repos are one check against num_queries_limit, and
+    # the foreign key loader makes none, but that is three statements
+    response = await metrics_ds.client.post(
+        "/graphql",
+        json={"query": "{ repos { totalCount nodes { owner { name } } } }"},
+    )
+    assert "errors" not in response.json()
+    values = samples((await metrics_ds.client.get("/graphql/-/metrics")).text)
+    statements = "datasette_graphql_sql_statements"
+    assert values[statements + '_bucket{database="metrics",le="2"}'] == "0"
+    assert values[statements + '_bucket{database="metrics",le="5"}'] == "1"
+    assert values[statements + '_sum{database="metrics"}'] == "3"
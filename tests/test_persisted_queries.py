@@ -0,0 +1,126 @@
+from datasette.app import Datasette
+from datasette_graphql.persisted import _persisted_queries, query_hash
+from datasette_graphql.utils import _schema_cache
+import json
+import pytest
+import urllib
+from .fixtures import ds, db_path
+
+QUERY = "{ users { nodes { name } } }"
+EXPECTED = {"users": {"nodes": [{"name": "cleopaws"}, {"name": "simonw"}]}}
+
+
+def persisted(sha256_hash):
+    return {"persistedQuery": {"version": 1, "sha256Hash": sha256_hash}}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_file", (False, True))
+async def test_persisted_queries(db_path, tmp_path, use_file):
+    _schema_cache.clear()
+    _persisted_queries.clear()
+    config = {}
+    if use_file:
+        config["persisted_queries_path"] = str(tmp_path / "queries.db")
+    ds = Datasette([str(db_path)], metadata={"plugins": {"datasette-graphql": config}})
+    sha256_hash = query_hash(QUERY)
+
+    # Hash alone is not enough the first time
+    response = await ds.client.post(
+        "/graphql", json={"extensions": persisted(sha256_hash)}
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "errors": [
+            {
+                "message": "PersistedQueryNotFound",
+                "extensions": {"code": "PERSISTED_QUERY_NOT_FOUND"},
+            }
+        ]
+    }
+
+    # Sending the query along with the hash registers it
+    response = await ds.client.post(
+        "/graphql", json={"query": QUERY, "extensions": persisted(sha256_hash)}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"data": EXPECTED}
+
+    if use_file:
+        # Simulate a restart - the query should be loaded from the file
+        _persisted_queries.clear()
+
+    # Now a GET with just the hash works
+    response = await ds.client.get(
+        "/graphql?"
+        + urllib.parse.urlencode({"extensions": json.dumps(persisted(sha256_hash))})
+    )
+    assert response.status_code == 200
+    assert response.json() == {"data": EXPECTED}
+    _schema_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_persisted_query_hash_mismatch(ds):
+    response = await ds.client.post(
+        "/graphql",
+        json={"query": QUERY, "extensions": persisted(query_hash(QUERY + " "))},
+    )
+    assert response.status_code == 400
+    assert response.json()["errors"][0]["message"] == (
+        "provided sha does not match query"
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "extensions,expected",
+    (
+        (
+            {"persistedQuery": True},
+            {
+                "errors": [
+                    {
+                        "message": "Invalid persistedQuery",
+                        "extensions": {"code": "BAD_REQUEST"},
+                    }
+                ]
+            },
+        ),
+        (
+            {"persistedQuery": "abc"},
+            {
+                "errors": [
+                    {
+                        "message": "Invalid persistedQuery",
+                        "extensions": {"code": "BAD_REQUEST"},
+                    }
+                ]
+            },
+        ),
+        ("persistedQuery", {"error": "extensions must be a JSON object"}),
+    ),
+)
+async def test_invalid_extensions(ds, extensions, expected):
+    response = await ds.client.post(
+        "/graphql", json={"query": QUERY, "extensions": extensions}
+    )
+    assert response.status_code == 400
+    assert response.json() == expected
+
+
+@pytest.mark.asyncio
+async def test_persisted_queries_disabled(db_path):
+    _schema_cache.clear()
+    ds = Datasette(
+        [str(db_path)],
+        metadata={"plugins": {"datasette-graphql": {"persisted_queries": False}}},
+    )
+    response = await ds.client.post(
+        "/graphql", json={"query": QUERY, "extensions": persisted(query_hash(QUERY))}
+    )
+    assert response.status_code == 200
+    assert response.json()["errors"][0]["extensions"] == {
+        "code": "PERSISTED_QUERY_NOT_SUPPORTED"
+    }
+    _schema_cache.clear()
@@ -1,8 +1,11 @@
 from datasette import hookimpl
 from datasette.plugins import pm
 from datasette.app import Datasette
+from datasette.filters import FilterArguments
+from datasette_graphql.utils import _schema_cache
 import graphene
 import pytest
+from .fixtures import db_path
 
 
 @pytest.mark.asyncio
@@ -69,3 +72,44 @@ async def test_graphql_extra_fields_hook():
         }
     finally:
         pm.unregister(name="undo")
+
+
+@pytest.mark.asyncio
+async def test_filters_from_request_plugins_are_applied(db_path):
+    class HidePrivatePlugin:
+        __name__ = "HidePrivatePlugin"
+
+        @hookimpl
+        def filters_from_request(self, request, database, table, datasette):
+            if table == "repos":
+                return FilterArguments(["name != 'private'"])
+
+    pm.register(HidePrivatePlugin(), name="undo")
+    _schema_cache.clear()
+    try:
+        ds = Datasette([str(db_path)])
+        response = await ds.client.post(
+            "/graphql",
+            json={
+                "query": "{ repos { nodes { name } } users { nodes { repos_list { totalCount } } } }"
+            },
+        )
+        assert response.status_code == 200
+        data = response.json()["data"]
+        assert data["repos"]["nodes"] == [{"name": "datasette"}, {"name": "dogspotter"}]
+        assert [
+            node["repos_list"]["totalCount"] for node in data["users"]["nodes"]
+        ] == [
+            1,
+            1,
+        ]
+        # Aggregates are calculated with SQL, which would skip the filter
+        response = await ds.client.post(
+            "/graphql", json={"query": "{ repos { aggregate { count } } }"}
+        )
+        assert response.json()["errors"][0]["message"] == (
+            "aggregate is not available while plugins add table filters"
+        )
+    finally:
+        pm.unregister(name="undo")
+        _schema_cache.clear()
@@ -0,0 +1,69 @@
+from datasette.app import Datasette
+import sqlite_utils
+import pytest
+from unittest import mock
+from .fixtures import fresh_db_path
+
+QUERY = "{ users { nodes { name } } }"
+
+
+@pytest.fixture
+def cached_ds(fresh_db_path):
+    db_path = fresh_db_path("cached")
+    ds = Datasette(
+        [str(db_path)],
+        metadata={
+            "plugins": {"datasette-graphql": {"response_cache_size": 10}},
+            "databases": {
+                "cached": {"plugins": {"datasette-graphql": {"response_cache_ttl": 60}}}
+            },
+        },
+    )
+    return ds, sqlite_utils.Database(db_path)
+
+
+async def names(ds, query=QUERY, **kwargs):
+    response = await ds.client.post("/graphql", json={"query": query}, **kwargs)
+    assert response.status_code == 200
+    data = response.json()
+    return (
+        [node["name"] for node in data["data"]["users"]["nodes"]],
+        data["extensions"]["responseCache"]["hit"],
+    )
+
+
+@pytest.mark.asyncio
+async def test_response_cache(cached_ds):
+    ds, db = cached_ds
+    assert await names(ds) == (["cleopaws", "simonw"], False)
+    assert await names(ds) == (["cleopaws", "simonw"], True)
+    # Whitespace differences do not matter
+    assert await names(ds, "{users{nodes{name}}}") == (["cleopaws", "simonw"], True)
+    # Different actors are cached separately
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    assert await names(ds, cookies=cookies) == (["cleopaws", "simonw"], False)
+    assert await names(ds, cookies=cookies) == (["cleopaws", "simonw"], True)
+
+
+@pytest.mark.asyncio
+async def test_response_cache_invalidated_by_writes(cached_ds):
+    ds, db = cached_ds
+    assert await names(ds) == (["cleopaws", "simonw"], False)
+    assert await names(ds) == (["cleopaws", "simonw"], True)
+    db["users"].insert({"id": 3, "name": "newuser"})
+    assert await names(ds) == (["cleopaws", "simonw", "newuser"], False)
+    assert await names(ds) == (["cleopaws", "simonw", "newuser"], True)
+    # Writes made by Datasette itself count too
+    await ds.get_database("cached").execute_write("delete from users where id = 3")
+    assert await names(ds) == (["cleopaws", "simonw"], False)
+
+
+@pytest.mark.asyncio
+async def test_response_cache_ttl(cached_ds):
+    ds, db = cached_ds
+    with mock.patch("datasette_graphql.execution.time.monotonic") as monotonic:
+        monotonic.return_value = 1000
+        assert (await names(ds))[1] is False
+        assert (await names(ds))[1] is True
+        monotonic.return_value = 1061
+        assert (await names(ds))[1] is False
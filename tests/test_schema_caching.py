@@ -1,10 +1,16 @@
 from datasette.app import Datasette
-from datasette_graphql.utils import schema_for_database, _schema_cache
+from datasette_graphql.utils import (
+    schema_for_database,
+    schema_for_database_via_cache,
+    _schema_cache,
+)
+import asyncio
 import sqlite_utils
 import pytest
 from unittest import mock
 import sys
-from .fixtures import build_database
+import time
+from .fixtures import build_database, fresh_db_path
 
 
 @pytest.mark.skipif(
@@ -62,3 +68,155 @@ async def test_schema_caching(mock_schema_for_database, tmp_path_factory):
 
     assert len(_schema_cache) == 1
     assert set(_schema_cache.keys()) != current_keys
+    # Looking up the previous schema to rebuild from is not a cache hit
+    assert _schema_cache.stats()["hits"] == 1
+    assert _schema_cache.stats()["misses"] == 2
+
+
+@pytest.fixture
+def schema_db_path(fresh_db_path):
+    return fresh_db_path("schema")
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8),
+    reason="async mocks from patch() require 3.8 or higher - #52",
+)
+@pytest.mark.asyncio
+@mock.patch("datasette_graphql.utils.schema_for_database")
+async def test_concurrent_requests_build_schema_once(
+    mock_schema_for_database, schema_db_path
+):
+    mock_schema_for_database.side_effect = schema_for_database
+    ds = Datasette([str(schema_db_path)])
+    schemas = await asyncio.gather(
+        *[schema_for_database_via_cache(ds, "schema") for _ in range(5)]
+    )
+    assert mock_schema_for_database.call_count == 1
+    assert all(schema is schemas[0] for schema in schemas)
+
+
+@pytest.mark.asyncio
+async def test_schema_version_check_ms(schema_db_path):
+    ds = Datasette(
+        [str(schema_db_path)],
+        metadata={
+            "plugins": {"datasette-graphql": {"schema_version_check_ms": 60 * 1000}}
+        },
+    )
+    schema = await schema_for_database_via_cache(ds, "schema")
+    sqlite_utils.Database(schema_db_path)["new_table"].insert({"new_column": 1})
+    # The schema version will not be checked again for another minute
+    assert await schema_for_database_via_cache(ds, "schema") is schema
+    a_minute_later = time.monotonic() + 61
+    with mock.patch("datasette_graphql.utils.time.monotonic") as monotonic:
+        monotonic.return_value = a_minute_later
+        new_schema = await schema_for_database_via_cache(ds, "schema")
+    assert new_schema is not schema
+    assert "new_table" in new_schema.table_classes
+
+
+@pytest.mark.asyncio
+async def test_schema_version_not_checked_for_immutable(schema_db_path):
+    ds = Datasette(immutables=[str(schema_db_path)])
+    schema = await schema_for_database_via_cache(ds, "schema")
+    db = ds.get_database("schema")
+    with mock.patch.object(db, "execute", wraps=db.execute) as spy:
+        assert await schema_for_database_via_cache(ds, "schema") is schema
+    assert not spy.called
+
+
+@pytest.mark.asyncio
+async def test_schema_cache_size(schema_db_path, tmp_path):
+    other_path = tmp_path / "other.db"
+    build_database(sqlite_utils.Database(other_path))
+    ds = Datasette(
+        [str(schema_db_path), str(other_path)],
+        metadata={"plugins": {"datasette-graphql": {"schema_cache_size": 1}}},
+    )
+    await ds.invoke_startup()
+    await schema_for_database_via_cache(ds, "schema")
+    await schema_for_database_via_cache(ds, "other")
+    assert [key[0] for key in _schema_cache.keys()] == ["other"]
+
+
+@pytest.mark.asyncio
+async def test_unchanged_tables_reuse_types(schema_db_path):
+    ds = Datasette([str(schema_db_path)])
+    schema = await schema_for_database_via_cache(ds, "schema")
+    classes = dict(schema.table_classes)
+    collection_classes = dict(schema.table_collection_classes)
+
+    # Changing licenses should rebuild every table connected to it
+    sqlite_utils.Database(schema_db_path)["licenses"].add_column("url", str)
+    new_schema = await schema_for_database_via_cache(ds, "schema")
+    assert new_schema is not schema
+    rebuilt = {
+        table
+        for table, table_class in new_schema.table_classes.items()
+        if table_class is not classes.get(table)
+    }
+    assert rebuilt == {"licenses", "repos", "users", "issues"}
+    assert (
+        new_schema.table_collection_classes["table_with_pk"]
+        is collection_classes["table_with_pk"]
+    )
+    # Reused types look up other tables in the new schema's classes
+    assert all(
+        lookup.classes is classes
+        for lookup, classes in zip(
+            new_schema.table_classes["table_with_pk"].class_lookups,
+            (new_schema.table_classes, new_schema.table_collection_classes),
+        )
+    )
+    # The previous schema is left as it was, for queries still using it
+    assert schema.table_classes == classes
+    assert schema.table_collection_classes == collection_classes
+
+    response = await ds.client.post(
+        "/graphql",
+        json={
+            "query": """{
+                users(first: 1) {
+                    nodes {
+                        name
+                        repos_list {
+                            nodes {
+                                name
+                                license { name url }
+                            }
+                        }
+                    }
+                }
+            }"""
+        },
+    )
+    assert response.status_code == 200
+    assert response.json()["data"]["users"]["nodes"] == [
+        {
+            "name": "cleopaws",
+            "repos_list": {
+                "nodes": [
+                    {"name": "dogspotter", "license": {"name": "MIT", "url": None}}
+                ]
+            },
+        }
+    ]
+
+
+@pytest.mark.asyncio
+async def test_dropped_table_does_not_change_previous_schema(schema_db_path):
+    ds = Datasette([str(schema_db_path)])
+    schema = await schema_for_database_via_cache(ds, "schema")
+    classes = dict(schema.table_classes)
+    sqlite_utils.Database(schema_db_path)["issues"].drop()
+    new_schema = await schema_for_database_via_cache(ds, "schema")
+    assert "issues" not in new_schema.table_classes
+    assert schema.table_classes == classes
+    # Tables that linked to the dropped table are rebuilt without it
+    for table in ("users", "repos"):
+        assert new_schema.table_classes[table] is not classes[table]
+    response = await ds.client.post(
+        "/graphql", json={"query": "{ users { nodes { name } } }"}
+    )
+    assert response.status_code == 200
@@ -6,6 +6,8 @@ from .fixtures import ds, db_path
 
 @pytest.mark.asyncio
 async def test_schema(ds):
+    # Resolvers check permissions, which needs the actions registered at startup
+    await ds.invoke_startup()
     schema = (await schema_for_database(ds)).schema
 
     query = """{
@@ -29,3 +31,18 @@ async def test_schema(ds):
             ],
         }
     }, result.errors
+
+
+@pytest.mark.asyncio
+async def test_from_row(ds):
+    users = (await schema_for_database(ds)).table_classes["users"]
+    db = ds.get_database("test")
+    sqlite_row = (await db.execute("select * from users where id = 1")).rows[0]
+    for row in (sqlite_row, dict(sqlite_row)):
+        obj = users.from_row(row)
+        # Compact objects rather than full graphene ObjectType instances
+        assert not hasattr(obj, "__dict__")
+        assert obj.name == "cleopaws"
+        # Column names are renamed to their GraphQL names
+        assert obj.dog_award == "3rd best mutt"
+        assert not hasattr(obj, "rowid")
@@ -0,0 +1,57 @@
+from datasette.app import Datasette
+from datasette_graphql import serializers
+from datasette_graphql.utils import _schema_cache
+import pytest
+from unittest import mock
+from .fixtures import ds, db_path
+
+QUERY = "{ users { nodes { name } } }"
+EXPECTED = {"data": {"users": {"nodes": [{"name": "cleopaws"}, {"name": "simonw"}]}}}
+
+
+@pytest.mark.parametrize("use_orjson", (True, False))
+def test_dumps_and_loads(use_orjson):
+    value = {"a": [1, 2.5, None, True], "b": "ünïcode", 1: 2**70}
+    with mock.patch.object(
+        serializers, "orjson", serializers.orjson if use_orjson else None
+    ):
+        encoded = serializers.dumps(value)
+        assert isinstance(encoded, bytes)
+        assert serializers.loads(encoded) == {
+            "a": [1, 2.5, None, True],
+            "b": "ünïcode",
+            "1": 2**70,
+        }
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_orjson", (True, False))
+async def test_graphql_with_and_without_orjson(ds, use_orjson):
+    with mock.patch.object(
+        serializers, "orjson", serializers.orjson if use_orjson else None
+    ):
+        response = await ds.client.post("/graphql", json={"query": QUERY})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json; charset=utf-8"
+    assert response.json() == EXPECTED
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_body_size,expected_status", ((100, 413), (0, 200)))
+async def test_max_body_size(db_path, max_body_size, expected_status):
+    _schema_cache.clear()
+    ds = Datasette(
+        [str(db_path)],
+        metadata={"plugins": {"datasette-graphql": {"max_body_size": max_body_size}}},
+    )
+    padded_query = QUERY + " " * 200
+    response = await ds.client.post("/graphql", json={"query": padded_query})
+    assert response.status_code == expected_status
+    if expected_status == 413:
+        assert response.json() == {"error": "Request body too large"}
+    else:
+        assert response.json() == EXPECTED
+    # Small requests are still allowed
+    response = await ds.client.post("/graphql", json={"query": QUERY})
+    assert response.status_code == 200
+    _schema_cache.clear()
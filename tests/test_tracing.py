@@ -0,0 +1,123 @@
+from datasette.app import Datasette
+from datasette_graphql.utils import _schema_cache
+import pytest
+from .fixtures import ds, db_path
+
+QUERY = "{ repos(first: 2) { nodes { full_name owner { name } } } }"
+
+
+def root_cookies(ds):
+    return {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "path,headers",
+    (
+        ("/graphql", {"x-graphql-tracing": "1"}),
+        ("/graphql?_tracing=1", {}),
+    ),
+)
+async def test_tracing(ds, path, headers):
+    response = await ds.client.post(
+        path, json={"query": QUERY}, headers=headers, cookies=root_cookies(ds)
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["data"]["repos"]["nodes"] == [
+        {"full_name": "simonw/datasette", "owner": {"name": "simonw"}},
+        {"full_name": "cleopaws/dogspotter", "owner": {"name": "cleopaws"}},
+    ]
+    tracing = data["extensions"]["tracing"]
+    assert tracing["version"] == 1
+    assert tracing["startTime"].endswith("Z")
+    assert tracing["endTime"] >= tracing["startTime"]
+    assert tracing["duration"] > 0
+    assert set(tracing["parsing"]) == {"startOffset", "duration"}
+    assert set(tracing["validation"]) == {"startOffset", "duration"}
+    resolvers = {
+        tuple(resolver["path"]): resolver
+        for resolver in tracing["execution"]["resolvers"]
+    }
+    assert set(resolvers) == {
+        ("repos",),
+        ("repos", "nodes"),
+        ("repos", "nodes", 0, "full_name"),
+        ("repos", "nodes", 0, "owner"),
+        ("repos", "nodes", 0, "owner", "name"),
+        ("repos", "nodes", 1, "full_name"),
+        ("repos", "nodes", 1, "owner"),
+        ("repos", "nodes", 1, "owner", "name"),
+    }
+    repos = resolvers[("repos",)]
+    assert repos["parentType"] == "Query"
+    assert repos["fieldName"] == "repos"
+    assert repos["returnType"] == "reposCollection"
+    assert repos["startOffset"] > 0
+    assert repos["duration"] > 0
+    (statement,) = repos["sql"]
+    assert statement["sql"].startswith("select id, full_name")
+    assert statement["startOffset"] >= repos["startOffset"]
+    # Both owners are fetched by one query, credited to the first resolver
+    owner_sql = resolvers[("repos", "nodes", 0, "owner")]["sql"]
+    assert owner_sql[0]["sql"].startswith("select * from [users] where [id] in")
+    assert "sql" not in resolvers[("repos", "nodes", 1, "owner")]
+    assert resolvers[("repos", "nodes", 1, "owner")]["duration"] > 0
+
+
+@pytest.mark.asyncio
+async def test_tracing_batch(ds):
+    response = await ds.client.post(
+        "/graphql",
+        json=[{"query": "{ users { totalCount } }"}, {"query": QUERY}],
+        headers={"x-graphql-tracing": "1"},
+        cookies=root_cookies(ds),
+    )
+    first, second = response.json()
+    assert [
+        r["path"] for r in first["extensions"]["tracing"]["execution"]["resolvers"]
+    ] == [
+        ["users"],
+        ["users", "totalCount"],
+    ]
+    assert len(second["extensions"]["tracing"]["execution"]["resolvers"]) == 8
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "headers,cookies",
+    (
+        # Tracing was not requested
+        ({}, True),
+        ({"x-graphql-tracing": "0"}, True),
+        # Anonymous users do not have the graphql-tracing permission
+        ({"x-graphql-tracing": "1"}, False),
+    ),
+)
+async def test_tracing_not_included(ds, headers, cookies):
+    response = await ds.client.post(
+        "/graphql",
+        json={"query": QUERY},
+        headers=headers,
+        cookies=root_cookies(ds) if cookies else {},
+    )
+    assert response.status_code == 200
+    assert "extensions" not in response.json()
+
+
+@pytest.mark.asyncio
+async def test_tracing_permission(db_path):
+    _schema_cache.clear()
+    ds = Datasette(
+        [str(db_path)],
+        config={"permissions": {"graphql-tracing": {"id": "alice"}}},
+    )
+    for actor, expected in (({"id": "alice"}, True), ({"id": "bob"}, False)):
+        response = await ds.client.post(
+            "/graphql",
+            json={"query": "{ users { totalCount } }"},
+            headers={"x-graphql-tracing": "1"},
+            cookies={"ds_actor": ds.client.actor_cookie(actor)},
+        )
+        assert ("extensions" in response.json()) == expected
+    _schema_cache.clear()
@@ -1,3 +1,4 @@
+import sqlite_utils
 from datasette_graphql import utils
 
 
@@ -15,3 +16,46 @@ def test_namer():
         ("this$and&that", "this_and_that"),
     ):
         assert n.name(input) == expected
+
+
+def test_introspect_tables():
+    db = sqlite_utils.Database(memory=True)
+    db.executescript(
+        """
+        create table owners (id integer primary key, name text);
+        create table pets (
+            type text, id integer, owner integer references owners, name text,
+            primary key (id, type)
+        );
+        create table visits (
+            pet_type text, pet_id integer, vet text,
+            foreign key (pet_id, pet_type) references pets(id, type)
+        );
+        create virtual table pets_fts using fts5 (name, content="pets");
+        create view owner_names as select name from owners;
+        """
+    )
+    metadata = utils.introspect_tables(db.conn, None, "db", {})
+    assert [table for table in metadata if not table.startswith("pets_fts_")] == [
+        "owners",
+        "pets",
+        "visits",
+        "pets_fts",
+        "owner_names",
+    ]
+    assert metadata["owners"].columns == {"id": int, "name": str}
+    assert metadata["owners"].pks == ["id"]
+    # Primary keys are in declaration order
+    assert metadata["pets"].pks == ["id", "type"]
+    # References with no column use the primary key, compound keys are skipped
+    assert metadata["pets"].foreign_keys == [
+        utils.ForeignKey("pets", "owner", "owners", "id")
+    ]
+    assert metadata["owners"].fks_back == metadata["pets"].foreign_keys
+    assert metadata["visits"].foreign_keys == []
+    assert metadata["visits"].pks == ["rowid"]
+    assert metadata["pets"].supports_fts
+    assert not metadata["owners"].supports_fts
+    assert metadata["owner_names"].is_view
+    assert metadata["owner_names"].pks == []
+    assert metadata["owner_names"].columns == {"name": str}
@@ -0,0 +1,101 @@
+from click import ClickException
+from datasette.app import Datasette
+from datasette_graphql import _warm_up_tasks
+from datasette_graphql.utils import (
+    _schema_cache,
+    introspect_tables,
+    schema_for_database,
+)
+import asyncio
+import sqlite_utils
+import pytest
+from unittest import mock
+from .fixtures import fresh_db_path
+
+
+@pytest.fixture
+def warm_db_path(fresh_db_path):
+    return fresh_db_path("warm")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("warm_up", (True, ["warm"]))
+async def test_warm_up(warm_db_path, warm_up):
+    ds = Datasette(
+        [str(warm_db_path)],
+        metadata={"plugins": {"datasette-graphql": {"warm_up": warm_up}}},
+    )
+    await ds.invoke_startup()
+    await asyncio.gather(*_warm_up_tasks)
+    assert [key[0] for key in _schema_cache.keys()] == ["warm"]
+    with mock.patch(
+        "datasette_graphql.utils.schema_for_database"
+    ) as mock_schema_for_database:
+        response = await ds.client.post(
+            "/graphql", json={"query": "{ users { totalCount } }"}
+        )
+    assert response.json() == {"data": {"users": {"totalCount": 2}}}
+    assert not mock_schema_for_database.called
+
+
+@pytest.mark.asyncio
+async def test_warm_up_invalid_database(warm_db_path):
+    ds = Datasette(
+        [str(warm_db_path)],
+        metadata={"plugins": {"datasette-graphql": {"warm_up": ["missing"]}}},
+    )
+    with pytest.raises(ClickException):
+        await ds.invoke_startup()
+
+
+@pytest.mark.asyncio
+async def test_introspection_cache_dir(warm_db_path, tmp_path):
+    cache_dir = tmp_path / "cache"
+    metadata = {
+        "plugins": {"datasette-graphql": {"introspection_cache_dir": str(cache_dir)}}
+    }
+    with mock.patch(
+        "datasette_graphql.utils.introspect_tables", side_effect=introspect_tables
+    ) as mock_introspect_tables:
+        ds = Datasette([str(warm_db_path)], metadata=metadata)
+        schema = await schema_for_database(ds, "warm")
+        assert mock_introspect_tables.call_count == 1
+        assert len(list(cache_dir.glob("*.json"))) == 1
+
+        # A new instance - as if in a new process - uses the cache file
+        ds2 = Datasette([str(warm_db_path)], metadata=metadata)
+        schema2 = await schema_for_database(ds2, "warm")
+        assert mock_introspect_tables.call_count == 1
+        assert set(schema2.table_classes) == set(schema.table_classes)
+        assert schema2.fingerprints == schema.fingerprints
+
+        # Changing the schema means the database must be introspected again
+        sqlite_utils.Database(warm_db_path)["new_table"].insert({"id": 1})
+        schema3 = await schema_for_database(ds2, "warm")
+        assert mock_introspect_tables.call_count == 2
+        assert "new_table" in schema3.table_classes
+        assert len(list(cache_dir.glob("*.json"))) == 1
+
+
+@pytest.mark.asyncio
+async def test_introspection_cache_dir_rebuilt_database(tmp_path):
+    cache_dir = tmp_path / "cache"
+    metadata = {
+        "plugins": {"datasette-graphql": {"introspection_cache_dir": str(cache_dir)}}
+    }
+    db_path = tmp_path / "rebuilt.db"
+    sqlite_utils.Database(db_path)["items"].insert({"id": 1, "name": "one"}, pk="id")
+    ds = Datasette([str(db_path)], metadata=metadata)
+    await schema_for_database(ds, "rebuilt")
+
+    # A different file at the same path, with the same schema_version
+    rebuilt_path = tmp_path / "other.db"
+    sqlite_utils.Database(rebuilt_path)["items"].insert(
+        {"id": 1, "title": "One"}, pk="id"
+    )
+    rebuilt_path.replace(db_path)
+    ds2 = Datasette([str(db_path)], metadata=metadata)
+    response = await ds2.client.post(
+        "/graphql", json={"query": "{ items { nodes { title } } }"}
+    )
+    assert response.json() == {"data": {"items": {"nodes": [{"title": "One"}]}}}